@@ -1,5 +1,11 @@
 #!/usr/bin/env python3
 
+import configparser
+import fnmatch
+import gzip
+import hashlib
+import http.client
+import json
 import socket
 import logging
 import os
@@ -7,6 +13,8 @@ import subprocess
 import sys
 import string
 import secrets
+import time
+import zlib
 from pathlib import Path
 
 sys.path.append('lib')
@@ -20,11 +28,21 @@ import charmhelpers.core.host as ch_host
 import charmhelpers.core.templating as ch_templating
 import interface_ceph_client.ceph_client as ceph_client
 import interface_ceph_iscsi_peer
+import interface_http
 import interface_tls_certificates.ca_client as ca_client
 
 import ops_openstack.adapters
 import ops_openstack.core
+import client_tuning
+import daemon_tuning
 import gwcli_client
+import hook_timings
+import lio_exporter
+import lio_stats
+import lun_placement
+import provisioning
+import rbd_client
+import task_graph
 import cryptography.hazmat.primitives.serialization as serialization
 logger = logging.getLogger(__name__)
 
@@ -47,6 +65,20 @@ class CephClientAdapter(ops_openstack.adapters.OpenStackOperRelationAdapter):
     def key(self):
         return self.relation.get_relation_data()['key']
 
+    @property
+    def tuning(self):
+        """librados/librbd settings from the configured tuning profile."""
+        config = self.relation.model.config
+        try:
+            settings = client_tuning.client_settings(
+                config.get('client-tuning-profile') or 'none',
+                config.get('client-tuning-overrides'))
+        except client_tuning.TuningError as exc:
+            # Reported by the status check, render the defaults meanwhile.
+            logging.error("Ignoring client tuning: {}".format(exc))
+            return []
+        return list(settings.items())
+
 
 class PeerAdapter(ops_openstack.adapters.OpenStackOperRelationAdapter):
 
@@ -65,10 +97,11 @@ class GatewayClientPeerAdapter(PeerAdapter):
         return ' '.join(sorted(hosts))
 
     @property
-    def trusted_ips(self):
-        ips = self.allowed_ips
-        ips.extend(self.relation.peer_addresses)
-        return ' '.join(sorted(ips))
+    def trusted_ip_list(self):
+        return ' '.join(interface_ceph_iscsi_peer.format_networks(
+            interface_ceph_iscsi_peer.collapse_networks(
+                (self.relation.allowed_ips or []) +
+                self.relation.peer_addresses)))
 
 
 class TLSCertificatesAdapter(
@@ -104,12 +137,19 @@ class CephISCSIGatewayCharmBase(ops_openstack.core.OSBaseCharm):
         "mon", "allow *",
         "mgr", "allow r"]
 
+    OSD_SETTINGS = {
+        'osd heartbeat grace': 20,
+        'osd heartbeat interval': 5}
+
     DEFAULT_TARGET = "iqn.2003-01.com.ubuntu.iscsi-gw:iscsi-igw"
+    # Bindings whose addresses are published as iSCSI portals, so that
+    # initiators can spread their paths over several data networks.
+    PORTAL_BINDINGS = ['iscsi']
     REQUIRED_RELATIONS = ['ceph-client', 'cluster']
 
-    # Two has been tested but four is probably fine too but needs
-    # validating
-    ALLOWED_UNIT_COUNTS = [2]
+    # Each disk is served by one owning gateway with the others acting as
+    # standby paths.
+    ALLOWED_UNIT_COUNTS = [2, 3, 4]
 
     CEPH_CONFIG_PATH = Path('/etc/ceph')
     CEPH_ISCSI_CONFIG_PATH = CEPH_CONFIG_PATH / 'iscsi'
@@ -124,11 +164,74 @@ class CephISCSIGatewayCharmBase(ops_openstack.core.OSBaseCharm):
         '/usr/local/share/ca-certificates/vault_ca_cert.crt')
 
     GW_SERVICES = ['rbd-target-api', 'rbd-target-gw']
+    # tcmu-runner does the RBD I/O of the LUNs ceph-iscsi sets up. It
+    # opens every image with the current ceph.conf, so config changes do
+    # not restart it.
+    TCMU_SERVICE = 'tcmu-runner'
+    # The gateway daemons, in the order they are (re)started.
+    DAEMONS = [TCMU_SERVICE, 'rbd-target-gw', 'rbd-target-api']
+
+    # systemd drop-in, from templates/daemon-tuning.conf, with the
+    # scheduling and resource settings of the DAEMONS.
+    SYSTEMD_DIR = Path('/etc/systemd/system')
+    TUNING_DROPIN = 'daemon-tuning.conf'
+
+    # Must match the api_* settings in templates/iscsi-gateway.cfg
+    API_PORT = 5000
+    API_USER = 'admin'
+
+    # Prometheus exporter for the LIO/TCMU statistics, run from copies of
+    # the charm's modules so it does not depend on the charm directory.
+    # EXPORTER_DIR must match templates/ceph-iscsi-exporter.service
+    EXPORTER_SERVICE = 'ceph-iscsi-exporter'
+    EXPORTER_DIR = Path('/usr/local/lib/ceph-iscsi-exporter')
+    CONFIG_EXPORT_DIR = Path('/var/lib/ceph-iscsi-charm/exports')
+    GZIP_MAGIC = b'\x1f\x8b'
+    EXPORTER_MODULES = ['lio_exporter.py', 'lio_stats.py']
+    EXPORTER_UNIT = Path('/etc/systemd/system/ceph-iscsi-exporter.service')
+
+    # Seconds to wait for the gateway to serve again after a restart
+    # before handing the restart token to the next unit.
+    GATEWAY_START_TIMEOUT = 120
+
+    # The DAEMONS' tuning drop-ins, written by render_tuning rather than
+    # rendered with the other config files. Listing them in RESTART_MAP
+    # also has pause and resume manage tcmu-runner.
+    TUNING_DROPINS = {
+        str(SYSTEMD_DIR / 'tcmu-runner.service.d' / TUNING_DROPIN):
+            [TCMU_SERVICE],
+        str(SYSTEMD_DIR / 'rbd-target-gw.service.d' / TUNING_DROPIN):
+            ['rbd-target-gw'],
+        str(SYSTEMD_DIR / 'rbd-target-api.service.d' / TUNING_DROPIN):
+            ['rbd-target-api']}
 
     RESTART_MAP = {
         str(GW_CONF): GW_SERVICES,
         str(CEPH_CONF): GW_SERVICES,
-        str(GW_KEYRING): GW_SERVICES}
+        str(GW_KEYRING): GW_SERVICES,
+        # Written by render_exporter, listed so that pause and resume
+        # stop and start the exporter with the gateway.
+        str(EXPORTER_UNIT): [EXPORTER_SERVICE]}
+    RESTART_MAP.update(TUNING_DROPINS)
+
+    # iscsi-gateway.cfg settings only read by some of the gateway daemons,
+    # changes to any other setting restart all of GW_SERVICES.
+    # rbd-target-gw only exports metrics so it has no use for the API
+    # settings. ceph-iscsi only reads these at startup so none of them
+    # can be changed without a restart.
+    GW_CONF_KEY_SERVICES = {
+        'api_secure': ['rbd-target-api'],
+        'api_user': ['rbd-target-api'],
+        'api_password': ['rbd-target-api'],
+        'api_port': ['rbd-target-api'],
+        'trusted_ip_list': ['rbd-target-api'],
+        # Defaults for disks and targets from the [target] section, applied
+        # by rbd-target-api as it loads them.
+        'max_data_area_mb': ['rbd-target-api'],
+        'hw_max_sectors': ['rbd-target-api'],
+        'qfull_timeout': ['rbd-target-api'],
+        'osd_op_timeout': ['rbd-target-api'],
+        'cmdsn_depth': ['rbd-target-api']}
 
     release = 'default'
 
@@ -137,7 +240,12 @@ class CephISCSIGatewayCharmBase(ops_openstack.core.OSBaseCharm):
         logging.info("Using {} class".format(self.release))
         self.state.set_default(
             target_created=False,
-            enable_tls=False)
+            enable_tls=False,
+            pending_restarts=[],
+            config_dirty=False,
+            ceph_request_digest='')
+        self.timings = hook_timings.Timings(self.state)
+        self._gw_client = None
         self.ceph_client = ceph_client.CephClientRequires(
             self,
             'ceph-client')
@@ -147,6 +255,10 @@ class CephISCSIGatewayCharmBase(ops_openstack.core.OSBaseCharm):
         self.ca_client = ca_client.CAClient(
             self,
             'certificates')
+        self.metrics_endpoint = interface_http.HTTPProvides(
+            self,
+            'prometheus',
+            lambda: self.model.config['metrics-port'])
         self.adapters = CephISCSIGatewayAdapters(
             (self.ceph_client, self.peers, self.ca_client),
             self)
@@ -162,6 +274,9 @@ class CephISCSIGatewayCharmBase(ops_openstack.core.OSBaseCharm):
         self.framework.observe(
             self.peers.on.allowed_ips_changed,
             self.render_config)
+        self.framework.observe(
+            self.peers.on.restart_granted,
+            self.on_restart_granted)
         self.framework.observe(
             self.ca_client.on.tls_app_config_ready,
             self.on_tls_app_config_ready)
@@ -170,7 +285,7 @@ class CephISCSIGatewayCharmBase(ops_openstack.core.OSBaseCharm):
             self.on_ca_available)
         self.framework.observe(
             self.on.config_changed,
-            self.render_config)
+            self.refresh_request)
         self.framework.observe(
             self.on.upgrade_charm,
             self.render_config)
@@ -180,14 +295,44 @@ class CephISCSIGatewayCharmBase(ops_openstack.core.OSBaseCharm):
         self.framework.observe(
             self.on.add_trusted_ip_action,
             self.on_add_trusted_ip_action)
+        self.framework.observe(
+            self.on.apply_manifest_action,
+            self.on_apply_manifest_action)
+        self.framework.observe(
+            self.on.export_config_action,
+            self.on_export_config_action)
+        self.framework.observe(
+            self.on.import_config_action,
+            self.on_import_config_action)
+        self.framework.observe(
+            self.on.set_qos_action,
+            self.on_set_qos_action)
+        self.framework.observe(
+            self.on.get_qos_action,
+            self.on_get_qos_action)
+        self.framework.observe(
+            self.on.resize_disks_action,
+            self.on_resize_disks_action)
+        self.framework.observe(
+            self.on.rebalance_action,
+            self.on_rebalance_action)
+        self.framework.observe(
+            self.on.hook_timings_action,
+            self.on_hook_timings_action)
+        self.framework.observe(
+            self.framework.on.pre_commit,
+            self.on_pre_commit)
 
+    @hook_timings.timed
     def on_install(self, event):
         if ch_host.is_container():
             logging.info("Installing into a container is not supported")
             self.update_status()
         else:
-            self.install_pkgs()
+            with self.timings.timer('step:install_pkgs'):
+                self.install_pkgs()
 
+    @hook_timings.timed
     def on_has_peers(self, event):
         logging.info("Unit has peers")
         if self.unit.is_leader() and not self.peers.admin_password:
@@ -196,60 +341,362 @@ class CephISCSIGatewayCharmBase(ops_openstack.core.OSBaseCharm):
             password = ''.join(secrets.choice(alphabet) for i in range(8))
             self.peers.set_admin_password(password)
 
+    @property
+    def ec_data_pool(self):
+        """Erasure-coded pool for image data, None if not configured."""
+        if self.model.config.get('pool-type') != 'erasure-coded':
+            return None
+        default = '{}-ec'.format(self.model.config['rbd-metadata-pool'])
+        return self.model.config.get('ec-data-pool') or default
+
+    def ceph_broker_requests(self):
+        """Everything the gateways need from ceph, in one list.
+
+        :returns: [(ceph_client method, args, kwargs)], json serialisable.
+                  'add_op' entries are raw broker ops, see add_broker_op.
+        """
+        requests = [(
+            'create_replicated_pool',
+            (self.model.config['rbd-metadata-pool'],),
+            {})]
+        data_pool = self.ec_data_pool
+        if data_pool:
+            profile = self.model.config.get('ec-profile-name')
+            profile = profile or '{}-profile'.format(data_pool)
+            # The ceph-client interface only has methods for replicated
+            # pools, so the erasure code ops are added to its broker
+            # request as they are.
+            requests.append((
+                'add_op',
+                ({
+                    'op': 'create-erasure-profile',
+                    'name': profile,
+                    'erasure-type': self.model.config['ec-profile-plugin'],
+                    'failure-domain': None,
+                    'k': self.model.config['ec-profile-k'],
+                    'm': self.model.config['ec-profile-m'],
+                    'device-class': self.model.config.get(
+                        'ec-profile-device-class') or None},),
+                {}))
+            # RBD needs partial overwrites to keep data in an EC pool, and
+            # the pool is tagged for rbd so ceph does not warn about a pool
+            # without an application.
+            requests.append((
+                'add_op',
+                ({
+                    'op': 'create-pool',
+                    'name': data_pool,
+                    'pool-type': 'erasure',
+                    'erasure-profile': profile,
+                    'allow-ec-overwrites': True,
+                    'app-name': 'rbd',
+                    'group': None,
+                    'group-namespace': None,
+                    'max-bytes': None,
+                    'max-objects': None,
+                    'weight': None},),
+                {}))
+        requests.append((
+            'request_ceph_permissions',
+            ('ceph-iscsi', self.CEPH_CAPABILITIES),
+            {}))
+        requests.append((
+            'request_osd_settings',
+            (self.OSD_SETTINGS,),
+            {}))
+        return requests
+
+    @hook_timings.timed
     def request_ceph_pool(self, event):
-        logging.info("Requesting replicated pool")
-        self.ceph_client.create_replicated_pool(
-            self.model.config['rbd-metadata-pool'])
-        logging.info("Requesting permissions")
-        self.ceph_client.request_ceph_permissions(
-            'ceph-iscsi',
-            self.CEPH_CAPABILITIES)
-        self.ceph_client.request_osd_settings({
-            'osd heartbeat grace': 20,
-            'osd heartbeat interval': 5})
+        """Send the ceph broker request unless it was already sent.
 
+        The ops are added to one broker request, which is only sent again
+        when its contents or the ceph-client relations change, sparing
+        the monitors and the gateways a round of broker processing and
+        pools_available hooks.
+        """
+        requests = self.ceph_broker_requests()
+        relation_ids = sorted(
+            r.id for r in self.model.relations['ceph-client'])
+        digest = hashlib.sha256(json.dumps(
+            [relation_ids, requests],
+            sort_keys=True).encode()).hexdigest()
+        if digest == self.state.ceph_request_digest:
+            logging.info("Ceph broker request unchanged, not sending")
+            return
+        logging.info("Sending ceph broker request: {}".format(
+            ', '.join(method for method, _, _ in requests)))
+        for method, args, kwargs in requests:
+            if method == 'add_op':
+                self.add_broker_op(*args)
+            else:
+                getattr(self.ceph_client, method)(*args, **kwargs)
+        self.state.ceph_request_digest = digest
+
+    def add_broker_op(self, op):
+        """Add an op to the ceph-client broker request and send it.
+
+        This goes through the same request and send path as the
+        interface's own methods, for ops it has no method for.
+        """
+        relations = self.model.relations['ceph-client']
+        if not relations:
+            return
+        request = self.ceph_client.get_existing_request()
+        request.add_op(op)
+        self.ceph_client.send_request_if_needed(request, relations)
+
+    @hook_timings.timed
     def refresh_request(self, event):
         self.render_config(event)
-        self.request_ceph_pool(event)
+        if self.model.get_relation('ceph-client'):
+            # Pick up pool changes, eg switching to erasure-coded.
+            self.request_ceph_pool(event)
 
+    @hook_timings.timed
     def render_config(self, event):
+        """Have the config rendered once this hook's events are handled."""
+        self.state.config_dirty = True
+
+    @hook_timings.timed
+    def reconcile(self):
+        """Render config and restart services at most once per hook.
+
+        Runs before the framework commits, if any event asked for it with
+        render_config(). The request stays pending in StoredState until
+        the admin password and pools are available.
+        """
+        if not self.state.config_dirty:
+            return
         if not self.peers.admin_password:
-            logging.info("Defering setup")
-            print("Defering setup admin")
-            event.defer()
+            logging.info("Defering setup, no admin password yet")
             return
         if not self.ceph_client.pools_available:
-            print("Defering setup pools")
-            logging.info("Defering setup")
-            event.defer()
+            logging.info("Defering setup, pools not available yet")
             return
 
         self.CEPH_ISCSI_CONFIG_PATH.mkdir(
             exist_ok=True,
             mode=0o750)
 
-        def daemon_reload_and_restart(service_name):
-            subprocess.check_call(['systemctl', 'daemon-reload'])
-            subprocess.check_call(['systemctl', 'restart', service_name])
-
-        rfuncs = {
-            'rbd-target-api': daemon_reload_and_restart}
-
-        @ch_host.restart_on_change(self.RESTART_MAP, restart_functions=rfuncs)
-        def _render_configs():
-            for config_file in self.RESTART_MAP.keys():
-                ch_templating.render(
-                    os.path.basename(config_file),
-                    config_file,
-                    self.adapters)
         logging.info("Rendering config")
-        _render_configs()
+        self.restart_services(self.render_configs() | self.render_tuning())
+        self.render_exporter()
+        self.metrics_endpoint.publish()
         logging.info("Setting started state")
-        self.peers.announce_ready()
+        self.peers.announce_ready(self.portal_addresses)
         self.state.is_started = True
+        self.state.config_dirty = False
         self.update_status()
         logging.info("on_pools_available: status updated")
 
+    def _gw_conf_services(self, old, new):
+        """Return the services affected by changes to iscsi-gateway.cfg."""
+        def parse(content):
+            parser = configparser.ConfigParser(interpolation=None)
+            parser.read_string(content)
+            return {
+                key: value
+                for section in parser.sections()
+                for key, value in parser.items(section)}
+        old_settings = parse(old)
+        new_settings = parse(new)
+        services = set()
+        for key in set(old_settings) | set(new_settings):
+            if old_settings.get(key) != new_settings.get(key):
+                logging.info("{} changed".format(key))
+                services.update(
+                    self.GW_CONF_KEY_SERVICES.get(key, self.GW_SERVICES))
+        return services
+
+    def render_configs(self):
+        """Render the config files, writing only those whose content changed.
+
+        :returns: Set of services that need restarting to pick up the
+                  changes.
+        """
+        services = set()
+        for config_file, file_services in self.RESTART_MAP.items():
+            if config_file in self.TUNING_DROPINS:
+                continue
+            if config_file == str(self.EXPORTER_UNIT):
+                continue
+            content = ch_templating.render(
+                os.path.basename(config_file),
+                None,
+                self.adapters)
+            new_hash = hashlib.sha256(content.encode('UTF-8')).hexdigest()
+            old_hash = ch_host.file_hash(config_file, hash_type='sha256')
+            if new_hash == old_hash:
+                continue
+            logging.info("Writing {}".format(config_file))
+            if old_hash and config_file == str(self.GW_CONF):
+                services.update(self._gw_conf_services(
+                    Path(config_file).read_text(),
+                    content))
+            else:
+                services.update(file_services)
+            ch_host.write_file(
+                config_file,
+                content.encode('UTF-8'),
+                perms=0o444)
+        return services
+
+    def portal_numa_node(self):
+        """NUMA node of the NIC serving the iSCSI portals, None if unknown."""
+        for binding_name in self.PORTAL_BINDINGS:
+            network = self.model.get_binding(binding_name).network
+            for interface in network.interfaces:
+                node = daemon_tuning.interface_numa_node(interface.name)
+                if node is not None:
+                    return node
+        return None
+
+    def render_tuning(self):
+        """Write the DAEMONS' tuning drop-ins, removing them if unused.
+
+        :returns: Set of services to restart for the changes to apply.
+        """
+        try:
+            settings = daemon_tuning.service_settings(
+                self.model.config,
+                self.portal_numa_node)
+        except daemon_tuning.TuningError as exc:
+            # Reported by the status check, leave the drop-ins alone.
+            logging.error("Ignoring daemon tuning: {}".format(exc))
+            return set()
+        content = None
+        if settings:
+            content = ch_templating.render(
+                self.TUNING_DROPIN,
+                None,
+                {'settings': list(settings.items())}).encode('UTF-8')
+        changed = set()
+        for dropin, services in self.TUNING_DROPINS.items():
+            path = Path(dropin)
+            old_hash = ch_host.file_hash(dropin, hash_type='sha256')
+            if content is None:
+                if old_hash:
+                    logging.info("Removing {}".format(path))
+                    path.unlink()
+                    changed.update(services)
+                continue
+            if hashlib.sha256(content).hexdigest() == old_hash:
+                continue
+            logging.info("Writing {}".format(path))
+            path.parent.mkdir(parents=True, exist_ok=True)
+            ch_host.write_file(dropin, content, perms=0o644)
+            changed.update(services)
+        if changed:
+            subprocess.check_call(['systemctl', 'daemon-reload'])
+        return changed
+
+    def render_exporter(self):
+        """Install or update the metrics exporter, restarting it on change.
+
+        The exporter only reads statistics so it is restarted straight
+        away rather than waiting for the restart token.
+        """
+        src = Path(__file__).parent
+        files = [
+            (self.EXPORTER_DIR / m, (src / m).read_bytes())
+            for m in self.EXPORTER_MODULES]
+        files.append((
+            self.EXPORTER_UNIT,
+            ch_templating.render(
+                self.EXPORTER_UNIT.name,
+                None,
+                self.adapters).encode('UTF-8')))
+        changed = []
+        for path, content in files:
+            old_hash = ch_host.file_hash(str(path), hash_type='sha256')
+            if hashlib.sha256(content).hexdigest() == old_hash:
+                continue
+            logging.info("Writing {}".format(path))
+            path.parent.mkdir(parents=True, exist_ok=True)
+            ch_host.write_file(str(path), content, perms=0o644)
+            changed.append(path)
+        if not changed:
+            return
+        if self.EXPORTER_UNIT in changed:
+            subprocess.check_call(['systemctl', 'daemon-reload'])
+            subprocess.check_call(
+                ['systemctl', 'enable', self.EXPORTER_SERVICE])
+        ch_host.service_restart(self.EXPORTER_SERVICE)
+
+    def restart_services(self, services):
+        """Restart services, one gateway at a time when clustered.
+
+        Restarting the gateway services drops the iSCSI paths through
+        this gateway, so when there are peers the restart waits for the
+        restart token and initiators keep their paths through the other
+        gateways.
+        """
+        if not services:
+            return
+        if not self.peers.peer_rel or not self.peers.peer_count:
+            self._restart_now(services)
+            return
+        self.state.pending_restarts = sorted(
+            set(self.state.pending_restarts) | set(services))
+        self.peers.request_restart()
+
+    @hook_timings.timed
+    def on_restart_granted(self, event):
+        self._restart_now(self.state.pending_restarts)
+        self.state.pending_restarts = []
+        self.peers.release_restart()
+
+    def _restart_now(self, services):
+        def start_order(service):
+            if service in self.DAEMONS:
+                return (self.DAEMONS.index(service), service)
+            return (len(self.DAEMONS), service)
+        for service in sorted(services, key=start_order):
+            logging.info("Restarting {}".format(service))
+            ch_host.service_restart(service)
+        if services:
+            self.wait_for_gateway()
+
+    @property
+    def portal_addresses(self):
+        """Addresses initiators reach this gateway on, eg one per NIC.
+
+        Every address on the PORTAL_BINDINGS is a portal, falling back to
+        the cluster address.
+        """
+        addresses = []
+        for binding_name in self.PORTAL_BINDINGS:
+            network = self.model.get_binding(binding_name).network
+            for interface in network.interfaces:
+                address = str(interface.address)
+                if address not in addresses:
+                    addresses.append(address)
+        return addresses or [self.peers.cluster_bind_address]
+
+    def _api_listening(self):
+        try:
+            with socket.create_connection(
+                    (self.peers.cluster_bind_address, self.API_PORT),
+                    timeout=2):
+                return True
+        except OSError:
+            return False
+
+    def wait_for_gateway(self):
+        """Wait until the gateway services are serving again."""
+        deadline = time.monotonic() + self.GATEWAY_START_TIMEOUT
+        while time.monotonic() < deadline:
+            running = all(
+                ch_host.service_running(s) for s in self.DAEMONS)
+            if running and self._api_listening():
+                return True
+            time.sleep(2)
+        logging.warning("Gateway services not serving after {}s".format(
+            self.GATEWAY_START_TIMEOUT))
+        return False
+
+    @hook_timings.timed
     def on_ca_available(self, event):
         addresses = set()
         for binding_name in ['public', 'cluster']:
@@ -260,34 +707,81 @@ class CephISCSIGatewayCharmBase(ops_openstack.core.OSBaseCharm):
         sans.append(socket.gethostname())
         self.ca_client.request_application_certificate(socket.getfqdn(), sans)
 
+    def _tls_files(self):
+        """Return [(path, content, perms)] for the TLS material."""
+        key = self.ca_client.application_key
+        key_pem = key.private_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PrivateFormat.TraditionalOpenSSL,
+            encryption_algorithm=serialization.NoEncryption())
+        cert_pem = self.ca_client.application_certificate.public_bytes(
+            encoding=serialization.Encoding.PEM)
+        return [
+            (self.TLS_KEY_PATH, key_pem, 0o600),
+            (self.TLS_CERT_PATH, cert_pem, 0o644),
+            (
+                self.TLS_CA_CERT_PATH,
+                self.ca_client.ca_certificate.public_bytes(
+                    encoding=serialization.Encoding.PEM),
+                0o644),
+            (self.TLS_KEY_AND_CERT_PATH, cert_pem + b'\n' + key_pem, 0o600),
+            (
+                self.TLS_PUB_KEY_PATH,
+                key.public_key().public_bytes(
+                    format=serialization.PublicFormat.SubjectPublicKeyInfo,
+                    encoding=serialization.Encoding.PEM),
+                0o644)]
+
+    def _write_atomic(self, path, content, perms):
+        """Replace path with content so readers never see a partial file.
+
+        The temporary file is created with perms, so private keys are
+        never readable by others, not even briefly.
+        """
+        tmp = path.with_name('.{}.tmp'.format(path.name))
+        # A file left by an interrupted write may have other permissions.
+        tmp.unlink(missing_ok=True)
+        tmp.touch(mode=perms, exist_ok=False)
+        try:
+            # The mode given on creation is masked by the umask.
+            tmp.chmod(perms)
+            tmp.write_bytes(content)
+            tmp.replace(path)
+        except BaseException:
+            tmp.unlink(missing_ok=True)
+            raise
+
+    def write_tls_files(self):
+        """Write the TLS material, skipping files that are unchanged.
+
+        :returns: List of the paths written.
+        """
+        changed = []
+        for path, content, perms in self._tls_files():
+            old_hash = ch_host.file_hash(str(path), hash_type='sha256')
+            if hashlib.sha256(content).hexdigest() == old_hash:
+                continue
+            logging.info("Writing {}".format(path))
+            self._write_atomic(path, content, perms)
+            changed.append(path)
+        return changed
+
+    @hook_timings.timed
     def on_tls_app_config_ready(self, event):
-        self.TLS_KEY_PATH.write_bytes(
-            self.ca_client.application_key.private_bytes(
-                encoding=serialization.Encoding.PEM,
-                format=serialization.PrivateFormat.TraditionalOpenSSL,
-                encryption_algorithm=serialization.NoEncryption()))
-        self.TLS_CERT_PATH.write_bytes(
-            self.ca_client.application_certificate.public_bytes(
-                encoding=serialization.Encoding.PEM))
-        self.TLS_CA_CERT_PATH.write_bytes(
-            self.ca_client.ca_certificate.public_bytes(
-                encoding=serialization.Encoding.PEM))
-        self.TLS_KEY_AND_CERT_PATH.write_bytes(
-            self.ca_client.application_certificate.public_bytes(
-                encoding=serialization.Encoding.PEM) +
-            b'\n' +
-            self.ca_client.application_key.private_bytes(
-                encoding=serialization.Encoding.PEM,
-                format=serialization.PrivateFormat.TraditionalOpenSSL,
-                encryption_algorithm=serialization.NoEncryption())
-        )
-        self.TLS_PUB_KEY_PATH.write_bytes(
-            self.ca_client.application_key.public_key().public_bytes(
-                format=serialization.PublicFormat.SubjectPublicKeyInfo,
-                encoding=serialization.Encoding.PEM))
-        subprocess.check_call(['update-ca-certificates'])
-        self.state.enable_tls = True
-        self.render_config(event)
+        changed = self.write_tls_files()
+        if self.TLS_CA_CERT_PATH in changed:
+            with self.timings.timer('step:update-ca-certificates'):
+                subprocess.check_call(['update-ca-certificates'])
+        if not self.state.enable_tls:
+            # Switching the API to TLS, api_secure changes in the config.
+            self.state.enable_tls = True
+            self.render_config(event)
+        elif changed:
+            # A renewed certificate is only used by the API daemon.
+            logging.info("TLS material changed, restarting the API")
+            self.restart_services(['rbd-target-api'])
+        else:
+            logging.info("TLS material unchanged")
 
     def custom_status_check(self):
         if ch_host.is_container():
@@ -298,54 +792,683 @@ class CephISCSIGatewayCharmBase(ops_openstack.core.OSBaseCharm):
             self.unit.status = ops.model.BlockedStatus(
                 '{} is an invalid unit count'.format(self.peers.unit_count))
             return False
+        concurrency = self.model.config.get('provisioning-concurrency')
+        if concurrency is not None and concurrency < 1:
+            self.unit.status = ops.model.BlockedStatus(
+                'provisioning-concurrency must be at least 1')
+            return False
+        try:
+            client_tuning.client_settings(
+                self.model.config.get('client-tuning-profile') or 'none',
+                self.model.config.get('client-tuning-overrides'),
+                cpus=1,
+                memory=0)
+        except client_tuning.TuningError as exc:
+            self.unit.status = ops.model.BlockedStatus(
+                'Invalid client tuning: {}'.format(exc))
+            return False
+        try:
+            daemon_tuning.parse_options(self.model.config)
+        except daemon_tuning.TuningError as exc:
+            self.unit.status = ops.model.BlockedStatus(
+                'Invalid daemon tuning: {}'.format(exc))
+            return False
         return True
 
     # Actions
 
+    @hook_timings.timed
     def on_add_trusted_ip_action(self, event):
         if self.unit.is_leader():
-            ips = event.params.get('ips').split()
-            self.peers.set_allowed_ips(
-                ips,
-                append=not event.params['overwrite'])
+            try:
+                self.peers.set_allowed_ips(
+                    event.params.get('ips', '').split(),
+                    append=not event.params['overwrite'],
+                    remove=event.params.get('remove', '').split())
+            except ValueError as exc:
+                event.fail("Invalid address: {}".format(exc))
+                return
+            event.set_results({
+                'allowed-ips': ' '.join(self.peers.allowed_ips)})
             self.render_config(event)
         else:
             event.fail("Action must be run on leader")
 
+    def gateway_client(self):
+        """Return a client for the local rbd-target-api.
+
+        The client, and the inventory of gateway objects it keeps, is
+        shared by everything run in this hook.
+        """
+        if not self._gw_client:
+            self._gw_client = gwcli_client.GatewayClient(
+                host=self.peers.cluster_bind_address,
+                port=self.API_PORT,
+                user=self.API_USER,
+                password=self.peers.admin_password,
+                secure=self.state.enable_tls,
+                use_inventory=True,
+                timer=lambda name, seconds: self.timings.record(
+                    'api:{}'.format(name),
+                    seconds))
+        return self._gw_client
+
+    def rbd_client(self):
+        """Return an rbd CLI client using the gateway's ceph config."""
+        return rbd_client.RBDClient(conf=str(self.CEPH_CONF))
+
+    def _action_controls(self, params, controls):
+        """Map action params onto API controls, eg hw-max-sectors."""
+        return {
+            c: params[c.replace('_', '-')] for c in controls
+            if params.get(c.replace('_', '-')) is not None}
+
+    def _action_qos(self, params):
+        """Map action params onto QoS settings, eg iops-limit.
+
+        :raises: ValueError for bad values.
+        """
+        return rbd_client.parse_qos({
+            q: params[q.replace('_', '-')] for q in rbd_client.QOS_SETTINGS
+            if params.get(q.replace('_', '-')) is not None})
+
+    @hook_timings.timed
     def on_create_target_action(self, event):
-        gw_client = gwcli_client.GatewayClient()
+        gw_client = self.gateway_client()
         target = event.params.get('iqn', self.DEFAULT_TARGET)
         gateway_units = event.params.get(
             'gateway-units',
             [u for u in self.peers.ready_peer_details.keys()])
-        gw_client.create_target(target)
+        if isinstance(gateway_units, str):
+            gateway_units = gateway_units.split()
+        pool_name = event.params['pool-name']
+        image_name = event.params['image-name']
+        initiator = event.params['client-initiatorname']
+        source = event.params.get('source-snapshot')
+        if source:
+            try:
+                rbd_client.split_snapshot(source)
+            except ValueError as exc:
+                event.fail(str(exc))
+                return
+        elif not event.params.get('image-size'):
+            event.fail("image-size is needed unless cloning a snapshot")
+            return
+        data_pool = event.params.get('data-pool', self.ec_data_pool)
+        try:
+            qos = self._action_qos(event.params)
+        except ValueError as exc:
+            event.fail(str(exc))
+            return
+        disk_controls = self._action_controls(
+            event.params,
+            gwcli_client.DISK_CONTROLS)
+        target_controls = self._action_controls(
+            event.params,
+            gwcli_client.TARGET_CONTROLS)
+        target_lock = ['target:{}'.format(target)]
+        graph = task_graph.TaskGraph()
+        target_task = graph.add(
+            'create_target',
+            gw_client.create_target,
+            (target,),
+            locks=target_lock)
+        if target_controls:
+            target_task = graph.add(
+                'reconfigure_target',
+                gw_client.reconfigure_target,
+                (target, target_controls),
+                deps=[target_task],
+                locks=target_lock)
+        gateway_tasks = [target_task]
         for gw_unit, gw_config in self.peers.ready_peer_details.items():
-            added_gateways = []
             if gw_unit in gateway_units:
-                gw_client.add_gateway_to_target(
-                    target,
-                    gw_config['ip'],
-                    gw_config['fqdn'])
-                added_gateways.append(gw_unit)
-        gw_client.create_pool(
-            event.params['pool-name'],
-            event.params['image-name'],
-            event.params['image-size'])
-        gw_client.add_client_to_target(
-            target,
-            event.params['client-initiatorname'])
-        gw_client.add_client_auth(
-            target,
-            event.params['client-initiatorname'],
-            event.params['client-username'],
-            event.params['client-password'])
-        gw_client.add_disk_to_client(
-            target,
-            event.params['client-initiatorname'],
-            event.params['pool-name'],
-            event.params['image-name'])
+                gateway_tasks.append(graph.add(
+                    'add_gateway_to_target:{}'.format(gw_unit),
+                    gw_client.add_gateway_to_target,
+                    (target, gw_config['portals'], gw_config['fqdn']),
+                    deps=[target_task],
+                    locks=target_lock))
+        disk_lock = ['disk:{}/{}'.format(pool_name, image_name)]
+        if source:
+            rbd = self.rbd_client()
+            clone_task = graph.add(
+                'clone_image',
+                rbd.clone_image,
+                (
+                    source,
+                    pool_name,
+                    image_name,
+                    event.params.get('image-size')),
+                locks=disk_lock)
+            pool_task = graph.add(
+                'register_disk',
+                gw_client.register_disk,
+                (pool_name, image_name, disk_controls or None),
+                deps=[clone_task],
+                locks=disk_lock)
+            if event.params.get('flatten'):
+                graph.add(
+                    'flatten_image',
+                    rbd.flatten_image,
+                    (pool_name, image_name),
+                    deps=[pool_task],
+                    locks=disk_lock)
+        elif data_pool:
+            create_task = graph.add(
+                'create_image',
+                self.rbd_client().create_image,
+                (
+                    pool_name,
+                    image_name,
+                    event.params['image-size'],
+                    data_pool),
+                locks=disk_lock)
+            pool_task = graph.add(
+                'register_disk',
+                gw_client.register_disk,
+                (pool_name, image_name, disk_controls or None),
+                deps=[create_task],
+                locks=disk_lock)
+        else:
+            pool_args = (pool_name, image_name, event.params['image-size'])
+            if disk_controls:
+                pool_args += (disk_controls,)
+            pool_task = graph.add(
+                'create_pool',
+                gw_client.create_pool,
+                pool_args,
+                locks=disk_lock)
+        if qos:
+            pool_task = graph.add(
+                'set_image_qos',
+                self.rbd_client().set_image_qos,
+                (pool_name, image_name, qos),
+                deps=[pool_task],
+                locks=disk_lock)
+        client_task = graph.add(
+            'add_client_to_target',
+            gw_client.add_client_to_target,
+            (target, initiator),
+            deps=gateway_tasks,
+            locks=target_lock)
+        graph.add(
+            'add_client_auth',
+            gw_client.add_client_auth,
+            (
+                target,
+                initiator,
+                event.params['client-username'],
+                event.params['client-password']),
+            deps=[client_task],
+            locks=target_lock)
+        graph.add(
+            'add_disk_to_client',
+            gw_client.add_disk_to_client,
+            (target, initiator, pool_name, image_name),
+            deps=[client_task, pool_task],
+            locks=target_lock)
+        results = graph.run(
+            workers=self.model.config['provisioning-concurrency'])
+        failed = ['{}: {}'.format(name, result['error'])
+                  for name, result in results.items()
+                  if result['status'] == task_graph.FAILED]
+        if failed:
+            event.fail('; '.join(failed))
+            return
         event.set_results({'iqn': target})
 
+    def _provision(self, event, manifest):
+        """Plan and apply a manifest on behalf of an action.
+
+        :returns: Per operation results, None for a dry run or a manifest
+                  that could not be planned.
+        """
+        gw_client = self.gateway_client()
+        try:
+            gw_client.inventory.refresh()
+            ops = provisioning.plan(
+                manifest,
+                gw_client.inventory.config,
+                self.peers.ready_peer_details)
+        except (provisioning.ManifestError,
+                gwcli_client.GatewayClientError) as exc:
+            event.fail(str(exc))
+            return None
+        if event.params.get('dry-run'):
+            event.set_results({
+                'plan': json.dumps(
+                    [{'operation': op.kind, 'object': op.obj}
+                     for op in ops])})
+            return None
+        results = provisioning.apply(
+            ops,
+            gw_client,
+            workers=self.model.config['provisioning-concurrency'],
+            rbd=self.rbd_client())
+        failed = [r for r in results if r['status'] == 'failed']
+        if failed:
+            event.fail("{} of {} operations failed".format(
+                len(failed),
+                len(results)))
+        return results
+
+    @hook_timings.timed
+    def on_apply_manifest_action(self, event):
+        start = time.monotonic()
+        try:
+            manifest = provisioning.load_manifest(event.params['manifest'])
+        except provisioning.ManifestError as exc:
+            event.fail(str(exc))
+            return
+        for disk in manifest['disks']:
+            if not disk['source']:
+                disk['data_pool'] = disk['data_pool'] or self.ec_data_pool
+        results = self._provision(event, manifest)
+        if results is not None:
+            event.set_results({
+                'results': json.dumps(results),
+                'seconds': round(time.monotonic() - start, 3)})
+
+    @hook_timings.timed
+    def on_export_config_action(self, event):
+        gw_client = self.gateway_client()
+        try:
+            gw_client.inventory.refresh()
+        except gwcli_client.GatewayClientError as exc:
+            event.fail(str(exc))
+            return
+        config = gw_client.inventory.config
+        # QoS limits are image settings rather than gateway configuration,
+        # so they are read from ceph.
+        rbd = self.rbd_client()
+        graph = task_graph.TaskGraph()
+        for disk in config.get('disks', {}):
+            graph.add(
+                disk,
+                rbd.get_image_qos,
+                tuple(disk.split('/', 1)) + (True,))
+        outcome = graph.run(
+            workers=self.model.config['provisioning-concurrency'])
+        failed = sorted(
+            d for d, r in outcome.items() if r['status'] != task_graph.DONE)
+        if failed:
+            event.fail("Unable to read the QoS of {}".format(
+                ', '.join(failed)))
+            return
+        export = provisioning.export_config(
+            config,
+            {d: r['result'] for d, r in outcome.items()})
+        content = gzip.compress(json.dumps(
+            export,
+            sort_keys=True,
+            separators=(',', ':')).encode())
+        default = self.CONFIG_EXPORT_DIR / 'gateway-config-{}.json.gz'.format(
+            config.get('epoch', 0))
+        path = Path(event.params.get('path') or default)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # The export holds the CHAP credentials.
+        self._write_atomic(path, content, 0o600)
+        logging.info("Exported gateway configuration to {}".format(path))
+        unexported = provisioning.unexported_settings(config)
+        if unexported:
+            logging.warning(
+                "Export {} does not include: {}".format(
+                    path,
+                    ', '.join(unexported)))
+        event.set_results({
+            'path': str(path),
+            'not-exported': json.dumps(unexported),
+            'sha256': hashlib.sha256(content).hexdigest(),
+            'disks': len(export['disks']),
+            'targets': len(export['targets']),
+            'luns': sum(
+                len(h['disks'])
+                for t in export['targets'] for h in t['hosts'])})
+
+    @hook_timings.timed
+    def on_import_config_action(self, event):
+        start = time.monotonic()
+        try:
+            content = Path(event.params['path']).read_bytes()
+            if content[:2] == self.GZIP_MAGIC:
+                content = gzip.decompress(content)
+            manifest = provisioning.load_export(
+                content.decode(),
+                self.peers.ready_peer_details)
+        except (OSError, EOFError, zlib.error, ValueError,
+                provisioning.ManifestError) as exc:
+            # A truncated or corrupt file, or one that is not UTF-8.
+            event.fail("Unable to read {}: {}".format(
+                event.params['path'],
+                exc))
+            return
+        results = self._provision(event, manifest)
+        if results is None:
+            return
+        # A restore can run to many thousands of operations, only those
+        # that did not succeed are listed.
+        counts = {}
+        for result in results:
+            counts[result['status']] = counts.get(result['status'], 0) + 1
+        event.set_results({
+            'counts': json.dumps(counts, sort_keys=True),
+            'problems': json.dumps(
+                [r for r in results if r['status'] != 'done']),
+            'seconds': round(time.monotonic() - start, 3)})
+
+    def _read_metrics(self, address):
+        """Metrics of a gateway, as served by its metrics exporter."""
+        conn = http.client.HTTPConnection(
+            address,
+            self.model.config['metrics-port'],
+            timeout=10)
+        try:
+            conn.request('GET', '/metrics')
+            response = conn.getresponse()
+            body = response.read().decode()
+        finally:
+            conn.close()
+        if response.status != 200:
+            raise http.client.HTTPException(
+                "GET /metrics returned {}".format(response.status))
+        return body
+
+    def read_lun_counters(self, address):
+        """LUN counters of a gateway, read from its metrics exporter."""
+        return lio_exporter.parse_counters(self._read_metrics(address))
+
+    def read_lun_sizes(self, address):
+        """Sizes of the LUNs a gateway exports, from its metrics exporter."""
+        return lio_exporter.parse_sizes(self._read_metrics(address))
+
+    def sample_lun_rates(self, gateways, interval):
+        """Per disk I/O rates of each gateway over interval seconds.
+
+        :param gateways: {gateway name: address}
+        :returns: ({gateway name: {disk: {'iops': .., 'mbps': ..}}},
+                   names of the gateways that could not be read)
+        """
+        samples = {}
+        failed = set()
+        for sample in range(2):
+            if sample:
+                time.sleep(interval)
+            for name, address in sorted(gateways.items()):
+                if name in failed:
+                    continue
+                try:
+                    counters = self.read_lun_counters(address)
+                except (OSError, http.client.HTTPException) as exc:
+                    logging.warning(
+                        "Unable to read LUN counters of {}: {}".format(
+                            name,
+                            exc))
+                    failed.add(name)
+                    continue
+                samples.setdefault(name, []).append(
+                    (time.monotonic(), counters))
+        rates = {}
+        for name in set(samples) - failed:
+            (start, old), (end, new) = samples[name]
+            rates[name] = lio_stats.rates(old, new, end - start)
+        return rates, sorted(failed)
+
+    def _resize_disk(self, client, rbd, pool_name, image_name, image_size):
+        """Grow a disk to image_size unless it already has that size."""
+        size = gwcli_client.size_bytes(image_size)
+        current = rbd.image_size(pool_name, image_name)
+        if current == size:
+            logging.info("{}/{} is already {}".format(
+                pool_name,
+                image_name,
+                image_size))
+            return
+        if current > size:
+            raise RuntimeError(
+                "{}/{} is {} bytes, disks cannot be shrunk".format(
+                    pool_name,
+                    image_name,
+                    current))
+        client.resize_disk(pool_name, image_name, image_size)
+
+    def _check_disk_size(self, exported, disk, size):
+        """Problem with the size a gateway exports a disk at, if any.
+
+        The gateway API only has the disk's configuration, so the size of
+        the LUN is read from the gateway's metrics exporter.
+
+        :param exported: Outcome of reading the gateway's LUN sizes.
+        :returns: Description of the problem, None if the gateway exports
+                  the disk at size bytes or more.
+        """
+        if exported['status'] != task_graph.DONE:
+            return exported.get('error', exported['status'])
+        current = exported['result'].get(disk)
+        if current is None:
+            return "does not export {}".format(disk)
+        if current < size:
+            return "exports {} at {} bytes".format(disk, current)
+        return None
+
+    @hook_timings.timed
+    def on_resize_disks_action(self, event):
+        start = time.monotonic()
+        try:
+            size = gwcli_client.size_bytes(event.params['size'])
+        except ValueError as exc:
+            event.fail(str(exc))
+            return
+        gw_client = self.gateway_client()
+        try:
+            gw_client.inventory.refresh()
+        except gwcli_client.GatewayClientError as exc:
+            event.fail(str(exc))
+            return
+        patterns = event.params['disks'].split()
+        disks = sorted(
+            d for d in gw_client.inventory.config.get('disks', {})
+            if any(fnmatch.fnmatchcase(d, p) for p in patterns))
+        if not disks:
+            event.fail("No disks match {}".format(' '.join(patterns)))
+            return
+        # Check the size every gateway exports once the disks are resized.
+        gateways = {
+            unit: details['ip']
+            for unit, details in self.peers.ready_peer_details.items()}
+        rbd = self.rbd_client()
+        graph = task_graph.TaskGraph()
+        for disk in disks:
+            pool_name, image_name = disk.split('/', 1)
+            graph.add(
+                'resize:{}'.format(disk),
+                self._resize_disk,
+                (gw_client, rbd, pool_name, image_name,
+                 event.params['size']),
+                locks=['disk:{}'.format(disk)])
+        outcome = graph.run(
+            workers=self.model.config['provisioning-concurrency'])
+        # Read each gateway's LUN sizes once, after every resize, rather
+        # than once per disk.
+        checks = task_graph.TaskGraph()
+        for unit, address in sorted(gateways.items()):
+            checks.add(unit, self.read_lun_sizes, (address,))
+        exported = checks.run(
+            workers=self.model.config['provisioning-concurrency'])
+        results = []
+        for disk in disks:
+            result = {'disk': disk}
+            result.update(
+                (k, v) for k, v in outcome['resize:{}'.format(disk)].items()
+                if k != 'result')
+            problems = []
+            for unit, read in exported.items():
+                problem = self._check_disk_size(read, disk, size)
+                if problem:
+                    problems.append('{}: {}'.format(unit, problem))
+            if result['status'] == task_graph.DONE and problems:
+                result['status'] = task_graph.FAILED
+                result['error'] = '; '.join(problems)
+            results.append(result)
+        event.set_results({
+            'results': json.dumps(results),
+            'check-seconds': max(
+                [c.get('seconds', 0) for c in exported.values()] or [0]),
+            'seconds': round(time.monotonic() - start, 3)})
+        failed = [r for r in results if r['status'] != task_graph.DONE]
+        if failed:
+            event.fail("{} of {} disks failed to resize".format(
+                len(failed),
+                len(results)))
+
+    def _select_disks(self, event, gw_client):
+        """Exported disks matching the disks and clients action params.
+
+        :returns: Sorted disk ids, None if the action failed.
+        """
+        try:
+            gw_client.inventory.refresh()
+        except gwcli_client.GatewayClientError as exc:
+            event.fail(str(exc))
+            return None
+        config = gw_client.inventory.config
+        patterns = (event.params.get('disks') or '').split()
+        disks = set(
+            d for d in config.get('disks', {})
+            if any(fnmatch.fnmatchcase(d, p) for p in patterns))
+        for initiator in (event.params.get('clients') or '').split():
+            for iqn in config.get('targets', {}):
+                disks.update(
+                    gw_client.inventory.client_disks(iqn, initiator))
+        if not disks:
+            event.fail("No disks match the disks or clients given")
+            return None
+        return sorted(disks)
+
+    @hook_timings.timed
+    def on_set_qos_action(self, event):
+        start = time.monotonic()
+        try:
+            qos = self._action_qos(event.params)
+        except ValueError as exc:
+            event.fail(str(exc))
+            return
+        if not qos:
+            event.fail("No QoS settings given")
+            return
+        disks = self._select_disks(event, self.gateway_client())
+        if disks is None:
+            return
+        rbd = self.rbd_client()
+        graph = task_graph.TaskGraph()
+        for disk in disks:
+            pool_name, image_name = disk.split('/', 1)
+            graph.add(
+                'set:{}'.format(disk),
+                rbd.set_image_qos,
+                (pool_name, image_name, qos))
+            graph.add(
+                'get:{}'.format(disk),
+                rbd.get_image_qos,
+                (pool_name, image_name),
+                deps=['set:{}'.format(disk)])
+        outcome = graph.run(
+            workers=self.model.config['provisioning-concurrency'])
+        results = []
+        for disk in disks:
+            result = {'disk': disk}
+            result.update(
+                (k, v) for k, v in outcome['set:{}'.format(disk)].items()
+                if k != 'result')
+            read_back = outcome['get:{}'.format(disk)]
+            if read_back['status'] == task_graph.DONE:
+                result['qos'] = read_back['result']
+            results.append(result)
+        event.set_results({
+            'results': json.dumps(results),
+            'seconds': round(time.monotonic() - start, 3)})
+        failed = [r for r in results if r['status'] != task_graph.DONE]
+        if failed:
+            event.fail("{} of {} disks failed to update".format(
+                len(failed),
+                len(results)))
+
+    @hook_timings.timed
+    def on_get_qos_action(self, event):
+        disks = self._select_disks(event, self.gateway_client())
+        if disks is None:
+            return
+        rbd = self.rbd_client()
+        graph = task_graph.TaskGraph()
+        for disk in disks:
+            graph.add(disk, rbd.get_image_qos, tuple(disk.split('/', 1)))
+        outcome = graph.run(
+            workers=self.model.config['provisioning-concurrency'])
+        failed = {
+            d: r.get('error', r['status']) for d, r in outcome.items()
+            if r['status'] != task_graph.DONE}
+        event.set_results({
+            'qos': json.dumps(
+                {d: r['result'] for d, r in outcome.items()
+                 if d not in failed},
+                sort_keys=True)})
+        if failed:
+            event.fail("Unable to read the QoS of {}".format(
+                ', '.join(sorted(failed))))
+
+    @hook_timings.timed
+    def on_rebalance_action(self, event):
+        metric = event.params.get('metric', 'iops')
+        gw_client = self.gateway_client()
+        try:
+            gw_client.inventory.refresh()
+        except gwcli_client.GatewayClientError as exc:
+            event.fail(str(exc))
+            return
+        config = gw_client.inventory.config
+        ready = self.peers.ready_peer_details.values()
+        rates, failed = self.sample_lun_rates(
+            {g['fqdn']: g['ip'] for g in ready},
+            event.params.get('interval', 10))
+        if failed:
+            event.fail("Unable to read the LUN statistics of {}".format(
+                ', '.join(failed)))
+            return
+        gateways = sorted(rates)
+        # I/O for a disk may arrive through any gateway, so its load is
+        # the sum over all of them.
+        weights = {}
+        for stats in rates.values():
+            for disk, disk_rates in stats.items():
+                weights[disk] = weights.get(disk, 0) + disk_rates[metric]
+        current = lun_placement.current_owners(config)
+        placement = lun_placement.rebalance(
+            lun_placement.eligible_owners(config, gateways),
+            current,
+            weights)
+        moves = lun_placement.moves(current, placement)
+        event.set_results({
+            'moves': json.dumps(
+                [{'disk': disk, 'from': old, 'to': new}
+                 for disk, (old, new) in moves.items()]),
+            'load-before': json.dumps(
+                lun_placement.loads(current, weights, gateways),
+                sort_keys=True),
+            'load-after': json.dumps(
+                lun_placement.loads(placement, weights, gateways),
+                sort_keys=True)})
+
+    def on_hook_timings_action(self, event):
+        self.timings.flush()
+        event.set_results({
+            'timings': json.dumps(
+                self.timings.report(event.params.get('prefix', '')),
+                sort_keys=True)})
+
+    def on_pre_commit(self, event):
+        self.reconcile()
+        self.timings.flush()
+
 
 @ops_openstack.core.charm_class
 class CephISCSIGatewayCharmJewel(CephISCSIGatewayCharmBase):
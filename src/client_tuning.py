@@ -0,0 +1,115 @@
+"""librados/librbd tuning for the gateway's Ceph client.
+
+Each profile maps ceph.conf options to a callable that sizes the value
+from the unit's CPU count and memory. tcmu-runner opens every image with
+its own client instance, so the per client budgets are kept well within
+the unit's resources.
+"""
+
+import os
+from collections import OrderedDict
+
+import yaml
+
+MiB = 1024 * 1024
+GiB = 1024 * MiB
+
+
+class TuningError(Exception):
+    """The profile or overrides are not valid."""
+
+
+def _clamp(value, low, high):
+    return int(min(max(value, low), high))
+
+
+# Dirty data held in one gateway's cache would be lost, or served stale
+# by another gateway, when an initiator fails over, so the profiles that
+# enable the rbd cache only use it for reads (max dirty of 0).
+PROFILES = {
+    'none': OrderedDict(),
+    'latency': OrderedDict([
+        ('rbd cache', lambda cpus, mem: False),
+        ('ms async op threads', lambda cpus, mem: _clamp(cpus // 4, 3, 8)),
+    ]),
+    'balanced': OrderedDict([
+        ('rbd cache', lambda cpus, mem: True),
+        ('rbd cache size', lambda cpus, mem: _clamp(
+            mem // 512, 32 * MiB, 128 * MiB)),
+        ('rbd cache max dirty', lambda cpus, mem: 0),
+        ('objecter inflight ops', lambda cpus, mem: 2048),
+        ('objecter inflight op bytes', lambda cpus, mem: _clamp(
+            mem // 64, 100 * MiB, 512 * MiB)),
+        ('ms async op threads', lambda cpus, mem: _clamp(cpus // 4, 3, 8)),
+    ]),
+    'throughput': OrderedDict([
+        ('rbd cache', lambda cpus, mem: True),
+        ('rbd cache size', lambda cpus, mem: _clamp(
+            mem // 256, 32 * MiB, 256 * MiB)),
+        ('rbd cache max dirty', lambda cpus, mem: 0),
+        ('rbd readahead max bytes', lambda cpus, mem: 4 * MiB),
+        ('objecter inflight ops', lambda cpus, mem: _clamp(
+            1024 * (cpus // 4), 2048, 8192)),
+        ('objecter inflight op bytes', lambda cpus, mem: _clamp(
+            mem // 32, 100 * MiB, GiB)),
+        ('ms async op threads', lambda cpus, mem: _clamp(
+            cpus // 2, 3, 12)),
+    ]),
+}
+
+
+def host_resources():
+    """Return the unit's (CPU count, memory in bytes)."""
+    cpus = os.cpu_count() or 1
+    memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    return cpus, memory
+
+
+def _format(value):
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return str(value)
+
+
+def parse_overrides(text):
+    """Parse a YAML or JSON mapping of ceph.conf option to value.
+
+    Option names may use underscores or spaces.
+
+    :raises: TuningError
+    """
+    try:
+        overrides = yaml.safe_load(text or '') or {}
+    except yaml.YAMLError as exc:
+        raise TuningError("Unable to parse overrides: {}".format(exc))
+    if not isinstance(overrides, dict):
+        raise TuningError("Overrides must be a mapping")
+    parsed = OrderedDict()
+    for option, value in sorted(overrides.items()):
+        if isinstance(value, (dict, list)) or value is None:
+            raise TuningError("Invalid value for {}".format(option))
+        parsed[str(option).replace('_', ' ').strip()] = _format(value)
+    return parsed
+
+
+def client_settings(profile, overrides=None, cpus=None, memory=None):
+    """Settings for the [client.ceph-iscsi] section.
+
+    :param profile: Name of one of PROFILES.
+    :param overrides: YAML or JSON mapping applied over the profile.
+    :param cpus: CPU count, defaults to the unit's.
+    :param memory: Memory in bytes, defaults to the unit's.
+    :returns: OrderedDict of option to value string.
+    :raises: TuningError
+    """
+    if profile not in PROFILES:
+        raise TuningError("Unknown profile {}, expected one of {}".format(
+            profile,
+            ', '.join(sorted(PROFILES))))
+    if cpus is None or memory is None:
+        cpus, memory = host_resources()
+    settings = OrderedDict(
+        (option, _format(size(cpus, memory)))
+        for option, size in PROFILES[profile].items())
+    settings.update(parse_overrides(overrides))
+    return settings
@@ -0,0 +1,163 @@
+"""systemd scheduling and resource tuning for the gateway daemons.
+
+The settings are written as a drop-in for tcmu-runner, rbd-target-gw and
+rbd-target-api. In auto mode the daemons are kept on the NUMA node of the
+NIC serving the iSCSI portals, so that the TCMU I/O threads run, and
+allocate their buffers, next to the network device instead of bouncing
+between sockets.
+"""
+
+import logging
+import re
+from collections import OrderedDict
+from pathlib import Path
+
+SYSFS = Path('/sys')
+
+AUTO = 'auto'
+NUMA_POLICIES = ('default', 'preferred', 'bind', 'interleave', 'local')
+IO_SCHEDULING_CLASSES = ('realtime', 'best-effort', 'idle')
+
+# CPU or NUMA node lists as systemd and sysfs write them, eg 0-7,16-23
+_ID_LIST = re.compile(r'^\d+(-\d+)?([ ,]+\d+(-\d+)?)*$')
+_MEMORY = re.compile(r'^(\d+[KMGT]?|\d+%|infinity)$')
+_TASKS = re.compile(r'^(\d+%?|infinity)$')
+
+
+class TuningError(Exception):
+    """The tuning options are not valid."""
+
+
+def interface_numa_node(name, sysfs=SYSFS):
+    """NUMA node of a network interface, None if unknown.
+
+    Bonds, bridges and VLANs have no device of their own, so the node of
+    the first of their lower interfaces with one is used.
+    """
+    net = sysfs / 'class' / 'net'
+    queue = [name]
+    seen = set()
+    while queue:
+        ifname = queue.pop(0)
+        if ifname in seen:
+            continue
+        seen.add(ifname)
+        try:
+            node = int((net / ifname / 'device' / 'numa_node').read_text())
+        except (OSError, ValueError):
+            node = -1
+        if node >= 0:
+            return node
+        queue.extend(sorted(
+            p.name[len('lower_'):] for p in (net / ifname).glob('lower_*')))
+    return None
+
+
+def node_cpus(node, sysfs=SYSFS):
+    """CPUs of a NUMA node as a list, eg '0-7,16-23', None if unknown."""
+    path = sysfs / 'devices' / 'system' / 'node' / 'node{}'.format(node)
+    try:
+        return (path / 'cpulist').read_text().strip() or None
+    except OSError:
+        return None
+
+
+def _int(config, option, low, high):
+    value = config.get(option)
+    if value is None or value == '':
+        return None
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        raise TuningError("{} must be a number".format(option))
+    if not low <= value <= high:
+        raise TuningError("{} must be between {} and {}".format(
+            option,
+            low,
+            high))
+    return value
+
+
+def _match(config, option, pattern, auto=False):
+    value = str(config.get(option) or '').strip()
+    if value and not (auto and value == AUTO) and not pattern.match(value):
+        raise TuningError("Invalid {} '{}'".format(option, value))
+    return value
+
+
+def _choice(config, option, choices):
+    value = config.get(option) or ''
+    if value and value not in choices:
+        raise TuningError("{} must be one of {}".format(
+            option,
+            ', '.join(choices)))
+    return value
+
+
+def parse_options(config):
+    """Validate the daemon-* options without looking at the host.
+
+    :returns: Tuple of the parsed options.
+    :raises: TuningError
+    """
+    return (
+        _match(config, 'daemon-cpu-affinity', _ID_LIST, auto=True),
+        _choice(config, 'daemon-numa-policy', NUMA_POLICIES),
+        _match(config, 'daemon-numa-mask', _ID_LIST, auto=True),
+        _int(config, 'daemon-nice', -20, 19),
+        _choice(
+            config,
+            'daemon-io-scheduling-class',
+            IO_SCHEDULING_CLASSES),
+        _int(config, 'daemon-io-scheduling-priority', 0, 7),
+        _match(config, 'daemon-memory-max', _MEMORY),
+        _match(config, 'daemon-tasks-max', _TASKS))
+
+
+def service_settings(config, numa_node=lambda: None, sysfs=SYSFS):
+    """[Service] settings for the gateway daemons' drop-in.
+
+    :param config: Charm config with the daemon-* options.
+    :param numa_node: Callable returning the NUMA node of the portal NIC,
+                      only called in auto mode.
+    :returns: OrderedDict of setting to value, empty if nothing is tuned.
+    :raises: TuningError
+    """
+    (affinity, policy, mask, nice, io_class, io_priority, memory_max,
+     tasks_max) = parse_options(config)
+
+    # A policy other than default or local needs a node mask, which
+    # defaults to the portal NIC's node.
+    needs_mask = policy not in ('', 'default', 'local')
+    if needs_mask and not mask:
+        mask = AUTO
+    node = None
+    if AUTO in (affinity, mask):
+        node = numa_node()
+        if node is None:
+            logging.warning(
+                "NUMA node of the iSCSI network is unknown, not pinning "
+                "the gateway daemons")
+    if affinity == AUTO:
+        affinity = node_cpus(node, sysfs) if node is not None else None
+    if mask == AUTO:
+        mask = str(node) if node is not None else None
+
+    settings = OrderedDict()
+    if affinity:
+        settings['CPUAffinity'] = affinity
+    if policy and (mask or not needs_mask):
+        settings['NUMAPolicy'] = policy
+        if needs_mask:
+            settings['NUMAMask'] = mask
+    if nice is not None:
+        settings['Nice'] = str(nice)
+    if io_class:
+        settings['IOSchedulingClass'] = io_class
+    if io_priority is not None:
+        settings['IOSchedulingPriority'] = str(io_priority)
+    if memory_max:
+        settings['MemoryMax'] = memory_max
+    if tasks_max:
+        settings['TasksMax'] = tasks_max
+    return settings
@@ -0,0 +1,144 @@
+"""Indexed view of the objects defined on the gateways."""
+
+import threading
+
+
+class GatewayInventory():
+    """Index of the gateway configuration object.
+
+    The configuration is fetched at most once until refresh() is called
+    and is indexed by target IQN, initiator and pool/image. Successful
+    changes made through the GatewayClient are recorded in the index as
+    they happen. refresh() always re-fetches and reindexes the whole
+    configuration: the gateway API has no cheaper way to read the config
+    object's epoch, and changes made through other gateways or by gwcli
+    are only seen that way.
+
+    :param fetch: Callable returning the configuration from GET /api/config.
+    """
+
+    def __init__(self, fetch):
+        self.fetch = fetch
+        self.config = None
+        self._lock = threading.RLock()
+
+    def _index(self, config):
+        self.config = config
+        self.disks = set(config.get('disks', {}))
+        self.targets = set()
+        self.portals = set()
+        self.target_luns = set()
+        self.clients = {}
+        self.client_luns = set()
+        for iqn, target in config.get('targets', {}).items():
+            self.targets.add(iqn)
+            for gateway in target.get('portals', {}):
+                self.portals.add((iqn, gateway))
+            for disk in target.get('disks', {}):
+                self.target_luns.add((iqn, disk))
+            for initiator, client in target.get('clients', {}).items():
+                auth = client.get('auth', {})
+                self.clients[(iqn, initiator)] = (
+                    auth.get('username'),
+                    auth.get('password'),
+                    auth.get('mutual_username') or '',
+                    auth.get('mutual_password') or '')
+                for disk in client.get('luns', {}):
+                    self.client_luns.add((iqn, initiator, disk))
+
+    def load(self):
+        """Fetch and index the configuration unless already done."""
+        with self._lock:
+            if self.config is None:
+                self._index(self.fetch())
+
+    def refresh(self):
+        """Re-fetch and reindex the configuration."""
+        with self._lock:
+            self._index(self.fetch())
+
+    def _record(self, name, key):
+        with self._lock:
+            if self.config is None:
+                # Nothing indexed yet, the next load will include it.
+                return
+            index = getattr(self, name)
+            if isinstance(index, dict):
+                index[key[:2]] = key[2:]
+            else:
+                index.add(key)
+
+    def _has(self, name, key):
+        self.load()
+        with self._lock:
+            return key in getattr(self, name)
+
+    def has_target(self, iqn):
+        return self._has('targets', iqn)
+
+    def has_portal(self, iqn, gateway_fqdn):
+        return self._has('portals', (iqn, gateway_fqdn))
+
+    def has_disk(self, disk):
+        return self._has('disks', disk)
+
+    def has_target_lun(self, iqn, disk):
+        return self._has('target_luns', (iqn, disk))
+
+    def has_client(self, iqn, initiatorname):
+        return self._has('clients', (iqn, initiatorname))
+
+    def has_client_auth(self, iqn, initiatorname, username, password,
+                        mutual_username='', mutual_password=''):
+        self.load()
+        with self._lock:
+            return self.clients.get((iqn, initiatorname)) == (
+                username, password, mutual_username, mutual_password)
+
+    def has_client_lun(self, iqn, initiatorname, disk):
+        return self._has('client_luns', (iqn, initiatorname, disk))
+
+    def client_disks(self, iqn, initiatorname):
+        """Disks mapped to an initiator on a target."""
+        self.load()
+        with self._lock:
+            return sorted(
+                d for i, n, d in self.client_luns
+                if (i, n) == (iqn, initiatorname))
+
+    def disk_clients(self, disk):
+        """(iqn, initiator) pairs a disk is mapped to."""
+        self.load()
+        with self._lock:
+            return sorted(
+                (i, n) for i, n, d in self.client_luns if d == disk)
+
+    def add_target(self, iqn):
+        self._record('targets', iqn)
+
+    def add_portal(self, iqn, gateway_fqdn):
+        self._record('portals', (iqn, gateway_fqdn))
+
+    def add_disk(self, disk):
+        self._record('disks', disk)
+
+    def add_target_lun(self, iqn, disk):
+        self._record('target_luns', (iqn, disk))
+
+    def add_client(self, iqn, initiatorname):
+        with self._lock:
+            if self.config is None or (iqn, initiatorname) in self.clients:
+                return
+            self._record(
+                'clients',
+                (iqn, initiatorname, None, None, '', ''))
+
+    def add_client_auth(self, iqn, initiatorname, username, password,
+                        mutual_username='', mutual_password=''):
+        self._record(
+            'clients',
+            (iqn, initiatorname, username, password, mutual_username,
+             mutual_password))
+
+    def add_client_lun(self, iqn, initiatorname, disk):
+        self._record('client_luns', (iqn, initiatorname, disk))
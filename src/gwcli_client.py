@@ -1,46 +1,363 @@
+import base64
+import http.client
+import json
 import logging
-import subprocess
+import re
+import ssl
+import threading
+import time
+import urllib.parse
+
+import gateway_inventory
 
 logger = logging.getLogger()
 
+# Per disk LIO/TCMU settings rbd-target-api accepts as disk controls.
+DISK_CONTROLS = (
+    'hw_max_sectors',
+    'max_data_area_mb',
+    'osd_op_timeout',
+    'qfull_timeout')
+
+# Per target iSCSI settings rbd-target-api accepts as target controls.
+TARGET_CONTROLS = (
+    'cmdsn_depth',
+    'dataout_timeout',
+    'first_burst_length',
+    'immediate_data',
+    'initial_r2t',
+    'max_burst_length',
+    'max_outstanding_r2t',
+    'max_recv_data_segment_length',
+    'max_xmit_data_segment_length',
+    'nopin_response_timeout',
+    'nopin_timeout')
+
+
+SIZE_UNITS = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30,
+              'T': 1 << 40, 'P': 1 << 50}
+
+
+def size_bytes(size):
+    """Convert a disk size as the API takes it, eg '20G', to bytes."""
+    match = re.match(r'^\s*(\d+)\s*([KMGTP]?)B?\s*$', str(size).upper())
+    if not match:
+        raise ValueError("'{}' is not a size, eg 20G".format(size))
+    return int(match.group(1)) * SIZE_UNITS[match.group(2)]
+
+
+class GatewayClientError(Exception):
+    """An rbd-target-api request failed.
+
+    status is None if the request did not get a response, eg because
+    the API was unreachable or the TLS handshake failed.
+    """
+
+    def __init__(self, method, path, status, message):
+        self.method = method
+        self.path = path
+        self.status = status
+        self.message = message
+        super().__init__(
+            "{} {} failed ({}): {}".format(method, path, status, message))
+
+
+class ConnectionPool():
+    """Keep-alive HTTP(S) connections to rbd-target-api endpoints.
+
+    Idle connections are kept per (host, port) and handed out again so
+    that consecutive requests reuse the same TCP connection and TLS
+    session. The pool is safe to share between threads; each thread
+    checks a connection out for the duration of one request.
+    """
+
+    def __init__(self, secure=False, timeout=60, maxsize=8,
+                 ssl_context=None):
+        self.secure = secure
+        self.timeout = timeout
+        self.maxsize = maxsize
+        if secure and not ssl_context:
+            ssl_context = ssl.create_default_context()
+        self.ssl_context = ssl_context
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _new_connection(self, host, port):
+        if self.secure:
+            return http.client.HTTPSConnection(
+                host,
+                port,
+                timeout=self.timeout,
+                context=self.ssl_context)
+        return http.client.HTTPConnection(host, port, timeout=self.timeout)
+
+    def _get(self, host, port):
+        with self._lock:
+            idle = self._idle.get((host, port))
+            if idle:
+                return idle.pop(), True
+        return self._new_connection(host, port), False
+
+    def _put(self, host, port, conn):
+        with self._lock:
+            idle = self._idle.setdefault((host, port), [])
+            if len(idle) < self.maxsize:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def request(self, host, port, method, path, body=None, headers=None):
+        """Perform a request and return (status, body bytes).
+
+        A request on a reused connection that the server has since
+        closed is retried once on a fresh connection.
+        """
+        conn, reused = self._get(host, port)
+        while True:
+            try:
+                conn.request(method, path, body=body, headers=headers or {})
+                response = conn.getresponse()
+                data = response.read()
+            except (http.client.RemoteDisconnected,
+                    http.client.CannotSendRequest,
+                    ConnectionResetError,
+                    BrokenPipeError):
+                conn.close()
+                if not reused:
+                    raise
+                conn, reused = self._new_connection(host, port), False
+                continue
+            except Exception:
+                conn.close()
+                raise
+            break
+        if response.will_close:
+            conn.close()
+        else:
+            self._put(host, port, conn)
+        return response.status, data
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
 
 class GatewayClient():
+    """Client for the rbd-target-api REST endpoint.
+
+    :param host: Address of the gateway API to talk to.
+    :param port: api_port from iscsi-gateway.cfg.
+    :param user: api_user from iscsi-gateway.cfg.
+    :param password: api_password from iscsi-gateway.cfg.
+    :param secure: api_secure from iscsi-gateway.cfg.
+    :param pool: ConnectionPool to share between clients.
+    :param use_inventory: Skip changes that the gateway configuration
+                          shows are already in place.
+    :param timer: Called with (name, seconds) after each request, the
+                  name being the method and the first two components of
+                  the path, eg 'PUT /api/disk'.
+    """
+
+    def __init__(self, host='localhost', port=5000, user='admin',
+                 password=None, secure=False, pool=None,
+                 use_inventory=False, timer=None):
+        self.host = host
+        self.port = port
+        self.timer = timer
+        self.pool = pool or ConnectionPool(secure=secure)
+        credentials = '{}:{}'.format(user, password or '').encode()
+        self.headers = {
+            'Authorization': 'Basic {}'.format(
+                base64.b64encode(credentials).decode())}
+        self.inventory = None
+        if use_inventory:
+            self.inventory = gateway_inventory.GatewayInventory(
+                lambda: self.get_config(decrypt_passwords=True))
+
+    def request(self, method, path, params=None):
+        """Call the API and return its decoded JSON response.
+
+        :raises: GatewayClientError on an error response or when the
+                 request could not be made at all.
+        """
+        headers = dict(self.headers)
+        body = None
+        if params:
+            body = urllib.parse.urlencode(params)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        logging.info("{} {}".format(method, path))
+        start = time.monotonic()
+        try:
+            status, data = self.pool.request(
+                self.host,
+                self.port,
+                method,
+                path,
+                body=body,
+                headers=headers)
+        except (OSError, http.client.HTTPException) as exc:
+            raise GatewayClientError(method, path, None, str(exc)) from exc
+        finally:
+            if self.timer:
+                self.timer(
+                    '{} {}'.format(
+                        method,
+                        '/'.join(path.split('?')[0].split('/')[:3])),
+                    time.monotonic() - start)
+        try:
+            result = json.loads(data.decode()) if data else {}
+        except ValueError:
+            result = {'message': data.decode(errors='replace')}
+        if status >= 400:
+            message = result.get('message') if isinstance(
+                result, dict) else result
+            raise GatewayClientError(method, path, status, message)
+        return result
+
+    def _change(self, kind, key, method, path, params=None):
+        """Make a change unless the inventory shows it is already done.
+
+        :param kind: Inventory object type, eg 'target' for has_target()
+                     and add_target().
+        :param key: Arguments identifying the object in the inventory.
+        """
+        if self.inventory:
+            if getattr(self.inventory, 'has_' + kind)(*key):
+                logging.info("Skipping {} {}, already done".format(
+                    method,
+                    path))
+                return {}
+        result = self.request(method, path, params)
+        if self.inventory:
+            getattr(self.inventory, 'add_' + kind)(*key)
+        return result
 
-    def run(self, path, cmd):
-        _cmd = ['gwcli', path]
-        _cmd.extend(cmd.split())
-        logging.info(_cmd)
-        subprocess.check_call(_cmd)
+    def get_config(self, decrypt_passwords=False):
+        path = '/api/config'
+        if decrypt_passwords:
+            path += '?decrypt_passwords=true'
+        return self.request('GET', path)
 
     def create_target(self, iqn):
-        self.run(
-            "/iscsi-targets/",
-            "create {}".format(iqn))
+        return self._change(
+            'target',
+            (iqn,),
+            'PUT',
+            '/api/target/{}'.format(iqn))
 
     def add_gateway_to_target(self, iqn, gateway_ip, gateway_fqdn):
-        self.run(
-            "/iscsi-targets/{}/gateways/".format(iqn),
-            "create {} {}".format(gateway_fqdn, gateway_ip))
-
-    def create_pool(self, pool_name, image_name, image_size):
-        self.run(
-            "/disks",
-            "create pool={} image={} size={}".format(
-                pool_name,
-                image_name,
-                image_size))
+        """Add a gateway's portals to a target.
+
+        :param gateway_ip: Portal address, or a list of them to serve the
+                           target on several networks.
+        """
+        if not isinstance(gateway_ip, str):
+            gateway_ip = ','.join(gateway_ip)
+        return self._change(
+            'portal',
+            (iqn, gateway_fqdn),
+            'PUT',
+            '/api/gateway/{}/{}'.format(iqn, gateway_fqdn),
+            {'ip_address': gateway_ip})
+
+    def reconfigure_target(self, iqn, controls):
+        return self.request(
+            'PUT',
+            '/api/target/{}'.format(iqn),
+            {
+                'mode': 'reconfigure',
+                'controls': json.dumps(controls)})
+
+    def create_pool(self, pool_name, image_name, image_size, controls=None):
+        params = {
+            'mode': 'create',
+            'size': image_size,
+            'create_image': 'true'}
+        if controls:
+            params['controls'] = json.dumps(controls)
+        return self._change(
+            'disk',
+            ('{}/{}'.format(pool_name, image_name),),
+            'PUT',
+            '/api/disk/{}/{}'.format(pool_name, image_name),
+            params)
+
+    def register_disk(self, pool_name, image_name, controls=None):
+        """Export an existing image, eg a clone, as a disk."""
+        params = {
+            'mode': 'create',
+            'create_image': 'false'}
+        if controls:
+            params['controls'] = json.dumps(controls)
+        return self._change(
+            'disk',
+            ('{}/{}'.format(pool_name, image_name),),
+            'PUT',
+            '/api/disk/{}/{}'.format(pool_name, image_name),
+            params)
+
+    def resize_disk(self, pool_name, image_name, image_size):
+        """Grow the image and the LUN exported by every gateway."""
+        return self.request(
+            'PUT',
+            '/api/disk/{}/{}'.format(pool_name, image_name),
+            {
+                'mode': 'resize',
+                'size': image_size})
+
+    def reconfigure_disk(self, pool_name, image_name, controls):
+        return self.request(
+            'PUT',
+            '/api/disk/{}/{}'.format(pool_name, image_name),
+            {
+                'mode': 'reconfigure',
+                'controls': json.dumps(controls)})
 
     def add_client_to_target(self, iqn, initiatorname):
-        self.run(
-            "/iscsi-targets/{}/hosts/".format(iqn),
-            "create {}".format(initiatorname))
+        return self._change(
+            'client',
+            (iqn, initiatorname),
+            'PUT',
+            '/api/client/{}/{}'.format(iqn, initiatorname))
+
+    def add_client_auth(self, iqn, initiatorname, username, password,
+                        mutual_username='', mutual_password=''):
+        return self._change(
+            'client_auth',
+            (iqn, initiatorname, username, password, mutual_username,
+             mutual_password),
+            'PUT',
+            '/api/clientauth/{}/{}'.format(iqn, initiatorname),
+            {
+                'username': username,
+                'password': password,
+                'mutual_username': mutual_username,
+                'mutual_password': mutual_password})
 
-    def add_client_auth(self, iqn, initiatorname, username, password):
-        self.run(
-            "/iscsi-targets/{}/hosts/{}".format(iqn, initiatorname),
-            "auth username={} password={}".format(username, password))
+    def add_disk_to_target(self, iqn, pool_name, image_name):
+        return self._change(
+            'target_lun',
+            (iqn, '{}/{}'.format(pool_name, image_name)),
+            'PUT',
+            '/api/targetlun/{}'.format(iqn),
+            {'disk': '{}/{}'.format(pool_name, image_name)})
+
+    def add_client_lun(self, iqn, initiatorname, pool_name, image_name):
+        return self._change(
+            'client_lun',
+            (iqn, initiatorname, '{}/{}'.format(pool_name, image_name)),
+            'PUT',
+            '/api/clientlun/{}/{}'.format(iqn, initiatorname),
+            {'disk': '{}/{}'.format(pool_name, image_name)})
 
     def add_disk_to_client(self, iqn, initiatorname, pool_name, image_name):
-        self.run(
-            "/iscsi-targets/{}/hosts/{}".format(iqn, initiatorname),
-            "disk add {}/{}".format(pool_name, image_name))
+        # A disk has to be mapped to the target before it can be mapped
+        # to one of the target's hosts.
+        self.add_disk_to_target(iqn, pool_name, image_name)
+        return self.add_client_lun(iqn, initiatorname, pool_name, image_name)
+
+    def close(self):
+        self.pool.close()
@@ -0,0 +1,100 @@
+"""Timing of charm handlers and gateway API calls.
+
+Samples are kept in a bounded ring buffer in the charm's StoredState so
+that they survive between hooks and can be reported by an action.
+"""
+
+import contextlib
+import functools
+import json
+import math
+import threading
+import time
+
+# Samples kept, the oldest are dropped first.
+MAXLEN = 500
+
+
+def timed(method):
+    """Time a charm method as 'handler:<method name>'.
+
+    The wrapper keeps the method's name, which the framework relies on to
+    re-run deferred events.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.timings.timer('handler:{}'.format(method.__name__)):
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+def percentile(values, pct):
+    """Nearest rank percentile of a list of numbers."""
+    ordered = sorted(values)
+    rank = max(1, int(math.ceil(pct / 100.0 * len(ordered))))
+    return ordered[rank - 1]
+
+
+class Timings():
+    """Record how long named operations take.
+
+    record() may be called from any thread. Samples are held in memory
+    until flush() appends them to the ring buffer in state.hook_timings.
+
+    :param state: StoredState to keep the ring buffer in.
+    :param maxlen: Number of samples to keep.
+    """
+
+    def __init__(self, state, maxlen=MAXLEN):
+        self.state = state
+        self.maxlen = maxlen
+        self.state.set_default(hook_timings='[]')
+        self._pending = []
+        self._lock = threading.Lock()
+
+    def record(self, name, seconds):
+        with self._lock:
+            self._pending.append([name, round(seconds, 6), int(time.time())])
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(name, time.monotonic() - start)
+
+    @property
+    def samples(self):
+        """Stored samples followed by any not flushed yet."""
+        with self._lock:
+            pending = list(self._pending)
+        return json.loads(self.state.hook_timings) + pending
+
+    def flush(self):
+        """Append the pending samples to the ring buffer."""
+        with self._lock:
+            if not self._pending:
+                return
+            pending, self._pending = self._pending, []
+        samples = json.loads(self.state.hook_timings) + pending
+        self.state.hook_timings = json.dumps(samples[-self.maxlen:])
+
+    def report(self, prefix=''):
+        """Summarise the samples per name.
+
+        :param prefix: Only include names starting with this.
+        :returns: {name: {'count', 'p50', 'p90', 'p99', 'max'}} in seconds.
+        """
+        by_name = {}
+        for name, seconds, _ in self.samples:
+            if name.startswith(prefix):
+                by_name.setdefault(name, []).append(seconds)
+        return {
+            name: {
+                'count': len(values),
+                'p50': percentile(values, 50),
+                'p90': percentile(values, 90),
+                'p99': percentile(values, 99),
+                'max': max(values)}
+            for name, values in sorted(by_name.items())}
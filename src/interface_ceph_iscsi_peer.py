@@ -1,8 +1,12 @@
 #!/usr/bin/env python3
 
+import copy
+import hashlib
+import ipaddress
 import json
 import logging
 import socket
+import time
 
 from ops.framework import (
     StoredState,
@@ -12,6 +16,59 @@ from ops.framework import (
     Object)
 
 
+def _is_host(network):
+    return network.prefixlen == network.max_prefixlen
+
+
+def _sorted(networks):
+    return sorted(set(networks), key=lambda n: (n.version, n))
+
+
+def collapse_networks(networks):
+    """Merge networks into the fewest that cover the same addresses.
+
+    Single addresses are kept as they are, even next to each other or
+    inside a network, as older rbd-target-api releases only match client
+    addresses exactly against trusted_ip_list.
+
+    :param networks: Addresses or networks, as strings or ipaddress objects.
+    :returns: Sorted list of ipaddress networks, IPv4 before IPv6.
+    :raises: ValueError if an entry is not an address or network.
+    """
+    hosts = []
+    by_version = {4: [], 6: []}
+    for network in networks:
+        network = ipaddress.ip_network(network, strict=False)
+        if _is_host(network):
+            hosts.append(network)
+        else:
+            by_version[network.version].append(network)
+    return _sorted(hosts + [
+        n for version in (4, 6)
+        for n in ipaddress.collapse_addresses(by_version[version])])
+
+
+def exclude_networks(networks, removed):
+    """Drop the addresses in removed from networks, splitting as needed."""
+    remaining = collapse_networks(networks)
+    for gone in collapse_networks(removed):
+        kept = []
+        for network in remaining:
+            if network.version != gone.version or not network.overlaps(gone):
+                kept.append(network)
+            elif gone.subnet_of(network) and gone != network:
+                kept.extend(network.address_exclude(gone))
+        remaining = collapse_networks(kept)
+    return remaining
+
+
+def format_networks(networks):
+    """Strings for networks, with single hosts written as a bare address."""
+    return [
+        str(n.network_address) if n.prefixlen == n.max_prefixlen else str(n)
+        for n in networks]
+
+
 class HasPeersEvent(EventBase):
     pass
 
@@ -24,10 +81,15 @@ class AllowedIpsChangedEvent(EventBase):
     pass
 
 
+class RestartGrantedEvent(EventBase):
+    pass
+
+
 class CephISCSIGatewayPeerEvents(ObjectEvents):
     has_peers = EventSource(HasPeersEvent)
     ready_peers = EventSource(ReadyPeersEvent)
     allowed_ips_changed = EventSource(AllowedIpsChangedEvent)
+    restart_granted = EventSource(RestartGrantedEvent)
 
 
 class CephISCSIGatewayPeers(Object):
@@ -37,62 +99,211 @@ class CephISCSIGatewayPeers(Object):
     PASSWORD_KEY = 'admin_password'
     READY_KEY = 'gateway_ready'
     FQDN_KEY = 'gateway_fqdn'
+    PORTALS_KEY = 'gateway_portals'
     ALLOWED_IPS_KEY = 'allowed_ips'
+    RESTART_REQUEST_KEY = 'restart_request'
+    RESTART_RELEASED_KEY = 'restart_released'
+    RESTART_TOKEN_KEY = 'restart_token'
 
     def __init__(self, charm, relation_name):
         super().__init__(charm, relation_name)
         self.relation_name = relation_name
         self.this_unit = self.framework.model.unit
         self.state.set_default(
-            allowed_ips=[])
+            allowed_ips_digest='')
+        self._cache = {}
+        self.framework.observe(
+            charm.on[relation_name].relation_joined,
+            self.on_joined)
         self.framework.observe(
             charm.on[relation_name].relation_changed,
             self.on_changed)
+        self.framework.observe(
+            charm.on[relation_name].relation_departed,
+            self.on_departed)
+        self.framework.observe(
+            charm.on.leader_elected,
+            self.on_departed)
+
+    # Values derived from the relation data and bindings are worked out
+    # once per dispatch. Relation data only changes under us when a
+    # relation event is delivered, or when this interface writes to it, so
+    # those drop the cache.
+
+    def _cached(self, key, func):
+        if key not in self._cache:
+            self._cache[key] = func()
+        return copy.deepcopy(self._cache[key])
+
+    def _invalidate(self):
+        self._cache.clear()
+
+    def _update(self, entity, data):
+        """Write to the relation data of our unit or app."""
+        self.peer_rel.data[entity].update(data)
+        self._invalidate()
+
+    def on_joined(self, event):
+        self._invalidate()
 
     def on_changed(self, event):
         logging.info("CephISCSIGatewayPeers on_changed")
+        self._invalidate()
         self.on.has_peers.emit()
         if self.ready_peer_details:
             self.on.ready_peers.emit()
-        if self.allowed_ips != self.state.allowed_ips:
+        digest = self.allowed_ips_digest
+        if digest != self.state.allowed_ips_digest:
+            self.state.allowed_ips_digest = digest
             self.on.allowed_ips_changed.emit()
-        self.state.allowed_ips = self.allowed_ips
+        self.process_restart_token()
+
+    def on_departed(self, event):
+        self._invalidate()
+        self.process_restart_token()
+
+    # Rolling restarts. Gateway services are restarted one unit at a time
+    # so that initiators always keep a path through the other gateways.
+    # A unit wanting to restart publishes a request nonce, the leader
+    # hands the restart token to one requesting unit at a time and the
+    # holder publishes the same nonce as released once its gateway is
+    # serving again.
+
+    def request_restart(self):
+        """Ask for the restart token, restart_granted fires once held."""
+        if not self._restart_pending(self.this_unit):
+            logging.info("Requesting restart token")
+            self._update(self.this_unit, {
+                self.RESTART_REQUEST_KEY: '{:.6f}'.format(time.time())})
+        self.process_restart_token()
+
+    def release_restart(self):
+        """Hand the restart token back."""
+        unit_data = self.peer_rel.data[self.this_unit]
+        logging.info("Releasing restart token")
+        self._update(self.this_unit, {
+            self.RESTART_RELEASED_KEY: unit_data.get(
+                self.RESTART_REQUEST_KEY, '')})
+        self.process_restart_token()
+
+    def process_restart_token(self):
+        if not self.peer_rel:
+            return
+        if self.framework.model.unit.is_leader():
+            self._grant_restart_token()
+        if self.holds_restart_token:
+            self.on.restart_granted.emit()
+
+    def _restart_pending(self, unit):
+        unit_data = self.peer_rel.data[unit]
+        request = unit_data.get(self.RESTART_REQUEST_KEY)
+        return bool(request) and request != unit_data.get(
+            self.RESTART_RELEASED_KEY)
+
+    def _grant_restart_token(self):
+        units = [self.this_unit] + list(self.peer_rel.units)
+        token = self.restart_token
+        if token and any(self._holds_token(u, token) for u in units):
+            return
+        waiting = sorted(
+            (self.peer_rel.data[u][self.RESTART_REQUEST_KEY], u.name)
+            for u in units if self._restart_pending(u))
+        if not waiting:
+            return
+        nonce, unit_name = waiting[0]
+        logging.info("Granting restart token to {}".format(unit_name))
+        self._update(self.peer_rel.app, {
+            self.RESTART_TOKEN_KEY: json.dumps(
+                {'unit': unit_name, 'nonce': nonce})})
+
+    @property
+    def restart_token(self):
+        token = self.peer_rel.data[self.peer_rel.app].get(
+            self.RESTART_TOKEN_KEY)
+        return json.loads(token) if token else None
+
+    def _holds_token(self, unit, token):
+        if token['unit'] != unit.name:
+            return False
+        request = self.peer_rel.data[unit].get(self.RESTART_REQUEST_KEY)
+        if token['nonce'] != request:
+            return False
+        return self._restart_pending(unit)
+
+    @property
+    def holds_restart_token(self):
+        token = self.restart_token
+        return bool(token) and self._holds_token(self.this_unit, token)
 
     def set_admin_password(self, password):
         logging.info("Setting admin password")
-        self.peer_rel.data[self.peer_rel.app][self.PASSWORD_KEY] = password
+        self._update(self.peer_rel.app, {self.PASSWORD_KEY: password})
+
+    def set_allowed_ips(self, ips, append=True, remove=()):
+        """Update the addresses and networks trusted to use the API.
+
+        CIDR networks in the stored list are collapsed into the fewest
+        networks covering the same addresses, single addresses are kept
+        as given.
 
-    def set_allowed_ips(self, ips, append=True):
+        :param ips: Addresses or CIDR networks to trust.
+        :param append: Add to the current list rather than replace it.
+        :param remove: Addresses or CIDR networks to stop trusting.
+        :raises: ValueError if an entry is not an address or network.
+        """
         logging.info("Setting allowed ips: {}".format(append))
-        trusted_ips = []
+        networks = list(ips)
         if append and self.allowed_ips:
-            trusted_ips = self.allowed_ips
-        trusted_ips.extend(ips)
-        trusted_ips = sorted(list(set(trusted_ips)))
-        ip_str = json.dumps(trusted_ips)
-        self.peer_rel.data[self.peer_rel.app][self.ALLOWED_IPS_KEY] = ip_str
+            networks.extend(self.allowed_ips)
+        ip_str = json.dumps(format_networks(
+            exclude_networks(networks, remove)))
+        if ip_str != self.peer_rel.data[self.peer_rel.app].get(
+                self.ALLOWED_IPS_KEY):
+            self._update(self.peer_rel.app, {self.ALLOWED_IPS_KEY: ip_str})
 
-    def announce_ready(self):
+    def announce_ready(self, portals=None):
+        """Tell the peers this gateway is serving.
+
+        :param portals: Addresses initiators reach this gateway on,
+                        defaults to its cluster address.
+        """
         logging.info("announcing ready")
-        self.peer_rel.data[self.this_unit][self.READY_KEY] = 'True'
-        self.peer_rel.data[self.this_unit][self.FQDN_KEY] = self.fqdn
+        data = {
+            self.READY_KEY: 'True',
+            self.FQDN_KEY: self.fqdn}
+        if portals:
+            data[self.PORTALS_KEY] = json.dumps(portals)
+        self._update(self.this_unit, data)
 
     @property
     def ready_peer_details(self):
+        return self._cached('ready_peer_details', self._ready_peer_details)
+
+    def _ready_peer_details(self):
+        ip = self.cluster_bind_address
         peers = {
             self.framework.model.unit.name: {
                 'fqdn': self.fqdn,
-                'ip': self.cluster_bind_address}}
+                'ip': ip,
+                'portals': self._portals(self.this_unit) or [ip]}}
         for u in self.peer_rel.units:
             if self.peer_rel.data[u].get(self.READY_KEY) == 'True':
+                ip = self.peer_rel.data[u]['ingress-address']
                 peers[u.name] = {
                     'fqdn': self.peer_rel.data[u][self.FQDN_KEY],
-                    'ip': self.peer_rel.data[u]['ingress-address']}
+                    'ip': ip,
+                    'portals': self._portals(u) or [ip]}
         return peers
 
+    def _portals(self, unit):
+        if not self.peer_rel:
+            return []
+        portals = self.peer_rel.data[unit].get(self.PORTALS_KEY)
+        return json.loads(portals) if portals else []
+
     @property
     def fqdn(self):
-        return socket.getfqdn()
+        return self._cached('fqdn', socket.getfqdn)
 
     @property
     def is_joined(self):
@@ -108,24 +319,43 @@ class CephISCSIGatewayPeers(Object):
 
     @property
     def cluster_bind_address(self):
-        return str(self.peer_binding.network.bind_address)
+        return self._cached(
+            'cluster_bind_address',
+            lambda: str(self.peer_binding.network.bind_address))
 
     @property
     def admin_password(self):
         if not self.peer_rel:
             return None
-        return self.peer_rel.data[self.peer_rel.app].get(self.PASSWORD_KEY)
+        return self._cached(
+            'admin_password',
+            lambda: self.peer_rel.data[self.peer_rel.app].get(
+                self.PASSWORD_KEY))
 
     @property
     def allowed_ips(self):
         if not self.peer_rel:
             return None
+        return self._cached('allowed_ips', self._allowed_ips)
+
+    def _allowed_ips(self):
         ip_str = self.peer_rel.data[self.peer_rel.app].get(
             self.ALLOWED_IPS_KEY, '[]')
         return json.loads(ip_str)
 
+    @property
+    def allowed_ips_digest(self):
+        """Digest of the stored allowed_ips, to spot changes cheaply."""
+        if not self.peer_rel:
+            return ''
+        return hashlib.sha256(self.peer_rel.data[self.peer_rel.app].get(
+            self.ALLOWED_IPS_KEY, '[]').encode()).hexdigest()
+
     @property
     def peer_addresses(self):
+        return self._cached('peer_addresses', self._peer_addresses)
+
+    def _peer_addresses(self):
         addresses = [self.cluster_bind_address]
         for u in self.peer_rel.units:
             addresses.append(self.peer_rel.data[u]['ingress-address'])
@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+
+import logging
+
+from ops.framework import Object
+
+
+class HTTPProvides(Object):
+    """Publish an HTTP endpoint, eg a metrics endpoint for prometheus.
+
+    :param charm: The charm.
+    :param relation_name: Relation using the http interface.
+    :param port: Callable returning the port the endpoint listens on.
+    """
+
+    def __init__(self, charm, relation_name, port):
+        super().__init__(charm, relation_name)
+        self.relation_name = relation_name
+        self.port = port
+        self.framework.observe(
+            charm.on[relation_name].relation_joined,
+            self.on_joined)
+
+    def on_joined(self, event):
+        self.publish()
+
+    def publish(self):
+        """Publish the endpoint on every relation."""
+        for relation in self.framework.model.relations[self.relation_name]:
+            binding = self.framework.model.get_binding(relation)
+            logging.info("Publishing {} endpoint on port {}".format(
+                self.relation_name,
+                self.port()))
+            relation.data[self.framework.model.unit].update({
+                'hostname': str(binding.network.ingress_address),
+                'port': str(self.port())})
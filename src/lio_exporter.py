@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""Prometheus exporter for the gateway's LIO/TCMU data path.
+
+Serves per LUN command and byte counters, configured queue depth limits
+and exported sizes, and per target session counts, read straight from
+configfs with a single pass per scrape.
+"""
+
+import argparse
+import http.server
+import re
+import socket
+
+import lio_stats
+
+MB = 1024 * 1024
+
+# Counters read back by parse_counters, metric name to read_counters() key
+# and scale.
+LUN_COUNTERS = {
+    'ceph_iscsi_lun_commands_total': ('cmds', 1),
+    'ceph_iscsi_lun_read_bytes_total': ('read_mb', MB),
+    'ceph_iscsi_lun_write_bytes_total': ('write_mb', MB)}
+
+LUN_SIZE = 'ceph_iscsi_lun_size_bytes'
+
+_SAMPLE = re.compile(r'^(\w+)\{(.*)\} (\S+)$')
+_LABEL = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+
+def _label(value):
+    return str(value).replace(
+        '\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _unlabel(value):
+    return re.sub(
+        r'\\(.)',
+        lambda m: '\n' if m.group(1) == 'n' else m.group(1),
+        value)
+
+
+def _metric(lines, name, metric_type, description, samples):
+    lines.append('# HELP {} {}'.format(name, description))
+    lines.append('# TYPE {} {}'.format(name, metric_type))
+    for labels, value in samples:
+        lines.append('{}{{{}}} {}'.format(
+            name,
+            ','.join('{}="{}"'.format(k, _label(v)) for k, v in labels),
+            value))
+
+
+def collect(core_root=lio_stats.CONFIGFS_CORE,
+            iscsi_root=lio_stats.CONFIGFS_ISCSI,
+            gateway=None):
+    """Render the current statistics in the Prometheus text format."""
+    gateway = gateway or socket.getfqdn()
+    luns = lio_stats.read_counters(core_root, queue_depth=True, size=True)
+    sessions = lio_stats.read_sessions(iscsi_root)
+
+    def lun_samples(key, scale=1):
+        return [
+            ((('gateway', gateway), ('disk', disk)), stats[key] * scale)
+            for disk, stats in sorted(luns.items())]
+
+    lines = []
+    _metric(
+        lines,
+        'ceph_iscsi_lun_commands_total',
+        'counter',
+        'SCSI commands handled for the LUN by this gateway.',
+        lun_samples('cmds'))
+    _metric(
+        lines,
+        'ceph_iscsi_lun_read_bytes_total',
+        'counter',
+        'Bytes read from the LUN through this gateway, in MiB steps.',
+        lun_samples('read_mb', MB))
+    _metric(
+        lines,
+        'ceph_iscsi_lun_write_bytes_total',
+        'counter',
+        'Bytes written to the LUN through this gateway, in MiB steps.',
+        lun_samples('write_mb', MB))
+    _metric(
+        lines,
+        'ceph_iscsi_lun_hw_queue_depth',
+        'gauge',
+        'Configured limit of commands the LUN backstore accepts at once, '
+        'not the number outstanding.',
+        lun_samples('queue_depth'))
+    _metric(
+        lines,
+        LUN_SIZE,
+        'gauge',
+        'Size of the LUN as exported by this gateway.',
+        [((('gateway', gateway), ('disk', disk)), stats['size'])
+         for disk, stats in sorted(luns.items()) if 'size' in stats])
+    _metric(
+        lines,
+        'ceph_iscsi_target_sessions',
+        'gauge',
+        'iSCSI sessions logged in to the target on this gateway.',
+        [((('gateway', gateway), ('target', iqn)), count)
+         for iqn, count in sorted(sessions.items())])
+    _metric(
+        lines,
+        'ceph_iscsi_gateway_sessions',
+        'gauge',
+        'iSCSI sessions logged in to this gateway.',
+        [((('gateway', gateway),), sum(sessions.values()))])
+    return '\n'.join(lines) + '\n'
+
+
+def _lun_samples(text, names):
+    """(metric name, disk, value) of the per LUN samples in names."""
+    for line in text.splitlines():
+        match = _SAMPLE.match(line)
+        if not match or match.group(1) not in names:
+            continue
+        labels = {
+            k: _unlabel(v) for k, v in _LABEL.findall(match.group(2))}
+        if 'disk' in labels:
+            yield match.group(1), labels['disk'], int(float(match.group(3)))
+
+
+def parse_counters(text):
+    """Per LUN counters from collect() output, as read_counters() gives.
+
+    :returns: {disk: {'cmds': n, 'read_mb': n, 'write_mb': n}}
+    """
+    counters = {}
+    for name, disk, value in _lun_samples(text, LUN_COUNTERS):
+        key, scale = LUN_COUNTERS[name]
+        counters.setdefault(disk, {})[key] = value // scale
+    return {
+        disk: values for disk, values in counters.items()
+        if len(values) == len(LUN_COUNTERS)}
+
+
+def parse_sizes(text):
+    """Exported LUN sizes from collect() output.
+
+    :returns: {disk: bytes}
+    """
+    return {
+        disk: value
+        for _, disk, value in _lun_samples(text, (LUN_SIZE,))}
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+
+    core_root = lio_stats.CONFIGFS_CORE
+    iscsi_root = lio_stats.CONFIGFS_ISCSI
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        data = collect(self.core_root, self.iscsi_root).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--address', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=9288)
+    args = parser.parse_args(argv)
+    server = http.server.HTTPServer((args.address, args.port), MetricsHandler)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+"""Per LUN I/O counters from the LIO configfs tree.
+
+ceph-iscsi backs each disk with a TCMU user backstore whose dev_config
+attribute records the rbd pool and image, eg
+``rbd/iscsi/disk_1;osd_op_timeout=30``. The backstore's SCSI logical
+unit statistics count the commands and data handled for the disk on this
+gateway, and its dev_size attribute is the size of the LUN this gateway
+exports. The iSCSI fabric statistics of each target count its sessions.
+"""
+
+import glob
+import os
+
+CONFIGFS_CORE = '/sys/kernel/config/target/core'
+CONFIGFS_ISCSI = '/sys/kernel/config/target/iscsi'
+
+
+def _read(path):
+    with open(path) as f:
+        return f.read().strip()
+
+
+def _disk_name(backstore):
+    """pool/image for a backstore, from its dev_config attribute."""
+    try:
+        dev_config = _read(os.path.join(backstore, 'attrib', 'dev_config'))
+    except OSError:
+        dev_config = ''
+    handler, _, path = dev_config.split(';')[0].partition('/')
+    if handler == 'rbd' and path:
+        return path
+    # ceph-iscsi names the backstore pool.image
+    return os.path.basename(backstore).replace('.', '/', 1)
+
+
+def read_counters(root=CONFIGFS_CORE, queue_depth=False, size=False):
+    """Read the counters of every TCMU backstore.
+
+    :param root: Path of the LIO core configfs directory.
+    :param queue_depth: Also read each backstore's hw_queue_depth, the
+                        configured limit of commands in flight rather
+                        than the number outstanding.
+    :param size: Also read the size of the LUN each backstore exports.
+                 This is the size initiators see through this gateway,
+                 which only follows the rbd image once the gateway has
+                 resized the backstore.
+    :returns: {disk: {'cmds': n, 'read_mb': n, 'write_mb': n}}, plus
+              'queue_depth' and 'size' in bytes if asked for.
+    """
+    counters = {}
+    for backstore in sorted(glob.glob(os.path.join(root, 'user_*', '*'))):
+        stats = os.path.join(backstore, 'statistics', 'scsi_lu')
+        try:
+            disk = {
+                'cmds': int(_read(os.path.join(stats, 'num_cmds'))),
+                'read_mb': int(_read(os.path.join(stats, 'read_mbytes'))),
+                'write_mb': int(_read(os.path.join(stats, 'write_mbytes')))}
+            if queue_depth:
+                disk['queue_depth'] = int(_read(
+                    os.path.join(backstore, 'attrib', 'hw_queue_depth')))
+        except (OSError, ValueError):
+            # Not a storage object, or it went away while being read.
+            continue
+        if size:
+            try:
+                disk['size'] = int(_read(
+                    os.path.join(backstore, 'attrib', 'dev_size')))
+            except (OSError, ValueError):
+                pass
+        counters[_disk_name(backstore)] = disk
+    return counters
+
+
+def read_sessions(root=CONFIGFS_ISCSI):
+    """Number of iSCSI sessions logged in to each target.
+
+    :param root: Path of the LIO iSCSI fabric configfs directory.
+    :returns: {target iqn: sessions}
+    """
+    sessions = {}
+    for target in sorted(glob.glob(os.path.join(root, 'iqn.*'))):
+        try:
+            sessions[os.path.basename(target)] = int(_read(os.path.join(
+                target,
+                'fabric_statistics',
+                'iscsi_instance',
+                'sessions')))
+        except (OSError, ValueError):
+            continue
+    return sessions
+
+
+def rates(old, new, seconds):
+    """Per disk rates between two read_counters() samples.
+
+    Disks missing from either sample, or whose counters went backwards
+    because the backstore was recreated, are left out.
+
+    :returns: {disk: {'iops': float, 'mbps': float}}
+    """
+    if seconds <= 0:
+        return {}
+    result = {}
+    for disk, counters in new.items():
+        previous = old.get(disk)
+        if not previous:
+            continue
+        deltas = {k: counters[k] - previous.get(k, 0) for k in counters}
+        if any(v < 0 for v in deltas.values()):
+            continue
+        result[disk] = {
+            'iops': round(deltas['cmds'] / seconds, 2),
+            'mbps': round(
+                (deltas['read_mb'] + deltas['write_mb']) / seconds, 2)}
+    return result
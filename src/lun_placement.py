@@ -0,0 +1,138 @@
+"""Balance LUN ownership across the gateways by load.
+
+Each disk has one owner, the gateway whose ALUA port group is
+active/optimized for it and which therefore serves its I/O. A disk can
+only be owned by a gateway that is a portal of the targets it is
+mapped to.
+"""
+
+
+def eligible_owners(config, gateways):
+    """Gateways each disk in the gateway configuration may be owned by.
+
+    :param config: Gateway configuration from GET /api/config.
+    :param gateways: Names of the ready gateways.
+    :returns: {disk: set of gateway names}
+    """
+    gateways = set(gateways)
+    eligible = {}
+    for target in config.get('targets', {}).values():
+        portals = set(target.get('portals', {})) & gateways
+        for disk in target.get('disks', {}):
+            if disk in eligible:
+                eligible[disk] &= portals
+            else:
+                eligible[disk] = set(portals)
+    return eligible
+
+
+def current_owners(config):
+    """{disk: owner} as recorded in the gateway configuration."""
+    return {
+        disk: details.get('owner')
+        for disk, details in config.get('disks', {}).items()
+        if details.get('owner')}
+
+
+EPSILON = 1e-9
+
+
+def loads(placement, weights, gateways=()):
+    """Total load per gateway, {gateway: load}."""
+    load = {g: 0.0 for g in gateways}
+    for disk, owner in placement.items():
+        load[owner] = load.get(owner, 0.0) + float(weights.get(disk, 0))
+    return load
+
+
+def _spread(load):
+    # Loads from highest to lowest, a lower tuple is a better balance.
+    return tuple(sorted(load.values(), reverse=True))
+
+
+def _best_step(eligible, placement, weight, load):
+    """Best move or swap off the most loaded gateway, None if none helps.
+
+    :returns: (hot gateway, disk, new owner, disk swapped back or None)
+    """
+    hot = max(load, key=lambda g: (load[g], g))
+    best = None
+    # Prefer a single move over a swap that balances as well.
+    best_key = (_spread(load), 0)
+    hot_disks = sorted(
+        (d for d, o in placement.items() if o == hot and weight[d]),
+        key=lambda d: (-weight[d], d))
+    for disk in hot_disks:
+        for gateway in sorted(eligible[disk] - {hot}):
+            swaps = sorted(
+                d for d, o in placement.items()
+                if o == gateway and weight[d] < weight[disk])
+            for other in [None] + swaps:
+                if other and hot not in eligible[other]:
+                    continue
+                delta = weight[disk] - (weight[other] if other else 0)
+                # Only count steps that leave the receiving gateway below
+                # the current peak, so each step strictly improves.
+                if load[gateway] + delta >= load[hot] - EPSILON:
+                    continue
+                trial = dict(load)
+                trial[hot] -= delta
+                trial[gateway] += delta
+                key = (_spread(trial), 2 if other else 1)
+                if key < best_key:
+                    best = (hot, disk, gateway, other)
+                    best_key = key
+    return best
+
+
+def rebalance(eligible, current, weights, max_moves=None):
+    """Move disks between gateways to minimise the highest gateway load.
+
+    Starting from the current owners, disks without a valid owner are
+    given the least loaded gateway, then a local search repeatedly makes
+    the single move, or swap of two disks, off the most loaded gateway
+    that best improves the balance. It stops once no move helps, so only
+    the moves needed are made.
+
+    :param eligible: {disk: set of gateways the disk may be owned by}
+    :param current: {disk: current owner}
+    :param weights: {disk: measured load}, missing disks count as idle.
+    :param max_moves: Stop after this many improving steps.
+    :returns: {disk: owner} for every disk with an eligible gateway.
+    """
+    weight = {d: float(weights.get(d, 0)) for d in eligible}
+    gateways = sorted(set().union(*eligible.values())) if eligible else []
+    if not gateways:
+        return {}
+    placement = {
+        d: current[d] for d in eligible
+        if current.get(d) in eligible[d]}
+    load = loads(placement, weight, gateways)
+    for disk in sorted(eligible, key=lambda d: (-weight[d], d)):
+        if disk not in placement and eligible[disk]:
+            owner = min(eligible[disk], key=lambda g: (load[g], g))
+            placement[disk] = owner
+            load[owner] += weight[disk]
+    steps = 0
+    while max_moves is None or steps < max_moves:
+        step = _best_step(eligible, placement, weight, load)
+        if step is None:
+            break
+        hot, disk, gateway, other = step
+        placement[disk] = gateway
+        load[hot] -= weight[disk]
+        load[gateway] += weight[disk]
+        if other:
+            placement[other] = hot
+            load[gateway] -= weight[other]
+            load[hot] += weight[other]
+        steps += 1
+    return placement
+
+
+def moves(current, placement):
+    """Disks whose owner changes, {disk: (old owner, new owner)}."""
+    return {
+        disk: (current.get(disk), owner)
+        for disk, owner in sorted(placement.items())
+        if current.get(disk) != owner}
@@ -0,0 +1,631 @@
+"""Declarative provisioning of iSCSI targets from a manifest.
+
+A manifest describes the desired disks, targets, gateways, hosts, CHAP
+credentials and LUN mappings, eg::
+
+    disks:
+      - pool: iscsi
+        image: disk1
+        size: 5G
+        controls:
+          max_data_area_mb: 64
+      - pool: iscsi
+        image: vdi1
+        source: iscsi/golden@base
+        flatten: false
+      - pool: iscsi
+        image: backup1
+        size: 2T
+        data_pool: iscsi-ec
+        qos:
+          iops_limit: 500
+          bps_limit: 100M
+    targets:
+      - iqn: iqn.2003-01.com.ubuntu.iscsi-gw:iscsi-igw
+        gateways: [ceph-iscsi/0, ceph-iscsi/1]
+        controls:
+          cmdsn_depth: 512
+        hosts:
+          - initiator: iqn.1993-08.org.debian:01:aaa2299be916
+            username: myiscsiusername
+            password: myiscsipassword
+            mutual_username: mytargetusername
+            mutual_password: mytargetpassword
+            disks: [iscsi/disk1]
+
+JSON is accepted as well, being a subset of YAML. The manifest is compared
+with the current gateway configuration and only the missing objects are
+created. Disk and target ``controls`` that differ from the current ones
+are reconfigured.
+
+A disk with a ``source`` snapshot is created as a layered RBD clone of it,
+grown to ``size`` if given, and then exported. With ``flatten`` the clone
+is detached from its parent in the background. A disk with a
+``data_pool`` keeps its data there, eg in an erasure-coded pool, and its
+metadata in ``pool``. A disk with ``create_image: false`` exports an
+existing image. A disk's ``qos`` limits, see rbd_client.QOS_SETTINGS, are
+set on its image whether or not it exists already.
+
+export_config() describes a gateway configuration in the same form, with
+a format version, so that it can be restored with load_export() and
+plan(). Settings it has no manifest form for are listed by
+unexported_settings().
+"""
+
+import json
+
+import yaml
+
+import gwcli_client
+import rbd_client
+import task_graph
+
+# Operations run with rbd rather than through the gateway API.
+RBD_OPERATIONS = (
+    'create_image',
+    'clone_image',
+    'flatten_image',
+    'set_image_qos')
+
+# Format of the files written from export_config.
+EXPORT_VERSION = 1
+
+
+class ManifestError(Exception):
+    """The manifest is malformed or refers to unknown objects."""
+
+
+class Operation():
+    """A single gateway API call in a provisioning plan.
+
+    :param kind: Name of the GatewayClient method to call.
+    :param obj: Identifier of the object the call creates or changes.
+    :param args: Positional arguments for the GatewayClient method.
+    :param deps: Names of operations that must complete first.
+    :param locks: Resources the operation needs exclusive use of.
+    """
+
+    def __init__(self, kind, obj, args, deps=(), locks=()):
+        self.kind = kind
+        self.obj = obj
+        self.args = args
+        self.deps = [d for d in deps if d]
+        self.locks = locks
+
+    @property
+    def name(self):
+        return '{}:{}'.format(self.kind, self.obj)
+
+    def __repr__(self):
+        return '<Operation {} {}>'.format(self.kind, self.obj)
+
+    def __eq__(self, other):
+        return (self.kind, self.obj, self.args) == (
+            other.kind, other.obj, other.args)
+
+    def run(self, client, rbd=None):
+        if self.kind in RBD_OPERATIONS:
+            client = rbd
+        return getattr(client, self.kind)(*self.args)
+
+
+def _require(item, key, context):
+    try:
+        value = item[key]
+    except (KeyError, TypeError):
+        raise ManifestError("{} is missing '{}'".format(context, key))
+    if value in (None, ''):
+        raise ManifestError("{} has an empty '{}'".format(context, key))
+    return value
+
+
+def _as_list(value, context):
+    if value is None:
+        return []
+    if not isinstance(value, list):
+        raise ManifestError("{} must be a list".format(context))
+    return value
+
+
+def _unique(values, context):
+    """List of values, each listed once, in the order first given."""
+    unique = []
+    for value in _as_list(values, context):
+        if value not in unique:
+            unique.append(value)
+    return unique
+
+
+def _check_duplicate(seen, name, context):
+    if name in seen:
+        raise ManifestError("{} {} is listed more than once".format(
+            context,
+            name))
+    seen.add(name)
+
+
+def _controls(item, allowed, context):
+    controls = item.get('controls') or {}
+    if not isinstance(controls, dict):
+        raise ManifestError("{} controls must be a mapping".format(context))
+    unknown = sorted(set(controls) - set(allowed))
+    if unknown:
+        raise ManifestError("{} has unknown controls: {}".format(
+            context,
+            ', '.join(unknown)))
+    return controls
+
+
+def _qos(item, context):
+    qos = item.get('qos') or {}
+    if not isinstance(qos, dict):
+        raise ManifestError("{} qos must be a mapping".format(context))
+    try:
+        return rbd_client.parse_qos(qos)
+    except ValueError as exc:
+        raise ManifestError("{}: {}".format(context, exc))
+
+
+def _changed_controls(wanted, current):
+    """Controls in wanted whose value differs from current."""
+    current = current or {}
+    return {
+        k: v for k, v in wanted.items()
+        if str(current.get(k)) != str(v)}
+
+
+def load_manifest(text):
+    """Parse and validate a YAML or JSON manifest.
+
+    :returns: dict with normalised 'disks' and 'targets' lists.
+    :raises: ManifestError
+    """
+    try:
+        manifest = yaml.safe_load(text) or {}
+    except yaml.YAMLError as exc:
+        raise ManifestError("Unable to parse manifest: {}".format(exc))
+    return _normalise(manifest)
+
+
+def _normalise(manifest):
+    if not isinstance(manifest, dict):
+        raise ManifestError("Manifest must be a mapping")
+    disks = []
+    seen = set()
+    for disk in _as_list(manifest.get('disks'), 'disks'):
+        pool = _require(disk, 'pool', 'disk')
+        image = _require(disk, 'image', 'disk {}'.format(pool))
+        _check_duplicate(seen, '{}/{}'.format(pool, image), 'disk')
+        source = disk.get('source')
+        if source:
+            try:
+                rbd_client.split_snapshot(source)
+            except ValueError as exc:
+                raise ManifestError("disk {}/{}: {}".format(pool, image, exc))
+        disks.append({
+            'id': '{}/{}'.format(pool, image),
+            'pool': pool,
+            'image': image,
+            'size': disk.get('size'),
+            'source': source,
+            'flatten': bool(disk.get('flatten')),
+            'data_pool': disk.get('data_pool'),
+            'create_image': bool(disk.get('create_image', True)),
+            'qos': _qos(disk, 'disk {}/{}'.format(pool, image)),
+            'controls': _controls(
+                disk,
+                gwcli_client.DISK_CONTROLS,
+                'disk {}/{}'.format(pool, image))})
+    targets = []
+    seen = set()
+    for target in _as_list(manifest.get('targets'), 'targets'):
+        iqn = _require(target, 'iqn', 'target')
+        _check_duplicate(seen, iqn, 'target')
+        hosts = []
+        initiators = set()
+        for host in _as_list(target.get('hosts'), '{} hosts'.format(iqn)):
+            initiator = _require(host, 'initiator', 'host')
+            _check_duplicate(initiators, initiator, '{} host'.format(iqn))
+            hosts.append({
+                'initiator': initiator,
+                'username': host.get('username'),
+                'password': host.get('password'),
+                'mutual_username': host.get('mutual_username') or '',
+                'mutual_password': host.get('mutual_password') or '',
+                'disks': _unique(
+                    host.get('disks'),
+                    '{} disks'.format(initiator))})
+        targets.append({
+            'iqn': iqn,
+            'gateways': _unique(
+                target.get('gateways'),
+                '{} gateways'.format(iqn)),
+            'disks': _unique(target.get('disks'), '{} disks'.format(iqn)),
+            'hosts': hosts,
+            'controls': _controls(
+                target,
+                gwcli_client.TARGET_CONTROLS,
+                iqn)})
+    return {'disks': disks, 'targets': targets}
+
+
+def _by_lun_id(luns):
+    """Disk ids of a target or client, in the order of their LUN ids."""
+    if not isinstance(luns, dict):
+        return list(luns)
+    return sorted(
+        luns,
+        key=lambda d: ((luns[d] or {}).get('lun_id', 0), d))
+
+
+def _known_controls(item, allowed):
+    return {
+        k: v for k, v in (item.get('controls') or {}).items()
+        if k in allowed}
+
+
+def export_config(config, qos=None):
+    """Describe a gateway configuration as a manifest to restore it from.
+
+    Disks are recorded as existing images, as the images themselves stay
+    in ceph. LUNs are listed in LUN id order and plan maps a target's
+    disks in the order listed, so an import into a target without disks
+    gives them the same ids, as the gateway gives each disk added the
+    next free id. CHAP credentials are written in plain text, so that they
+    can be replayed through the API.
+
+    :param config: Gateway configuration from GET /api/config, fetched
+                   with decrypt_passwords.
+    :param qos: {disk id: QoS limits set on its image}, see
+                rbd_client.RBDClient.get_image_qos. The gateway
+                configuration does not hold them.
+    :returns: Manifest dict with the EXPORT_VERSION as 'version'.
+    """
+    qos = qos or {}
+    disks = []
+    for disk_id, disk in sorted(config.get('disks', {}).items()):
+        pool, image = _split_disk(disk_id)
+        entry = {'pool': pool, 'image': image, 'create_image': False}
+        controls = _known_controls(disk, gwcli_client.DISK_CONTROLS)
+        if controls:
+            entry['controls'] = controls
+        if qos.get(disk_id):
+            entry['qos'] = qos[disk_id]
+        disks.append(entry)
+    targets = []
+    for iqn, target in sorted(config.get('targets', {}).items()):
+        hosts = []
+        clients = target.get('clients', {})
+        for initiator, client in sorted(clients.items()):
+            host = {
+                'initiator': initiator,
+                'disks': _by_lun_id(client.get('luns', {}))}
+            auth = client.get('auth') or {}
+            if auth.get('username'):
+                host['username'] = auth['username']
+                host['password'] = auth.get('password')
+                if auth.get('mutual_username'):
+                    host['mutual_username'] = auth['mutual_username']
+                    host['mutual_password'] = auth.get('mutual_password')
+            hosts.append(host)
+        entry = {
+            'iqn': iqn,
+            'gateways': sorted(target.get('portals', {})),
+            'disks': _by_lun_id(target.get('disks', {})),
+            'hosts': hosts}
+        controls = _known_controls(target, gwcli_client.TARGET_CONTROLS)
+        if controls:
+            entry['controls'] = controls
+        targets.append(entry)
+    return {'version': EXPORT_VERSION, 'disks': disks, 'targets': targets}
+
+
+def unexported_settings(config):
+    """Describe the settings in a configuration export_config leaves out.
+
+    A manifest has no form for discovery or target level CHAP, for
+    targets with ACLs disabled or for host groups, so an import would not
+    restore them.
+
+    :param config: Gateway configuration from GET /api/config.
+    :returns: List of str, one per setting.
+    """
+    settings = []
+    if (config.get('discovery_auth') or {}).get('username'):
+        settings.append("discovery CHAP credentials")
+    for iqn, target in sorted(config.get('targets', {}).items()):
+        if (target.get('auth') or {}).get('username'):
+            settings.append("{} target CHAP credentials".format(iqn))
+        if target.get('acl_enabled') is False:
+            settings.append("{} ACLs disabled".format(iqn))
+        for group in sorted(target.get('groups') or {}):
+            settings.append("{} host group {}".format(iqn, group))
+    return settings
+
+
+def load_export(text, gateways):
+    """Parse the JSON written from export_config.
+
+    Gateways in the export that are no longer ready, eg because they were
+    rebuilt under new names, are dropped. A target left without gateways
+    is served by all ready gateways.
+
+    :param gateways: Ready gateways, as for plan.
+    :returns: dict as returned by load_manifest.
+    :raises: ManifestError
+    """
+    try:
+        export = json.loads(text)
+    except ValueError as exc:
+        raise ManifestError("Unable to parse export: {}".format(exc))
+    version = export.get('version') if isinstance(export, dict) else None
+    if version != EXPORT_VERSION:
+        raise ManifestError("Unsupported export version {}".format(version))
+    manifest = _normalise(export)
+    known = set(gateways)
+    known.update(g['fqdn'] for g in gateways.values())
+    for target in manifest['targets']:
+        target['gateways'] = [g for g in target['gateways'] if g in known]
+    return manifest
+
+
+def _split_disk(disk_id):
+    pool, _, image = disk_id.partition('/')
+    if not pool or not image:
+        raise ManifestError(
+            "'{}' is not a disk, expected pool/image".format(disk_id))
+    return pool, image
+
+
+def _resolve_gateways(names, gateways):
+    """Map unit names or fqdns from the manifest to gateway details.
+
+    A gateway named both by unit name and by fqdn is only returned once.
+    """
+    if not names:
+        return sorted(gateways.values(), key=lambda g: g['fqdn'])
+    by_fqdn = {g['fqdn']: g for g in gateways.values()}
+    resolved = []
+    for name in names:
+        gateway = gateways.get(name) or by_fqdn.get(name)
+        if not gateway:
+            raise ManifestError("'{}' is not a ready gateway".format(name))
+        if gateway not in resolved:
+            resolved.append(gateway)
+    return resolved
+
+
+def _target_lock(iqn):
+    # Changes to a target are applied to its TPG on every gateway, so only
+    # one change per target is sent to the API at a time.
+    return ('target:{}'.format(iqn),)
+
+
+def _disk_lock(disk_id):
+    return ('disk:{}'.format(disk_id),)
+
+
+def plan(manifest, config, gateways):
+    """Work out the operations needed to reach the manifest.
+
+    Each operation lists the operations it depends on so that
+    independent ones, such as creating images and adding gateways, can
+    be run at the same time.
+
+    :param manifest: dict returned by load_manifest.
+    :param config: Current gateway configuration from GET /api/config.
+    :param gateways: Ready gateways,
+                     {unit_name: {'fqdn': .., 'ip': .., 'portals': [..]}}.
+    :returns: List of Operations, dependencies come before dependents.
+    :raises: ManifestError
+    """
+    ops = []
+
+    def add(*args, **kwargs):
+        op = Operation(*args, **kwargs)
+        ops.append(op)
+        return op.name
+
+    current_disks = config.get('disks', {})
+    existing_disks = set(current_disks)
+    disk_ops = {}
+    for disk in manifest['disks']:
+        if disk['id'] in existing_disks:
+            controls = _changed_controls(
+                disk['controls'],
+                current_disks.get(disk['id'], {}).get('controls'))
+            if controls:
+                disk_ops[disk['id']] = add(
+                    'reconfigure_disk',
+                    disk['id'],
+                    (disk['pool'], disk['image'], controls),
+                    locks=_disk_lock(disk['id']))
+            continue
+        locks = _disk_lock(disk['id'])
+        if disk['source']:
+            clone = add(
+                'clone_image',
+                disk['id'],
+                (disk['source'], disk['pool'], disk['image'], disk['size']),
+                locks=locks)
+            disk_ops[disk['id']] = add(
+                'register_disk',
+                disk['id'],
+                (disk['pool'], disk['image'], disk['controls'] or None),
+                deps=[clone],
+                locks=locks)
+            if disk['flatten']:
+                add(
+                    'flatten_image',
+                    disk['id'],
+                    (disk['pool'], disk['image']),
+                    deps=[disk_ops[disk['id']]],
+                    locks=locks)
+            existing_disks.add(disk['id'])
+            continue
+        if not disk['create_image']:
+            disk_ops[disk['id']] = add(
+                'register_disk',
+                disk['id'],
+                (disk['pool'], disk['image'], disk['controls'] or None),
+                locks=locks)
+            existing_disks.add(disk['id'])
+            continue
+        if not disk['size']:
+            raise ManifestError(
+                "disk {} does not exist and has no size".format(disk['id']))
+        if disk['data_pool']:
+            create = add(
+                'create_image',
+                disk['id'],
+                (disk['pool'], disk['image'], disk['size'], disk['data_pool']),
+                locks=locks)
+            disk_ops[disk['id']] = add(
+                'register_disk',
+                disk['id'],
+                (disk['pool'], disk['image'], disk['controls'] or None),
+                deps=[create],
+                locks=locks)
+            existing_disks.add(disk['id'])
+            continue
+        args = (disk['pool'], disk['image'], disk['size'])
+        if disk['controls']:
+            args += (disk['controls'],)
+        disk_ops[disk['id']] = add(
+            'create_pool',
+            disk['id'],
+            args,
+            locks=locks)
+        existing_disks.add(disk['id'])
+    for disk in manifest['disks']:
+        # Limit the disk before it is mapped to any initiator.
+        if disk['qos']:
+            disk_ops[disk['id']] = add(
+                'set_image_qos',
+                disk['id'],
+                (disk['pool'], disk['image'], disk['qos']),
+                deps=[disk_ops.get(disk['id'])],
+                locks=_disk_lock(disk['id']))
+    for target in manifest['targets']:
+        iqn = target['iqn']
+        locks = _target_lock(iqn)
+        current = config.get('targets', {}).get(iqn)
+        target_deps = []
+        if current is None:
+            target_deps.append(
+                add('create_target', iqn, (iqn,), locks=locks))
+            current = {}
+        controls = _changed_controls(
+            target['controls'],
+            current.get('controls'))
+        if controls:
+            target_deps.append(add(
+                'reconfigure_target',
+                iqn,
+                (iqn, controls),
+                deps=target_deps,
+                locks=locks))
+        portals = current.get('portals', {})
+        gateway_deps = list(target_deps)
+        for gateway in _resolve_gateways(target['gateways'], gateways):
+            if gateway['fqdn'] not in portals:
+                gateway_deps.append(add(
+                    'add_gateway_to_target',
+                    '{}/{}'.format(iqn, gateway['fqdn']),
+                    (
+                        iqn,
+                        gateway.get('portals') or [gateway['ip']],
+                        gateway['fqdn']),
+                    deps=target_deps,
+                    locks=locks))
+        target_disks = set(current.get('disks', {}))
+        wanted_disks = list(target['disks'])
+        for host in target['hosts']:
+            wanted_disks.extend(host['disks'])
+        lun_ops = {}
+        previous_lun = None
+        for disk_id in wanted_disks:
+            if disk_id in target_disks:
+                continue
+            if disk_id not in existing_disks:
+                raise ManifestError(
+                    "{} maps unknown disk {}".format(iqn, disk_id))
+            # The gateway gives each disk the next free LUN id as it is
+            # added, so map them one after the other in the order listed
+            # rather than as their disk operations finish.
+            previous_lun = lun_ops[disk_id] = add(
+                'add_disk_to_target',
+                '{}/{}'.format(iqn, disk_id),
+                (iqn,) + _split_disk(disk_id),
+                deps=gateway_deps + [disk_ops.get(disk_id), previous_lun],
+                locks=locks)
+            target_disks.add(disk_id)
+        clients = current.get('clients', {})
+        for host in target['hosts']:
+            initiator = host['initiator']
+            client = clients.get(initiator)
+            client_deps = list(gateway_deps)
+            if client is None:
+                client_deps.append(add(
+                    'add_client_to_target',
+                    '{}/{}'.format(iqn, initiator),
+                    (iqn, initiator),
+                    deps=gateway_deps,
+                    locks=locks))
+                client = {}
+            auth = client.get('auth', {})
+            credentials = (
+                host['username'],
+                host['password'],
+                host['mutual_username'],
+                host['mutual_password'])
+            current_credentials = (
+                auth.get('username'),
+                auth.get('password'),
+                auth.get('mutual_username') or '',
+                auth.get('mutual_password') or '')
+            if host['username'] and credentials != current_credentials:
+                add(
+                    'add_client_auth',
+                    '{}/{}'.format(iqn, initiator),
+                    (iqn, initiator) + credentials,
+                    deps=client_deps,
+                    locks=locks)
+            luns = client.get('luns', {})
+            for disk_id in host['disks']:
+                if disk_id not in luns:
+                    add(
+                        'add_client_lun',
+                        '{}/{}/{}'.format(iqn, initiator, disk_id),
+                        (iqn, initiator) + _split_disk(disk_id),
+                        deps=client_deps + [lun_ops.get(disk_id)],
+                        locks=locks)
+    return ops
+
+
+def apply(ops, client, workers=1, rbd=None):
+    """Run the operations, up to workers of them at a time.
+
+    Operations that depend on a failed operation are skipped.
+
+    :param client: GatewayClient for the API operations.
+    :param rbd: RBDClient for the RBD_OPERATIONS.
+
+    :returns: List of per operation results with timings.
+    """
+    graph = task_graph.TaskGraph()
+    for op in ops:
+        graph.add(
+            op.name,
+            op.run,
+            (client, rbd),
+            deps=op.deps,
+            locks=op.locks)
+    outcome = graph.run(workers=workers)
+    results = []
+    for op in ops:
+        result = {'operation': op.kind, 'object': op.obj}
+        result.update(
+            (k, v) for k, v in outcome[op.name].items() if k != 'result')
+        results.append(result)
+    return results
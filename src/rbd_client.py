@@ -0,0 +1,232 @@
+"""RBD image operations the gateway API has no call for.
+
+rbd-target-api can only create empty images in a single pool, or export
+ones that already exist. Disks cloned from a golden image, or with their
+data in an erasure-coded pool, are created here with the rbd CLI, using
+the gateway's own ceph.conf and keyring, and then exported through the
+API with create_image=false.
+
+QoS limits are librbd settings of the image, so they are set with the
+rbd CLI as well and apply to the gateways' tcmu-runner like any other
+librbd client.
+"""
+
+import json
+import logging
+import subprocess
+
+import gwcli_client
+
+# librbd QoS settings, without their rbd_qos_ prefix. 0 means unlimited.
+QOS_SETTINGS = (
+    'iops_limit',
+    'read_iops_limit',
+    'write_iops_limit',
+    'bps_limit',
+    'read_bps_limit',
+    'write_bps_limit',
+    'iops_burst',
+    'read_iops_burst',
+    'write_iops_burst',
+    'bps_burst',
+    'read_bps_burst',
+    'write_bps_burst')
+
+
+class RBDError(Exception):
+    """An rbd command failed."""
+
+
+def split_snapshot(spec):
+    """Split 'pool/image@snap' into (pool, image, snap).
+
+    :raises: ValueError if spec does not name a snapshot.
+    """
+    image_spec, _, snap = spec.partition('@')
+    pool, _, image = image_spec.partition('/')
+    if not (pool and image and snap) or '/' in image:
+        raise ValueError(
+            "'{}' is not a snapshot, expected pool/image@snap".format(spec))
+    return pool, image, snap
+
+
+def parse_qos(qos):
+    """Validate QoS settings, eg {'iops_limit': 500, 'bps_limit': '100M'}.
+
+    :returns: {setting: int}, byte rates converted from sizes.
+    :raises: ValueError for unknown settings or bad values.
+    """
+    unknown = sorted(set(qos) - set(QOS_SETTINGS))
+    if unknown:
+        raise ValueError("Unknown QoS settings: {}".format(', '.join(unknown)))
+    parsed = {}
+    for name, value in qos.items():
+        if 'bps' in name:
+            value = gwcli_client.size_bytes(value)
+        else:
+            try:
+                value = int(value)
+            except (TypeError, ValueError):
+                raise ValueError("{} must be a number, not '{}'".format(
+                    name,
+                    value))
+        if value < 0:
+            raise ValueError("{} cannot be negative".format(name))
+        parsed[name] = value
+    return parsed
+
+
+class RBDClient():
+    """Run rbd commands as the gateway's ceph client.
+
+    :param user: Ceph client id, without the 'client.' prefix.
+    :param conf: ceph.conf naming the monitors and the keyring.
+    """
+
+    def __init__(self, user='ceph-iscsi', conf='/etc/ceph/iscsi/ceph.conf'):
+        self.user = user
+        self.conf = conf
+
+    def _cmd(self, *args):
+        return ['rbd', '--id', self.user, '--conf', self.conf] + list(args)
+
+    def _run(self, *args):
+        cmd = self._cmd(*args)
+        logging.info("Running {}".format(' '.join(cmd)))
+        try:
+            return subprocess.run(
+                cmd,
+                check=True,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE).stdout.decode()
+        except subprocess.CalledProcessError as exc:
+            raise RBDError("rbd {} failed: {}".format(
+                ' '.join(a for a in args[:2] if not a.startswith('-')),
+                exc.stderr.decode(errors='replace').strip()))
+
+    def image_exists(self, pool_name, image_name):
+        try:
+            self._run('info', '{}/{}'.format(pool_name, image_name))
+        except RBDError:
+            return False
+        return True
+
+    def image_size(self, pool_name, image_name):
+        """Size of the image in bytes."""
+        output = self._run(
+            'info', '--format', 'json',
+            '{}/{}'.format(pool_name, image_name))
+        return int(json.loads(output)['size'])
+
+    def image_parent(self, pool_name, image_name):
+        """Snapshot the image was cloned from, as 'pool/image@snap'.
+
+        :returns: None if the image is not a clone, or was flattened.
+        """
+        output = self._run(
+            'info', '--format', 'json',
+            '{}/{}'.format(pool_name, image_name))
+        parent = json.loads(output).get('parent')
+        if not parent:
+            return None
+        pool = parent['pool']
+        if parent.get('pool_namespace'):
+            pool = '{}/{}'.format(pool, parent['pool_namespace'])
+        return '{}/{}@{}'.format(pool, parent['image'], parent['snapshot'])
+
+    def create_image(self, pool_name, image_name, size, data_pool=None):
+        """Create an empty image, its data in data_pool if given.
+
+        An image left behind by an earlier, interrupted run is reused.
+
+        :param size: Size of the image, eg '20G'.
+        :param data_pool: Pool for the image's data, eg an erasure-coded
+                          pool with overwrites enabled. The metadata stays
+                          in pool_name, which must be replicated.
+        """
+        image = '{}/{}'.format(pool_name, image_name)
+        if self.image_exists(pool_name, image_name):
+            logging.info("{} already exists, not creating".format(image))
+            return
+        args = ['create', '--size', str(size)]
+        if data_pool:
+            args += ['--data-pool', data_pool]
+        self._run(*(args + [image]))
+
+    def clone_image(self, source, pool_name, image_name, size=None):
+        """Create pool_name/image_name as a layered clone of source.
+
+        An image left behind by an earlier, interrupted run is reused if
+        it is a clone of source.
+
+        :param source: Snapshot to clone, 'pool/image@snap'. With clone
+                       format 1 the snapshot must be protected.
+        :param size: Grow the clone to this size, eg '20G'.
+        :raises: RBDError if the image exists but is not a clone of source.
+        """
+        split_snapshot(source)
+        image = '{}/{}'.format(pool_name, image_name)
+        if self.image_exists(pool_name, image_name):
+            parent = self.image_parent(pool_name, image_name)
+            if parent != source:
+                raise RBDError(
+                    "{} already exists and is not a clone of {}{}".format(
+                        image,
+                        source,
+                        ', its parent is {}'.format(parent) if parent
+                        else ''))
+            logging.info("{} already exists, not cloning".format(image))
+        else:
+            self._run('clone', source, image)
+        if size:
+            self._run('resize', '--no-progress', '--size', str(size), image)
+
+    def set_image_qos(self, pool_name, image_name, qos):
+        """Set QoS limits of an image.
+
+        :param qos: {setting: value} as returned by parse_qos.
+        """
+        image = '{}/{}'.format(pool_name, image_name)
+        for name, value in sorted(qos.items()):
+            self._run(
+                'config', 'image', 'set', image,
+                'rbd_qos_{}'.format(name), str(value))
+
+    def get_image_qos(self, pool_name, image_name, image_only=False):
+        """Effective QoS limits of an image that are set.
+
+        Limits inherited from the pool or global configuration are
+        included unless image_only.
+
+        :param image_only: Only limits set on the image itself.
+        :returns: {setting: value}, unlimited settings are left out.
+        """
+        output = self._run(
+            'config', 'image', 'list', '--format', 'json',
+            '{}/{}'.format(pool_name, image_name))
+        qos = {}
+        for option in json.loads(output):
+            name = option['name'].replace('rbd_qos_', '', 1)
+            if image_only and option.get('source') != 'image':
+                continue
+            if name in QOS_SETTINGS and int(option['value']):
+                qos[name] = int(option['value'])
+        return qos
+
+    def flatten_image(self, pool_name, image_name):
+        """Start copying the parent's data into the clone.
+
+        Flattening reads the whole parent, so it is left running in the
+        background and the disk can be exported meanwhile.
+        """
+        cmd = self._cmd(
+            'flatten',
+            '--no-progress',
+            '{}/{}'.format(pool_name, image_name))
+        logging.info("Starting {}".format(' '.join(cmd)))
+        subprocess.Popen(
+            cmd,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            start_new_session=True)
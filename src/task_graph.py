@@ -0,0 +1,114 @@
+"""Run interdependent tasks on a bounded pool of worker threads."""
+
+import concurrent.futures
+import logging
+import time
+from collections import OrderedDict
+
+DONE = 'done'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+
+
+class Task():
+    """A unit of work in a TaskGraph.
+
+    :param name: Unique name of the task.
+    :param func: Callable to run.
+    :param args: Positional arguments for func.
+    :param deps: Names of tasks that must complete first.
+    :param locks: Names of resources the task needs exclusive use of.
+    """
+
+    def __init__(self, name, func, args=(), deps=(), locks=()):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.deps = tuple(deps)
+        self.locks = frozenset(locks)
+
+
+class TaskGraph():
+    """Dependency graph of tasks.
+
+    Tasks only start once all of their dependencies have completed and
+    none of their locks are held by a running task. When several tasks
+    are ready they start in the order they were added. Tasks depending
+    on a failed task are skipped.
+    """
+
+    def __init__(self):
+        self.tasks = OrderedDict()
+
+    def add(self, name, func, args=(), deps=(), locks=()):
+        """Add a task, its dependencies must already have been added.
+
+        Requiring dependencies to exist up front keeps the graph acyclic.
+        """
+        if name in self.tasks:
+            raise ValueError("Duplicate task {}".format(name))
+        for dep in deps:
+            if dep not in self.tasks:
+                raise ValueError("{} depends on unknown task {}".format(
+                    name,
+                    dep))
+        self.tasks[name] = Task(name, func, args, deps, locks)
+        return name
+
+    def _timed(self, task):
+        start = time.monotonic()
+        try:
+            return task.func(*task.args), None, time.monotonic() - start
+        except Exception as exc:
+            return None, exc, time.monotonic() - start
+
+    def run(self, workers=1):
+        """Run all tasks.
+
+        :param workers: Maximum number of tasks to run at once, values
+                        below 1 run them one at a time.
+        :returns: OrderedDict of task name to a dict with 'status',
+                  'seconds' and either 'result' or 'error'.
+        """
+        workers = max(1, workers)
+        results = OrderedDict((name, None) for name in self.tasks)
+        pending = list(self.tasks.values())
+        running = {}
+        held = set()
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=workers) as pool:
+            while pending or running:
+                for task in list(pending):
+                    states = [results[d] and results[d]['status']
+                              for d in task.deps]
+                    if FAILED in states or SKIPPED in states:
+                        results[task.name] = {'status': SKIPPED}
+                        pending.remove(task)
+                        continue
+                    ready = all(s == DONE for s in states)
+                    free = not task.locks & held
+                    if ready and free and len(running) < workers:
+                        held |= task.locks
+                        running[pool.submit(self._timed, task)] = task
+                        pending.remove(task)
+                if not running:
+                    continue
+                finished, _ = concurrent.futures.wait(
+                    running,
+                    return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    task = running.pop(future)
+                    held -= task.locks
+                    result, exc, seconds = future.result()
+                    if exc is None:
+                        results[task.name] = {
+                            'status': DONE,
+                            'result': result,
+                            'seconds': round(seconds, 3)}
+                    else:
+                        logging.error("{} failed: {}".format(task.name, exc))
+                        results[task.name] = {
+                            'status': FAILED,
+                            'error': str(exc),
+                            'seconds': round(seconds, 3)}
+        return results
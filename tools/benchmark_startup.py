@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""Measure charm startup, import plus dispatch, per hook.
+
+Every hook runs the charm in a fresh interpreter, so each sample is taken
+in a new process: import the charm module, build it under the ops test
+harness and emit the hook's event, followed by the framework's pre-commit.
+Hook tools are served by the harness, so the numbers cover the charm's own
+Python cost and not juju's.
+
+    python3 tools/benchmark_startup.py --runs 20 --output startup.json
+    python3 tools/benchmark_startup.py --baseline startup.json
+
+With --baseline the run fails if the median total time of any hook grew
+by more than --tolerance over the baseline.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HOOKS = {
+    'update-status': 'update_status',
+    'config-changed': 'config_changed',
+    'upgrade-charm': 'upgrade_charm',
+    'leader-elected': 'leader_elected',
+}
+
+CHILD = """
+import json
+import sys
+import time
+start = time.perf_counter()
+sys.path[:0] = ['lib', 'src']
+import charm
+imported = time.perf_counter()
+from ops.testing import Harness
+harness = Harness(charm.CephISCSIGatewayCharmBase)
+harness.begin()
+getattr(harness.charm.on, sys.argv[1]).emit()
+harness.framework.on.pre_commit.emit()
+done = time.perf_counter()
+print(json.dumps({
+    'import': imported - start,
+    'dispatch': done - imported,
+    'modules': len(sys.modules)}))
+"""
+
+
+def sample(event):
+    output = subprocess.check_output(
+        [sys.executable, '-c', CHILD, event],
+        cwd=ROOT,
+        stderr=subprocess.DEVNULL)
+    return json.loads(output.decode().splitlines()[-1])
+
+
+def measure(hooks, runs):
+    results = {}
+    for hook in hooks:
+        samples = [sample(HOOKS[hook]) for _ in range(runs)]
+        results[hook] = {
+            'import': statistics.median(s['import'] for s in samples),
+            'dispatch': statistics.median(s['dispatch'] for s in samples),
+            'total': statistics.median(
+                s['import'] + s['dispatch'] for s in samples),
+            'modules': samples[-1]['modules']}
+    return results
+
+
+def regressions(results, baseline, tolerance):
+    """Hooks whose median total time grew by more than tolerance."""
+    slower = []
+    for hook, result in sorted(results.items()):
+        limit = baseline.get(hook, {}).get('total')
+        if limit and result['total'] > limit * (1 + tolerance):
+            slower.append(hook)
+    return slower
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument(
+        '--hook',
+        action='append',
+        choices=sorted(HOOKS),
+        help="Hook to measure, may be repeated, default all")
+    parser.add_argument('--output', help="Write the results to this file")
+    parser.add_argument('--baseline', help="Results to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    results = measure(args.hook or sorted(HOOKS), args.runs)
+    print('{:<16} {:>10} {:>10} {:>10} {:>8}'.format(
+        'hook', 'import ms', 'hook ms', 'total ms', 'modules'))
+    for hook, result in sorted(results.items()):
+        print('{:<16} {:>10.1f} {:>10.1f} {:>10.1f} {:>8}'.format(
+            hook,
+            result['import'] * 1000,
+            result['dispatch'] * 1000,
+            result['total'] * 1000,
+            result['modules']))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            slower = regressions(results, json.load(f), args.tolerance)
+        if slower:
+            print("Slower than the baseline: {}".format(', '.join(slower)))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
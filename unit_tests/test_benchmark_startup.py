@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+
+import importlib.util
+import json
+import os
+import tempfile
+import unittest
+import sys
+
+sys.path.append('lib')  # noqa
+sys.path.append('src')  # noqa
+sys.path.append('tools')  # noqa
+
+import benchmark_startup
+
+# The charm's requirements, which test_main runs the charm with.
+CHARM_MODULES = [
+    'ops',
+    'ops_openstack',
+    'charmhelpers',
+    'interface_ceph_client',
+    'interface_tls_certificates',
+    'cryptography']
+MISSING_MODULES = [
+    m for m in CHARM_MODULES if importlib.util.find_spec(m) is None]
+
+
+class TestBenchmarkStartup(unittest.TestCase):
+
+    def test_regressions(self):
+        baseline = {
+            'update-status': {'total': 0.5},
+            'config-changed': {'total': 1.0}}
+        results = {
+            'update-status': {'total': 0.61},
+            'config-changed': {'total': 1.1},
+            'leader-elected': {'total': 2.0}}
+        self.assertEqual(
+            benchmark_startup.regressions(results, baseline, 0.2),
+            ['update-status'])
+
+    @unittest.skipIf(
+        MISSING_MODULES,
+        "charm requirements not installed: {}".format(
+            ', '.join(MISSING_MODULES)))
+    def test_main(self):
+        # Runs the charm for real, so it needs the charm's requirements.
+        with tempfile.TemporaryDirectory() as tmpdir:
+            output = os.path.join(tmpdir, 'startup.json')
+            self.assertEqual(
+                benchmark_startup.main([
+                    '--runs', '1',
+                    '--hook', 'update-status',
+                    '--output', output]),
+                0)
+            with open(output) as f:
+                results = json.load(f)
+            self.assertEqual(list(results), ['update-status'])
+            self.assertGreater(results['update-status']['total'], 0)
+            self.assertEqual(
+                benchmark_startup.main([
+                    '--runs', '1',
+                    '--hook', 'update-status',
+                    '--baseline', output,
+                    '--tolerance', '100']),
+                0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -14,8 +14,10 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import configparser
 import os
 import json
+import tempfile
 import unittest
 import sys
 from pathlib import Path
@@ -23,6 +25,7 @@ from pathlib import Path
 sys.path.append('lib')  # noqa
 sys.path.append('src')  # noqa
 
+import jinja2
 from mock import call, patch, MagicMock, ANY
 
 from ops.testing import Harness, _TestingModelBackend
@@ -192,6 +195,8 @@ class TestCephISCSIGatewayCharmBase(CharmTestCase):
     def test_on_create_target_action(self, _getfqdn):
         _getfqdn.return_value = 'ceph-iscsi-0.example'
         self.add_cluster_relation()
+        self.harness.update_config(
+            key_values={'provisioning-concurrency': 2})
         self.harness.begin()
         action_event = MagicMock()
         action_event.params = {
@@ -207,11 +212,11 @@ class TestCephISCSIGatewayCharmBase(CharmTestCase):
         self.gwc.add_gateway_to_target.assert_has_calls([
             call(
                 'iqn.mock.iscsi-gw:iscsi-igw',
-                '10.0.0.10',
+                ['10.0.0.10'],
                 'ceph-iscsi-0.example'),
             call(
                 'iqn.mock.iscsi-gw:iscsi-igw',
-                '10.0.0.2',
+                ['10.0.0.2'],
                 'ceph-iscsi-1.example')])
 
         self.gwc.create_pool.assert_called_once_with(
@@ -232,6 +237,358 @@ class TestCephISCSIGatewayCharmBase(CharmTestCase):
             'iscsi-pool',
             'disk1')
 
+    @patch('socket.getfqdn')
+    def test_on_create_target_action_controls(self, _getfqdn):
+        _getfqdn.return_value = 'ceph-iscsi-0.example'
+        self.gwcli_client.DISK_CONTROLS = ('hw_max_sectors',
+                                           'max_data_area_mb')
+        self.gwcli_client.TARGET_CONTROLS = ('cmdsn_depth',)
+        self.add_cluster_relation()
+        self.harness.update_config(
+            key_values={'provisioning-concurrency': 2})
+        self.harness.begin()
+        action_event = MagicMock()
+        action_event.params = {
+            'iqn': 'iqn.mock.iscsi-gw:iscsi-igw',
+            'pool-name': 'iscsi-pool',
+            'image-name': 'disk1',
+            'image-size': '5G',
+            'client-initiatorname': 'client-initiator',
+            'client-username': 'myusername',
+            'client-password': 'mypassword',
+            'max-data-area-mb': 64,
+            'cmdsn-depth': 512}
+        self.harness.charm.on_create_target_action(action_event)
+        self.gwc.create_pool.assert_called_once_with(
+            'iscsi-pool',
+            'disk1',
+            '5G',
+            {'max_data_area_mb': 64})
+        self.gwc.reconfigure_target.assert_called_once_with(
+            'iqn.mock.iscsi-gw:iscsi-igw',
+            {'cmdsn_depth': 512})
+        self.gwc.add_disk_to_client.assert_called_once_with(
+            'iqn.mock.iscsi-gw:iscsi-igw',
+            'client-initiator',
+            'iscsi-pool',
+            'disk1')
+
+    @patch.object(charm, 'rbd_client')
+    @patch('socket.getfqdn')
+    def test_on_create_target_action_clone(self, _getfqdn, _rbd_client):
+        _getfqdn.return_value = 'ceph-iscsi-0.example'
+        rbd = _rbd_client.RBDClient.return_value
+        self.add_cluster_relation()
+        self.harness.update_config(
+            key_values={'provisioning-concurrency': 2})
+        self.harness.begin()
+        action_event = MagicMock()
+        action_event.params = {
+            'iqn': 'iqn.mock.iscsi-gw:iscsi-igw',
+            'pool-name': 'iscsi-pool',
+            'image-name': 'vdi1',
+            'source-snapshot': 'iscsi-pool/golden@base',
+            'flatten': True,
+            'client-initiatorname': 'client-initiator',
+            'client-username': 'myusername',
+            'client-password': 'mypassword'}
+        self.harness.charm.on_create_target_action(action_event)
+        _rbd_client.RBDClient.assert_called_once_with(
+            conf='/etc/ceph/iscsi/ceph.conf')
+        rbd.clone_image.assert_called_once_with(
+            'iscsi-pool/golden@base',
+            'iscsi-pool',
+            'vdi1',
+            None)
+        self.gwc.register_disk.assert_called_once_with(
+            'iscsi-pool',
+            'vdi1',
+            None)
+        rbd.flatten_image.assert_called_once_with('iscsi-pool', 'vdi1')
+        self.gwc.create_pool.assert_not_called()
+        self.gwc.add_disk_to_client.assert_called_once_with(
+            'iqn.mock.iscsi-gw:iscsi-igw',
+            'client-initiator',
+            'iscsi-pool',
+            'vdi1')
+        action_event.fail.assert_not_called()
+
+    @patch.object(charm, 'rbd_client')
+    @patch('socket.getfqdn')
+    def test_on_create_target_action_data_pool(self, _getfqdn, _rbd_client):
+        _getfqdn.return_value = 'ceph-iscsi-0.example'
+        rbd = _rbd_client.RBDClient.return_value
+        self.add_cluster_relation()
+        self.harness.update_config(key_values={
+            'provisioning-concurrency': 2,
+            'rbd-metadata-pool': 'iscsi-pool',
+            'pool-type': 'erasure-coded'})
+        self.harness.begin()
+        action_event = MagicMock()
+        action_event.params = {
+            'iqn': 'iqn.mock.iscsi-gw:iscsi-igw',
+            'pool-name': 'iscsi-pool',
+            'image-name': 'disk1',
+            'image-size': '2T',
+            'client-initiatorname': 'client-initiator',
+            'client-username': 'myusername',
+            'client-password': 'mypassword'}
+        self.harness.charm.on_create_target_action(action_event)
+        rbd.create_image.assert_called_once_with(
+            'iscsi-pool',
+            'disk1',
+            '2T',
+            'iscsi-pool-ec')
+        self.gwc.register_disk.assert_called_once_with(
+            'iscsi-pool',
+            'disk1',
+            None)
+        self.gwc.create_pool.assert_not_called()
+        action_event.fail.assert_not_called()
+
+    @patch.object(charm, 'rbd_client')
+    @patch('socket.getfqdn')
+    def test_on_set_qos_action(self, _getfqdn, _rbd_client):
+        _getfqdn.return_value = 'ceph-iscsi-0.example'
+        _rbd_client.parse_qos.side_effect = lambda qos: qos
+        _rbd_client.QOS_SETTINGS = ('iops_limit', 'bps_limit')
+        rbd = _rbd_client.RBDClient.return_value
+        rbd.get_image_qos.return_value = {'iops_limit': 500}
+        self.add_cluster_relation()
+        self.harness.update_config(
+            key_values={'provisioning-concurrency': 2})
+        self.harness.begin()
+        self.gwc.inventory.config = {
+            'disks': {
+                'iscsi-pool/disk1': {},
+                'iscsi-pool/disk2': {},
+                'iscsi-pool/vdi1': {}},
+            'targets': {'iqn.mock.iscsi-gw:iscsi-igw': {}}}
+        self.gwc.inventory.client_disks.return_value = ['iscsi-pool/vdi1']
+        action_event = MagicMock()
+        action_event.params = {
+            'disks': 'iscsi-pool/disk1',
+            'clients': 'client-initiator',
+            'iops-limit': 500}
+        self.harness.charm.on_set_qos_action(action_event)
+        self.gwc.inventory.client_disks.assert_called_once_with(
+            'iqn.mock.iscsi-gw:iscsi-igw',
+            'client-initiator')
+        rbd.set_image_qos.assert_has_calls([
+            call('iscsi-pool', 'disk1', {'iops_limit': 500}),
+            call('iscsi-pool', 'vdi1', {'iops_limit': 500})],
+            any_order=True)
+        self.assertEqual(rbd.set_image_qos.call_count, 2)
+        action_event.fail.assert_not_called()
+        results = json.loads(
+            action_event.set_results.call_args[0][0]['results'])
+        self.assertEqual(
+            [(r['disk'], r['qos']) for r in results],
+            [
+                ('iscsi-pool/disk1', {'iops_limit': 500}),
+                ('iscsi-pool/vdi1', {'iops_limit': 500})])
+
+    @patch.object(charm.CephISCSIGatewayCharmBase, 'read_lun_sizes')
+    @patch.object(charm, 'rbd_client')
+    @patch('socket.getfqdn')
+    def test_on_resize_disks_action(self, _getfqdn, _rbd_client,
+                                    _read_lun_sizes):
+        _getfqdn.return_value = 'ceph-iscsi-0.example'
+        gib = 2 ** 30
+        rbd = _rbd_client.RBDClient.return_value
+        self.gwcli_client.size_bytes.side_effect = lambda size: 40 * gib
+        self.add_cluster_relation()
+        self.harness.update_config(
+            key_values={'provisioning-concurrency': 2})
+        self.harness.begin()
+        self.gwc.inventory.config = {
+            'disks': {
+                'iscsi-pool/vdi1': {},
+                'iscsi-pool/vdi2': {},
+                'iscsi-pool/disk1': {}}}
+        rbd.image_size.return_value = 10 * gib
+        _read_lun_sizes.return_value = {
+            'iscsi-pool/vdi1': 40 * gib,
+            'iscsi-pool/vdi2': 40 * gib}
+        action_event = MagicMock()
+        action_event.params = {'disks': 'iscsi-pool/vdi*', 'size': '40G'}
+        self.harness.charm.on_resize_disks_action(action_event)
+        self.assertEqual(
+            sorted(c[0] for c in rbd.image_size.call_args_list),
+            [('iscsi-pool', 'vdi1'), ('iscsi-pool', 'vdi2')])
+        self.assertEqual(
+            sorted(c[0] for c in self.gwc.resize_disk.call_args_list),
+            [('iscsi-pool', 'vdi1', '40G'), ('iscsi-pool', 'vdi2', '40G')])
+        # Each gateway is read once, not once per disk.
+        self.assertEqual(
+            sorted(c[0][0] for c in _read_lun_sizes.call_args_list),
+            ['10.0.0.10', '10.0.0.2'])
+        results = json.loads(
+            action_event.set_results.call_args[0][0]['results'])
+        self.assertEqual(
+            [(r['disk'], r['status']) for r in results],
+            [('iscsi-pool/vdi1', 'done'), ('iscsi-pool/vdi2', 'done')])
+        action_event.fail.assert_not_called()
+
+        # A gateway that still exports the old size fails the disk.
+        _read_lun_sizes.side_effect = lambda address: {
+            'iscsi-pool/vdi1': 10 * gib if address == '10.0.0.2' else 40 * gib}
+        action_event = MagicMock()
+        action_event.params = {'disks': 'iscsi-pool/vdi1', 'size': '40G'}
+        self.harness.charm.on_resize_disks_action(action_event)
+        action_event.fail.assert_called_once_with(
+            "1 of 1 disks failed to resize")
+
+    @patch.object(charm, 'rbd_client')
+    @patch('socket.getfqdn')
+    def test_export_import_config(self, _getfqdn, _rbd_client):
+        _getfqdn.return_value = 'ceph-iscsi-0.example'
+        rbd = _rbd_client.RBDClient.return_value
+        rbd.get_image_qos.return_value = {'iops_burst': 1000}
+        self.add_cluster_relation()
+        self.harness.update_config(
+            key_values={'provisioning-concurrency': 2})
+        self.harness.begin()
+        config = {
+            'epoch': 3,
+            'disks': {'iscsi-pool/disk1': {}},
+            'targets': {
+                'iqn.mock.iscsi-gw:iscsi-igw': {
+                    'portals': {'ceph-iscsi-0.example': {}},
+                    'disks': {'iscsi-pool/disk1': {'lun_id': 0}},
+                    'groups': {'cluster': {}},
+                    'clients': {
+                        'client-initiator': {
+                            # Encrypted by ceph-iscsi, read back decrypted.
+                            'auth': {
+                                'username': 'myusername',
+                                'password': 'mypassword',
+                                'mutual_username': 'mytarget',
+                                'mutual_password': 'mytargetpassword',
+                                'password_encryption_enabled': True},
+                            'luns': {'iscsi-pool/disk1': {'lun_id': 0}}}}}}}
+        self.gwc.inventory.config = config
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        path = str(Path(tmpdir.name) / 'export.json.gz')
+        action_event = MagicMock()
+        action_event.params = {'path': path}
+        self.harness.charm.on_export_config_action(action_event)
+        action_event.fail.assert_not_called()
+        results = action_event.set_results.call_args[0][0]
+        self.assertEqual(results['path'], path)
+        self.assertEqual(
+            (results['disks'], results['targets'], results['luns']),
+            (1, 1, 1))
+        self.assertEqual(
+            json.loads(results['not-exported']),
+            ['iqn.mock.iscsi-gw:iscsi-igw host group cluster'])
+        rbd.get_image_qos.assert_called_once_with(
+            'iscsi-pool',
+            'disk1',
+            True)
+        self.assertEqual(Path(path).stat().st_mode & 0o777, 0o600)
+
+        # Restore onto a gateway that lost its configuration.
+        self.gwc.inventory.config = {}
+        action_event = MagicMock()
+        action_event.params = {'path': path, 'dry-run': False}
+        self.harness.charm.on_import_config_action(action_event)
+        action_event.fail.assert_not_called()
+        self.gwc.register_disk.assert_called_once_with(
+            'iscsi-pool',
+            'disk1',
+            None)
+        self.gwc.create_pool.assert_not_called()
+        self.gwc.add_client_lun.assert_called_once_with(
+            'iqn.mock.iscsi-gw:iscsi-igw',
+            'client-initiator',
+            'iscsi-pool',
+            'disk1')
+        self.gwc.add_client_auth.assert_called_once_with(
+            'iqn.mock.iscsi-gw:iscsi-igw',
+            'client-initiator',
+            'myusername',
+            'mypassword',
+            'mytarget',
+            'mytargetpassword')
+        rbd.set_image_qos.assert_called_once_with(
+            'iscsi-pool',
+            'disk1',
+            {'iops_burst': 1000})
+        results = action_event.set_results.call_args[0][0]
+        self.assertEqual(json.loads(results['counts']), {'done': 8})
+        self.assertEqual(json.loads(results['problems']), [])
+
+        # Truncated, corrupt or non UTF-8 files fail the action.
+        content = Path(path).read_bytes()
+        for bad in (content[:len(content) // 2],
+                    content[:10] + b'\0' * (len(content) - 10),
+                    b'\xff\xfe not utf-8'):
+            Path(path).write_bytes(bad)
+            action_event = MagicMock()
+            action_event.params = {'path': path, 'dry-run': False}
+            self.harness.charm.on_import_config_action(action_event)
+            action_event.fail.assert_called_once_with(ANY)
+            self.assertTrue(
+                action_event.fail.call_args[0][0].startswith(
+                    'Unable to read {}: '.format(path)))
+
+    @patch('socket.getfqdn')
+    def test_on_apply_manifest_action(self, _getfqdn):
+        _getfqdn.return_value = 'ceph-iscsi-0.example'
+        self.add_cluster_relation()
+        self.harness.update_config(
+            key_values={'provisioning-concurrency': 2})
+        self.harness.begin()
+        self.gwc.inventory.config = {
+            'disks': {'iscsi-pool/disk1': {}},
+            'targets': {
+                'iqn.mock.iscsi-gw:iscsi-igw': {
+                    'portals': {
+                        'ceph-iscsi-0.example': {},
+                        'ceph-iscsi-1.example': {}},
+                    'disks': {'iscsi-pool/disk1': {'lun_id': 0}},
+                    'clients': {}}}}
+        action_event = MagicMock()
+        action_event.params = {
+            'manifest': json.dumps({
+                'disks': [
+                    {'pool': 'iscsi-pool', 'image': 'disk1', 'size': '5G'}],
+                'targets': [{
+                    'iqn': 'iqn.mock.iscsi-gw:iscsi-igw',
+                    'hosts': [{
+                        'initiator': 'client-initiator',
+                        'username': 'myusername',
+                        'password': 'mypassword',
+                        'disks': ['iscsi-pool/disk1']}]}]}),
+            'dry-run': False}
+        self.harness.charm.on_apply_manifest_action(action_event)
+        self.gwc.create_pool.assert_not_called()
+        self.gwc.create_target.assert_not_called()
+        self.gwc.add_gateway_to_target.assert_not_called()
+        self.gwc.add_client_to_target.assert_called_once_with(
+            'iqn.mock.iscsi-gw:iscsi-igw',
+            'client-initiator')
+        self.gwc.add_client_auth.assert_called_once_with(
+            'iqn.mock.iscsi-gw:iscsi-igw',
+            'client-initiator',
+            'myusername',
+            'mypassword',
+            '',
+            '')
+        self.gwc.add_client_lun.assert_called_once_with(
+            'iqn.mock.iscsi-gw:iscsi-igw',
+            'client-initiator',
+            'iscsi-pool',
+            'disk1')
+        action_event.fail.assert_not_called()
+        results = json.loads(
+            action_event.set_results.call_args[0][0]['results'])
+        self.assertEqual(
+            [r['operation'] for r in results],
+            ['add_client_to_target', 'add_client_auth', 'add_client_lun'])
+
     @patch.object(charm.secrets, 'choice')
     def test_on_has_peers(self, _choice):
         rel_id = self.harness.add_relation('cluster', 'ceph-iscsi')
@@ -298,7 +655,7 @@ class TestCephISCSIGatewayCharmBase(CharmTestCase):
         self.assertEqual(
             req_pool['ops'],
             [{
-                'app-name': None,
+                'app-name': 'rbd',
                 'group': None,
                 'group-namespace': None,
                 'max-bytes': None,
@@ -319,7 +676,104 @@ class TestCephISCSIGatewayCharmBase(CharmTestCase):
                         'mgr',
                         'allow r']}])
 
-    def test_on_pools_available(self):
+    def test_on_ceph_client_relation_joined_erasure_coded(self):
+        # Goes through the real ceph-client interface, so a change to its
+        # request and send path fails here rather than in a deployment.
+        rel_id = self.harness.add_relation('ceph-client', 'ceph-mon')
+        self.harness.update_config(key_values={
+            'rbd-metadata-pool': 'iscsi-pool',
+            'pool-type': 'erasure-coded',
+            'ec-profile-k': 4,
+            'ec-profile-m': 2,
+            'ec-profile-plugin': 'jerasure'})
+        self.harness.begin()
+        self.harness.add_relation_unit(
+            rel_id,
+            'ceph-mon/0')
+        self.harness.update_relation_data(
+            rel_id,
+            'ceph-mon/0',
+            {'ingress-address': '10.0.0.3'})
+        rel_data = self.harness.get_relation_data(rel_id, 'ceph-iscsi/0')
+        ops = json.loads(rel_data['broker_req'])['ops']
+        self.assertEqual(
+            [(op['op'], op.get('name')) for op in ops],
+            [
+                ('create-pool', 'iscsi-pool'),
+                ('create-erasure-profile', 'iscsi-pool-ec-profile'),
+                ('create-pool', 'iscsi-pool-ec'),
+                ('set-key-permissions', None)])
+        profile = ops[1]
+        self.assertEqual(
+            (profile['erasure-type'], profile['k'], profile['m']),
+            ('jerasure', 4, 2))
+        pool = ops[2]
+        self.assertEqual(
+            (pool['pool-type'], pool['erasure-profile'],
+             pool['allow-ec-overwrites']),
+            ('erasure', 'iscsi-pool-ec-profile', True))
+
+    def test_request_ceph_pool_unchanged(self):
+        self.harness.update_config(
+            key_values={'rbd-metadata-pool': 'iscsi-pool'})
+        self.harness.begin()
+        ceph_client = MagicMock()
+        self.harness.charm.ceph_client = ceph_client
+        self.harness.charm.request_ceph_pool(None)
+        self.harness.charm.request_ceph_pool(None)
+        ceph_client.create_replicated_pool.assert_called_once_with(
+            'iscsi-pool')
+        ceph_client.request_ceph_permissions.assert_called_once_with(
+            'ceph-iscsi',
+            self.harness.charm.CEPH_CAPABILITIES)
+        ceph_client.request_osd_settings.assert_called_once_with(
+            {'osd heartbeat grace': 20, 'osd heartbeat interval': 5})
+        self.harness.update_config(
+            key_values={'rbd-metadata-pool': 'iscsi-pool2'})
+        self.harness.charm.request_ceph_pool(None)
+        ceph_client.create_replicated_pool.assert_called_with('iscsi-pool2')
+
+    def test_request_ceph_pool_erasure_coded(self):
+        self.harness.add_relation('ceph-client', 'ceph-mon')
+        self.harness.update_config(key_values={
+            'rbd-metadata-pool': 'iscsi-pool',
+            'pool-type': 'erasure-coded',
+            'ec-profile-k': 4,
+            'ec-profile-m': 2,
+            'ec-profile-plugin': 'jerasure'})
+        self.harness.begin()
+        ceph_client = MagicMock()
+        self.harness.charm.ceph_client = ceph_client
+        self.harness.charm.request_ceph_pool(None)
+        ceph_client.create_replicated_pool.assert_called_once_with(
+            'iscsi-pool')
+        # The interface has no erasure code methods, the ops go through
+        # its broker request.
+        request = ceph_client.get_existing_request.return_value
+        ops = [c[0][0] for c in request.add_op.call_args_list]
+        self.assertEqual(
+            [(op['op'], op['name']) for op in ops],
+            [
+                ('create-erasure-profile', 'iscsi-pool-ec-profile'),
+                ('create-pool', 'iscsi-pool-ec')])
+        self.assertEqual(
+            (ops[0]['erasure-type'], ops[0]['k'], ops[0]['m'],
+             ops[0]['device-class']),
+            ('jerasure', 4, 2, None))
+        self.assertEqual(
+            (ops[1]['pool-type'], ops[1]['erasure-profile'],
+             ops[1]['allow-ec-overwrites']),
+            ('erasure', 'iscsi-pool-ec-profile', True))
+        self.assertEqual(ceph_client.send_request_if_needed.call_count, 2)
+
+    @patch.object(charm.CephISCSIGatewayCharmBase, 'render_exporter')
+    @patch.object(charm.ch_host, 'service_restart')
+    @patch.object(charm.ch_host, 'write_file')
+    @patch.object(charm.ch_host, 'file_hash')
+    def test_on_pools_available(self, _file_hash, _write_file,
+                                _service_restart, _render_exporter):
+        _file_hash.return_value = None
+        self.ch_templating.render.return_value = 'rendered'
         self.os.path.exists.return_value = False
         self.os.path.basename = os.path.basename
         rel_id = self.add_cluster_relation()
@@ -332,17 +786,255 @@ class TestCephISCSIGatewayCharmBase(CharmTestCase):
         self.harness.charm.ceph_client.state.pools_available = True
         with patch.object(Path, 'mkdir') as mock_mkdir:
             self.harness.charm.ceph_client.on.pools_available.emit()
+            self.harness.charm.on.config_changed.emit()
+            # Rendering waits until the hook's events are all handled.
+            self.ch_templating.render.assert_not_called()
+            self.assertTrue(self.harness.charm.state.config_dirty)
+            self.harness.framework.on.pre_commit.emit()
             mock_mkdir.assert_called_once_with(exist_ok=True, mode=488)
+        self.assertFalse(self.harness.charm.state.config_dirty)
+        self.assertEqual(self.ch_templating.render.call_count, 3)
         self.ch_templating.render.assert_has_calls([
-            call('ceph.conf', '/etc/ceph/iscsi/ceph.conf', ANY),
-            call('iscsi-gateway.cfg', '/etc/ceph/iscsi-gateway.cfg', ANY),
+            call('ceph.conf', None, ANY),
+            call('iscsi-gateway.cfg', None, ANY),
+            call('ceph.client.ceph-iscsi.keyring', None, ANY)],
+            any_order=True)
+        _write_file.assert_has_calls([
+            call('/etc/ceph/iscsi/ceph.conf', b'rendered', perms=0o444),
+            call('/etc/ceph/iscsi-gateway.cfg', b'rendered', perms=0o444),
             call(
-                'ceph.client.ceph-iscsi.keyring',
-                '/etc/ceph/iscsi/ceph.client.ceph-iscsi.keyring', ANY)],
+                '/etc/ceph/iscsi/ceph.client.ceph-iscsi.keyring',
+                b'rendered',
+                perms=0o444)],
             any_order=True)
+        # The restart waits for the restart token from the leader.
+        _service_restart.assert_not_called()
+        self.assertEqual(
+            list(self.harness.charm.state.pending_restarts),
+            ['rbd-target-api', 'rbd-target-gw'])
         self.assertTrue(self.harness.charm.state.is_started)
         rel_data = self.harness.get_relation_data(rel_id, 'ceph-iscsi/0')
         self.assertEqual(rel_data['gateway_ready'], 'True')
+        self.assertIn('restart_request', rel_data)
+        _render_exporter.assert_called_once_with()
+
+    def test_reconcile_waits_for_prerequisites(self):
+        self.harness.begin()
+        self.harness.charm.render_configs = MagicMock()
+        self.harness.charm.on.config_changed.emit()
+        self.harness.charm.on.upgrade_charm.emit()
+        self.harness.framework.on.pre_commit.emit()
+        self.harness.charm.render_configs.assert_not_called()
+        self.assertTrue(self.harness.charm.state.config_dirty)
+
+    @patch.object(charm.ch_host, 'service_restart')
+    @patch.object(charm.ch_host, 'write_file')
+    @patch.object(charm.ch_host, 'file_hash')
+    def test_render_exporter(self, _file_hash, _write_file,
+                             _service_restart):
+        self.ch_templating.render.return_value = 'unit file'
+        _file_hash.return_value = None
+        self.harness.begin()
+        with patch.object(Path, 'mkdir'):
+            self.harness.charm.render_exporter()
+        _write_file.assert_has_calls([
+            call(
+                '/usr/local/lib/ceph-iscsi-exporter/lio_exporter.py',
+                ANY,
+                perms=0o644),
+            call(
+                '/usr/local/lib/ceph-iscsi-exporter/lio_stats.py',
+                ANY,
+                perms=0o644),
+            call(
+                '/etc/systemd/system/ceph-iscsi-exporter.service',
+                b'unit file',
+                perms=0o644)])
+        self.subprocess.check_call.assert_has_calls([
+            call(['systemctl', 'daemon-reload']),
+            call(['systemctl', 'enable', 'ceph-iscsi-exporter'])])
+        _service_restart.assert_called_once_with('ceph-iscsi-exporter')
+
+        # Nothing changed, nothing to restart.
+        _write_file.reset_mock()
+        _service_restart.reset_mock()
+        written = {
+            '/usr/local/lib/ceph-iscsi-exporter/lio_exporter.py':
+                Path('src/lio_exporter.py').read_bytes(),
+            '/usr/local/lib/ceph-iscsi-exporter/lio_stats.py':
+                Path('src/lio_stats.py').read_bytes(),
+            '/etc/systemd/system/ceph-iscsi-exporter.service': b'unit file'}
+        _file_hash.side_effect = lambda path, hash_type: (
+            charm.hashlib.sha256(written[path]).hexdigest())
+        self.harness.charm.render_exporter()
+        _write_file.assert_not_called()
+        _service_restart.assert_not_called()
+
+    def test_portal_addresses(self):
+        self.add_cluster_relation()
+        self.harness.begin()
+        self.assertEqual(self.harness.charm.portal_addresses, ['10.0.0.10'])
+
+    def test_metrics_endpoint(self):
+        self.harness.update_config(key_values={'metrics-port': 9288})
+        self.harness.begin()
+        rel_id = self.harness.add_relation('prometheus', 'prometheus2')
+        self.harness.add_relation_unit(rel_id, 'prometheus2/0')
+        self.assertEqual(
+            self.harness.get_relation_data(rel_id, 'ceph-iscsi/0'),
+            {'hostname': '10.0.0.10', 'port': '9288'})
+
+    @patch.object(charm.CephISCSIGatewayCharmBase, 'wait_for_gateway')
+    @patch.object(charm.ch_host, 'service_restart')
+    def test_on_restart_granted(self, _service_restart, _wait_for_gateway):
+        rel_id = self.add_cluster_relation()
+        self.harness.begin()
+        self.harness.set_leader()
+        self.harness.charm.restart_services({'rbd-target-api'})
+        _service_restart.assert_called_once_with('rbd-target-api')
+        _wait_for_gateway.assert_called_once_with()
+        self.assertEqual(
+            list(self.harness.charm.state.pending_restarts),
+            [])
+        rel_data = self.harness.get_relation_data(rel_id, 'ceph-iscsi/0')
+        self.assertEqual(
+            rel_data['restart_request'],
+            rel_data['restart_released'])
+
+    @patch.object(charm.daemon_tuning, 'interface_numa_node')
+    @patch.object(charm.ch_host, 'write_file')
+    @patch.object(charm.ch_host, 'file_hash')
+    def test_render_tuning(self, _file_hash, _write_file,
+                           _interface_numa_node):
+        _file_hash.return_value = None
+        _interface_numa_node.return_value = 1
+        self.ch_templating.render.return_value = 'drop-in'
+        self.harness.update_config(key_values={
+            'daemon-numa-policy': 'preferred',
+            'daemon-nice': -5})
+        self.harness.begin()
+        with patch.object(Path, 'mkdir'):
+            services = self.harness.charm.render_tuning()
+        self.assertEqual(
+            services,
+            {'tcmu-runner', 'rbd-target-gw', 'rbd-target-api'})
+        _interface_numa_node.assert_called_once_with('eth0')
+        self.ch_templating.render.assert_called_once_with(
+            'daemon-tuning.conf',
+            None,
+            {'settings': [
+                ('NUMAPolicy', 'preferred'),
+                ('NUMAMask', '1'),
+                ('Nice', '-5')]})
+        _write_file.assert_any_call(
+            '/etc/systemd/system/tcmu-runner.service.d/daemon-tuning.conf',
+            b'drop-in',
+            perms=0o644)
+        self.subprocess.check_call.assert_called_once_with(
+            ['systemctl', 'daemon-reload'])
+
+    @patch.object(charm.CephISCSIGatewayCharmBase, 'render_exporter')
+    @patch.object(charm.ch_host, 'write_file')
+    @patch.object(charm.ch_host, 'file_hash')
+    def test_daemon_option_restarts_tcmu_runner(self, _file_hash,
+                                                _write_file,
+                                                _render_exporter):
+        _file_hash.return_value = None
+        self.ch_templating.render.return_value = 'drop-in'
+        rel_id = self.add_cluster_relation()
+        self.harness.update_relation_data(
+            rel_id,
+            'ceph-iscsi',
+            {'admin_password': 'existing password'})
+        self.harness.begin()
+        # pause and resume manage every service in RESTART_MAP.
+        services = set(
+            s for v in self.harness.charm.RESTART_MAP.values() for s in v)
+        self.assertIn('tcmu-runner', services)
+        self.assertIn('ceph-iscsi-exporter', services)
+        self.harness.charm.ceph_client.state.pools_available = True
+        self.harness.charm.render_configs = MagicMock(return_value=set())
+        self.harness.update_config(key_values={'daemon-nice': -5})
+        with patch.object(Path, 'mkdir'):
+            self.harness.framework.on.pre_commit.emit()
+        self.assertEqual(
+            list(self.harness.charm.state.pending_restarts),
+            ['rbd-target-api', 'rbd-target-gw', 'tcmu-runner'])
+        _write_file.assert_any_call(
+            '/etc/systemd/system/tcmu-runner.service.d/daemon-tuning.conf',
+            b'drop-in',
+            perms=0o644)
+
+    @patch.object(charm.CephISCSIGatewayCharmBase, 'wait_for_gateway')
+    @patch.object(charm.ch_host, 'service_restart')
+    def test_restart_order(self, _service_restart, _wait_for_gateway):
+        self.harness.begin()
+        self.harness.charm.restart_services(
+            {'rbd-target-api', 'rbd-target-gw', 'tcmu-runner'})
+        self.assertEqual(_service_restart.call_args_list, [
+            call('tcmu-runner'),
+            call('rbd-target-gw'),
+            call('rbd-target-api')])
+
+    @patch.object(charm.ch_host, 'write_file')
+    @patch.object(charm.ch_host, 'file_hash')
+    def test_render_configs_scoped_restart(self, _file_hash, _write_file):
+        old_gw_conf = (
+            '[config]\n'
+            'pool = iscsi\n'
+            'trusted_ip_list = 10.0.0.10 10.0.0.2\n')
+        new_gw_conf = (
+            '[config]\n'
+            'pool = iscsi\n'
+            'trusted_ip_list = 10.0.0.10 10.0.0.2 10.0.0.5\n')
+        rendered = {
+            'ceph.conf': 'ceph conf',
+            'iscsi-gateway.cfg': new_gw_conf,
+            'ceph.client.ceph-iscsi.keyring': 'keyring'}
+        self.os.path.basename = os.path.basename
+        self.ch_templating.render.side_effect = (
+            lambda source, target, context: rendered[source])
+        hashes = {
+            '/etc/ceph/iscsi/ceph.conf': charm.hashlib.sha256(
+                b'ceph conf').hexdigest(),
+            '/etc/ceph/iscsi-gateway.cfg': 'old',
+            '/etc/ceph/iscsi/ceph.client.ceph-iscsi.keyring':
+                charm.hashlib.sha256(b'keyring').hexdigest()}
+        _file_hash.side_effect = lambda path, hash_type: hashes[path]
+        self.harness.begin()
+        with patch.object(Path, 'read_text') as mock_read_text:
+            mock_read_text.return_value = old_gw_conf
+            services = self.harness.charm.render_configs()
+        self.assertEqual(services, {'rbd-target-api'})
+        _write_file.assert_called_once_with(
+            '/etc/ceph/iscsi-gateway.cfg',
+            new_gw_conf.encode(),
+            perms=0o444)
+
+    def test_gw_conf_target_defaults(self):
+        env = jinja2.Environment(loader=jinja2.FileSystemLoader('templates'))
+        content = env.get_template('iscsi-gateway.cfg').render(
+            options={
+                'rbd_metadata_pool': 'iscsi',
+                'max_data_area_mb': 64,
+                'cmdsn_depth': 512},
+            certificates={'enable_tls': False},
+            cluster={
+                'admin_password': 'secret',
+                'trusted_ip_list': '10.0.0.10'})
+        parser = configparser.ConfigParser(interpolation=None)
+        parser.read_string(content)
+        # ceph-iscsi only reads the disk and target defaults from [target].
+        self.assertEqual(
+            dict(parser['target']),
+            {'max_data_area_mb': '64', 'cmdsn_depth': '512'})
+        self.assertNotIn('max_data_area_mb', parser['config'])
+        self.harness.begin()
+        self.assertEqual(
+            self.harness.charm._gw_conf_services(
+                content,
+                content.replace('cmdsn_depth = 512', 'cmdsn_depth = 256')),
+            {'rbd-target-api'})
 
     @patch('socket.gethostname')
     def test_on_certificates_relation_joined(self, _gethostname):
@@ -361,23 +1053,19 @@ class TestCephISCSIGatewayCharmBase(CharmTestCase):
             rel_data['application_cert_requests'],
             '{"server1": {"sans": ["10.0.0.10", "server1"]}}')
 
-    @patch('socket.gethostname')
-    def test_on_certificates_relation_changed(self, _gethostname):
-        mock_TLS_CERT_PATH = MagicMock()
-        mock_TLS_CA_CERT_PATH = MagicMock()
-        mock_TLS_KEY_PATH = MagicMock()
-        mock_KEY_AND_CERT_PATH = MagicMock()
-        mock_TLS_PUB_KEY_PATH = MagicMock()
-        _gethostname.return_value = 'server1'
-        self.subprocess.check_output.return_value = b'pubkey'
-        rel_id = self.harness.add_relation('certificates', 'vault')
-        self.add_cluster_relation()
-        self.harness.begin()
-        self.harness.charm.TLS_CERT_PATH = mock_TLS_CERT_PATH
-        self.harness.charm.TLS_CA_CERT_PATH = mock_TLS_CA_CERT_PATH
-        self.harness.charm.TLS_KEY_PATH = mock_TLS_KEY_PATH
-        self.harness.charm.TLS_KEY_AND_CERT_PATH = mock_KEY_AND_CERT_PATH
-        self.harness.charm.TLS_PUB_KEY_PATH = mock_TLS_PUB_KEY_PATH
+    def use_tls_dir(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        tls_dir = Path(tmpdir.name)
+        for attr in ('TLS_CERT_PATH', 'TLS_CA_CERT_PATH', 'TLS_KEY_PATH',
+                     'TLS_KEY_AND_CERT_PATH', 'TLS_PUB_KEY_PATH'):
+            setattr(
+                self.harness.charm,
+                attr,
+                tls_dir / getattr(self.harness.charm, attr).name)
+        return tls_dir
+
+    def add_vault_certificates(self, rel_id):
         self.harness.add_relation_unit(
             rel_id,
             'vault/0')
@@ -392,14 +1080,87 @@ class TestCephISCSIGatewayCharmBase(CharmTestCase):
                 'ceph-iscsi_0.processed_application_requests': json.dumps(
                     rel_data),
                 'ca': TEST_CA})
-        mock_TLS_CERT_PATH.write_bytes.assert_called_once()
-        mock_TLS_CA_CERT_PATH.write_bytes.assert_called_once()
-        mock_TLS_KEY_PATH.write_bytes.assert_called_once()
-        mock_KEY_AND_CERT_PATH.write_bytes.assert_called_once()
-        mock_TLS_PUB_KEY_PATH.write_bytes.assert_called_once()
+
+    @patch('socket.gethostname')
+    def test_on_certificates_relation_changed(self, _gethostname):
+        _gethostname.return_value = 'server1'
+        self.subprocess.check_output.return_value = b'pubkey'
+        rel_id = self.harness.add_relation('certificates', 'vault')
+        self.add_cluster_relation()
+        self.harness.begin()
+        tls_dir = self.use_tls_dir()
+        self.add_vault_certificates(rel_id)
+        self.assertEqual(
+            sorted(p.name for p in tls_dir.iterdir()),
+            [
+                'iscsi-gateway-pub.key',
+                'iscsi-gateway.crt',
+                'iscsi-gateway.key',
+                'iscsi-gateway.pem',
+                'vault_ca_cert.crt'])
+        self.assertEqual(
+            (tls_dir / 'iscsi-gateway.crt').read_text(),
+            TEST_APP_CERT.strip() + '\n')
+        self.assertEqual(
+            (tls_dir / 'iscsi-gateway.key').stat().st_mode & 0o777,
+            0o600)
         self.subprocess.check_call.assert_called_once_with(
             ['update-ca-certificates'])
         self.assertTrue(self.harness.charm.state.enable_tls)
+        self.assertTrue(self.harness.charm.state.config_dirty)
+
+    def test_write_atomic(self):
+        self.harness.begin()
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        path = Path(tmpdir.name) / 'iscsi-gateway.key'
+        tmp = Path(tmpdir.name) / '.iscsi-gateway.key.tmp'
+        # Left behind by an interrupted write.
+        tmp.write_bytes(b'stale')
+        tmp.chmod(0o644)
+        modes = []
+        real_write_bytes = Path.write_bytes
+
+        def write_bytes(self, data):
+            modes.append(self.stat().st_mode & 0o777)
+            return real_write_bytes(self, data)
+
+        with patch.object(Path, 'write_bytes', write_bytes):
+            self.harness.charm._write_atomic(path, b'key', 0o600)
+        # The key is never readable by others, not even while written.
+        self.assertEqual(modes, [0o600])
+        self.assertEqual(path.read_bytes(), b'key')
+        self.assertEqual(path.stat().st_mode & 0o777, 0o600)
+        self.assertFalse(tmp.exists())
+        with patch.object(Path, 'write_bytes', side_effect=OSError('full')):
+            with self.assertRaises(OSError):
+                self.harness.charm._write_atomic(path, b'new key', 0o600)
+        self.assertEqual(path.read_bytes(), b'key')
+        self.assertFalse(tmp.exists())
+
+    @patch('socket.gethostname')
+    def test_on_tls_app_config_ready_unchanged(self, _gethostname):
+        _gethostname.return_value = 'server1'
+        rel_id = self.harness.add_relation('certificates', 'vault')
+        self.add_cluster_relation()
+        self.harness.begin()
+        self.use_tls_dir()
+        self.add_vault_certificates(rel_id)
+        self.harness.charm.state.config_dirty = False
+        self.subprocess.check_call.reset_mock()
+        self.harness.charm.restart_services = MagicMock()
+        # Same material again, nothing is written or restarted.
+        self.harness.charm.on_tls_app_config_ready(MagicMock())
+        self.subprocess.check_call.assert_not_called()
+        self.harness.charm.restart_services.assert_not_called()
+        self.assertFalse(self.harness.charm.state.config_dirty)
+        # A renewed certificate only restarts the API.
+        self.harness.charm.TLS_CERT_PATH.write_text('old cert')
+        self.harness.charm.on_tls_app_config_ready(MagicMock())
+        self.subprocess.check_call.assert_not_called()
+        self.harness.charm.restart_services.assert_called_once_with(
+            ['rbd-target-api'])
+        self.assertFalse(self.harness.charm.state.config_dirty)
 
     def test_custom_status_check(self):
         self.harness.add_relation('ceph-client', 'ceph-mon')
@@ -412,3 +1173,181 @@ class TestCephISCSIGatewayCharmBase(CharmTestCase):
         self.assertIsInstance(
             self.harness.charm.unit.status,
             BlockedStatus)
+
+    def test_custom_status_check_client_tuning(self):
+        self.harness.add_relation('ceph-client', 'ceph-mon')
+        self.add_cluster_relation()
+        self.harness.update_config(
+            key_values={'client-tuning-profile': 'fast'})
+        self.harness.begin()
+        self.harness.charm.on.update_status.emit()
+        self.assertIsInstance(
+            self.harness.charm.unit.status,
+            BlockedStatus)
+        self.assertTrue(
+            self.harness.charm.unit.status.message.startswith(
+                'Invalid client tuning: Unknown profile fast'))
+
+    def test_custom_status_check_concurrency(self):
+        self.harness.add_relation('ceph-client', 'ceph-mon')
+        self.add_cluster_relation()
+        self.harness.update_config(
+            key_values={'provisioning-concurrency': 0})
+        self.harness.begin()
+        self.harness.charm.on.update_status.emit()
+        self.assertIsInstance(
+            self.harness.charm.unit.status,
+            BlockedStatus)
+        self.assertEqual(
+            self.harness.charm.unit.status.message,
+            'provisioning-concurrency must be at least 1')
+
+    @patch.object(charm.time, 'sleep')
+    @patch.object(charm.time, 'monotonic')
+    @patch.object(charm.CephISCSIGatewayCharmBase, 'read_lun_counters')
+    def test_sample_lun_rates(self, _read_lun_counters, _monotonic, _sleep):
+        self.harness.begin()
+
+        def counters(cmds):
+            return {'iscsi-pool/disk1': {
+                'cmds': cmds, 'read_mb': 0, 'write_mb': 100}}
+
+        # Each gateway is read twice, its rates are taken over the time
+        # between its own two reads.
+        _read_lun_counters.side_effect = [
+            counters(0), counters(100),
+            counters(500), counters(1100)]
+        _monotonic.side_effect = [0.0, 1.0, 10.0, 11.0]
+        rates, failed = self.harness.charm.sample_lun_rates(
+            {'gw0': '10.0.0.10', 'gw1': '10.0.0.2'},
+            10)
+        _sleep.assert_called_once_with(10)
+        self.assertEqual(
+            [c[0][0] for c in _read_lun_counters.call_args_list],
+            ['10.0.0.10', '10.0.0.2', '10.0.0.10', '10.0.0.2'])
+        self.assertEqual(rates, {
+            'gw0': {'iscsi-pool/disk1': {'iops': 50.0, 'mbps': 0.0}},
+            'gw1': {'iscsi-pool/disk1': {'iops': 100.0, 'mbps': 0.0}}})
+        self.assertEqual(failed, [])
+
+        _read_lun_counters.side_effect = [
+            counters(0), OSError('Connection refused'), counters(10)]
+        _monotonic.side_effect = [0.0, 10.0]
+        rates, failed = self.harness.charm.sample_lun_rates(
+            {'gw0': '10.0.0.10', 'gw1': '10.0.0.2'},
+            10)
+        self.assertEqual(list(rates), ['gw0'])
+        self.assertEqual(failed, ['gw1'])
+
+    @patch.object(charm.CephISCSIGatewayCharmBase, 'sample_lun_rates')
+    @patch('socket.getfqdn')
+    def test_on_rebalance_action(self, _getfqdn, _sample_lun_rates):
+        _getfqdn.return_value = 'ceph-iscsi-0.example'
+        self.add_cluster_relation()
+        self.harness.begin()
+        self.gwc.inventory.config = {
+            'disks': {
+                'iscsi-pool/disk1': {'owner': 'ceph-iscsi-1.example'},
+                'iscsi-pool/disk2': {'owner': 'ceph-iscsi-1.example'}},
+            'targets': {
+                'iqn.mock.iscsi-gw:iscsi-igw': {
+                    'portals': {
+                        'ceph-iscsi-0.example': {},
+                        'ceph-iscsi-1.example': {}},
+                    'disks': {
+                        'iscsi-pool/disk1': {},
+                        'iscsi-pool/disk2': {}}}}}
+        _sample_lun_rates.return_value = (
+            {
+                'ceph-iscsi-0.example': {
+                    'iscsi-pool/disk1': {'iops': 100.0, 'mbps': 1.0}},
+                'ceph-iscsi-1.example': {
+                    'iscsi-pool/disk1': {'iops': 400.0, 'mbps': 4.0},
+                    'iscsi-pool/disk2': {'iops': 400.0, 'mbps': 4.0}}},
+            [])
+        action_event = MagicMock()
+        action_event.params = {'metric': 'iops', 'interval': 5}
+        self.harness.charm.on_rebalance_action(action_event)
+        _sample_lun_rates.assert_called_once_with(
+            {
+                'ceph-iscsi-0.example': '10.0.0.10',
+                'ceph-iscsi-1.example': '10.0.0.2'},
+            5)
+        # I/O through either gateway counts towards the disk's load.
+        action_event.set_results.assert_called_once_with({
+            'moves': json.dumps([{
+                'disk': 'iscsi-pool/disk1',
+                'from': 'ceph-iscsi-1.example',
+                'to': 'ceph-iscsi-0.example'}]),
+            'load-before': json.dumps(
+                {'ceph-iscsi-0.example': 0.0, 'ceph-iscsi-1.example': 900.0},
+                sort_keys=True),
+            'load-after': json.dumps(
+                {'ceph-iscsi-0.example': 500.0, 'ceph-iscsi-1.example': 400.0},
+                sort_keys=True)})
+
+        # The report needs the rates of every ready gateway.
+        _sample_lun_rates.return_value = (
+            {'ceph-iscsi-0.example': {}},
+            ['ceph-iscsi-1.example'])
+        action_event = MagicMock()
+        action_event.params = {'metric': 'iops', 'interval': 5}
+        self.harness.charm.on_rebalance_action(action_event)
+        action_event.fail.assert_called_once_with(
+            'Unable to read the LUN statistics of ceph-iscsi-1.example')
+        action_event.set_results.assert_not_called()
+
+    def test_on_add_trusted_ip_action(self):
+        self.add_cluster_relation()
+        self.harness.set_leader()
+        self.harness.begin()
+        self.harness.charm.render_config = MagicMock()
+        action_event = MagicMock()
+        action_event.params = {
+            'ips': '10.0.1.0/25 10.0.1.128/25 10.0.2.5',
+            'overwrite': False,
+            'remove': '10.0.2.5'}
+        self.harness.charm.on_add_trusted_ip_action(action_event)
+        action_event.set_results.assert_called_once_with(
+            {'allowed-ips': '10.0.1.0/24'})
+        self.harness.charm.render_config.assert_called_once_with(
+            action_event)
+        action_event = MagicMock()
+        action_event.params = {
+            'ips': '10.0.1.300',
+            'overwrite': False,
+            'remove': ''}
+        self.harness.charm.on_add_trusted_ip_action(action_event)
+        action_event.fail.assert_called_once()
+        self.assertEqual(self.harness.charm.peers.allowed_ips, ['10.0.1.0/24'])
+
+    def test_trusted_ip_list(self):
+        rel_id = self.add_cluster_relation()
+        self.harness.add_relation_unit(rel_id, 'ceph-iscsi/2')
+        self.harness.update_relation_data(
+            rel_id,
+            'ceph-iscsi/2',
+            {'ingress-address': '10.0.0.11'})
+        self.harness.set_leader()
+        self.harness.begin()
+        self.harness.charm.peers.set_allowed_ips(
+            ['10.0.1.0/25', '10.0.1.128/25', '10.0.0.3'])
+        adapter = charm.GatewayClientPeerAdapter(self.harness.charm.peers)
+        # Adjacent gateway and user addresses are written as given.
+        self.assertEqual(
+            adapter.trusted_ip_list,
+            '10.0.0.2 10.0.0.3 10.0.0.10 10.0.0.11 10.0.1.0/24')
+
+    def test_on_hook_timings_action(self):
+        self.harness.begin()
+        self.harness.charm.timings.record('api:PUT /api/disk', 2.0)
+        self.harness.charm.on_add_trusted_ip_action(MagicMock())
+        action_event = MagicMock()
+        action_event.params = {'prefix': 'handler:'}
+        self.harness.charm.on_hook_timings_action(action_event)
+        results = json.loads(
+            action_event.set_results.call_args[0][0]['timings'])
+        self.assertEqual(list(results), ['handler:on_add_trusted_ip_action'])
+        self.assertEqual(
+            json.loads(self.harness.charm.state.hook_timings)[0][:2],
+            ['api:PUT /api/disk', 2.0])
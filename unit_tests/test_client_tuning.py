@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+import unittest
+import sys
+
+sys.path.append('lib')  # noqa
+sys.path.append('src')  # noqa
+
+from mock import patch
+
+import client_tuning
+from client_tuning import GiB, MiB
+
+
+class TestClientTuning(unittest.TestCase):
+
+    def test_none(self):
+        self.assertEqual(
+            client_tuning.client_settings('none', cpus=8, memory=16 * GiB),
+            {})
+
+    def test_latency(self):
+        self.assertEqual(
+            client_tuning.client_settings(
+                'latency',
+                cpus=32,
+                memory=64 * GiB),
+            {'rbd cache': 'false', 'ms async op threads': '8'})
+
+    def test_throughput_sizing(self):
+        small = client_tuning.client_settings(
+            'throughput',
+            cpus=2,
+            memory=2 * GiB)
+        self.assertEqual(small['rbd cache size'], str(32 * MiB))
+        self.assertEqual(small['objecter inflight ops'], '2048')
+        self.assertEqual(small['objecter inflight op bytes'], str(100 * MiB))
+        self.assertEqual(small['ms async op threads'], '3')
+        self.assertEqual(small['rbd cache max dirty'], '0')
+        large = client_tuning.client_settings(
+            'throughput',
+            cpus=48,
+            memory=256 * GiB)
+        self.assertEqual(large['rbd cache size'], str(256 * MiB))
+        self.assertEqual(large['objecter inflight ops'], '8192')
+        self.assertEqual(large['objecter inflight op bytes'], str(GiB))
+        self.assertEqual(large['ms async op threads'], '12')
+
+    def test_overrides(self):
+        settings = client_tuning.client_settings(
+            'balanced',
+            '{"rbd_cache": false, "rbd read from replica policy": balance}',
+            cpus=8,
+            memory=16 * GiB)
+        self.assertEqual(settings['rbd cache'], 'false')
+        self.assertEqual(settings['rbd read from replica policy'], 'balance')
+        self.assertEqual(settings['objecter inflight ops'], '2048')
+
+    def test_invalid(self):
+        with self.assertRaises(client_tuning.TuningError):
+            client_tuning.client_settings('fast', cpus=1, memory=0)
+        with self.assertRaises(client_tuning.TuningError):
+            client_tuning.client_settings('none', '[1]', cpus=1, memory=0)
+        with self.assertRaises(client_tuning.TuningError):
+            client_tuning.client_settings(
+                'none',
+                'rbd cache: {a: 1}',
+                cpus=1,
+                memory=0)
+
+    @patch.object(client_tuning, 'host_resources')
+    def test_host_resources(self, host_resources):
+        host_resources.return_value = (16, 32 * GiB)
+        settings = client_tuning.client_settings('balanced')
+        self.assertEqual(settings['ms async op threads'], '4')
+        self.assertEqual(settings['rbd cache size'], str(64 * MiB))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+import tempfile
+import unittest
+import sys
+from pathlib import Path
+
+sys.path.append('lib')  # noqa
+sys.path.append('src')  # noqa
+
+import daemon_tuning
+
+
+class TestDaemonTuning(unittest.TestCase):
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.sysfs = Path(tmpdir.name)
+        net = self.sysfs / 'class' / 'net'
+        for ifname, node in (('ens1f0', '1'), ('ens1f1', '1'), ('lo', None)):
+            (net / ifname).mkdir(parents=True)
+            if node is not None:
+                (net / ifname / 'device').mkdir()
+                (net / ifname / 'device' / 'numa_node').write_text(node)
+        (net / 'bond0').mkdir()
+        (net / 'bond0' / 'lower_ens1f0').symlink_to(net / 'ens1f0')
+        (net / 'bond0' / 'lower_ens1f1').symlink_to(net / 'ens1f1')
+        (net / 'bond0.100').mkdir()
+        (net / 'bond0.100' / 'lower_bond0').symlink_to(net / 'bond0')
+        node1 = self.sysfs / 'devices' / 'system' / 'node' / 'node1'
+        node1.mkdir(parents=True)
+        (node1 / 'cpulist').write_text('8-15,24-31\n')
+
+    def test_interface_numa_node(self):
+        self.assertEqual(
+            daemon_tuning.interface_numa_node('ens1f0', self.sysfs),
+            1)
+        self.assertEqual(
+            daemon_tuning.interface_numa_node('bond0.100', self.sysfs),
+            1)
+        self.assertIsNone(
+            daemon_tuning.interface_numa_node('lo', self.sysfs))
+        self.assertIsNone(
+            daemon_tuning.interface_numa_node('missing', self.sysfs))
+        self.assertEqual(
+            daemon_tuning.node_cpus(1, self.sysfs),
+            '8-15,24-31')
+
+    def test_service_settings(self):
+        self.assertEqual(daemon_tuning.service_settings({}), {})
+        settings = daemon_tuning.service_settings(
+            {
+                'daemon-cpu-affinity': '0-7 16-23',
+                'daemon-numa-policy': 'bind',
+                'daemon-numa-mask': '0',
+                'daemon-nice': -5,
+                'daemon-io-scheduling-class': 'best-effort',
+                'daemon-io-scheduling-priority': 0,
+                'daemon-memory-max': '8G',
+                'daemon-tasks-max': 'infinity'},
+            sysfs=self.sysfs)
+        self.assertEqual(list(settings.items()), [
+            ('CPUAffinity', '0-7 16-23'),
+            ('NUMAPolicy', 'bind'),
+            ('NUMAMask', '0'),
+            ('Nice', '-5'),
+            ('IOSchedulingClass', 'best-effort'),
+            ('IOSchedulingPriority', '0'),
+            ('MemoryMax', '8G'),
+            ('TasksMax', 'infinity')])
+
+    def test_service_settings_auto(self):
+        config = {
+            'daemon-cpu-affinity': 'auto',
+            'daemon-numa-policy': 'preferred'}
+        self.assertEqual(
+            daemon_tuning.service_settings(config, lambda: 1, self.sysfs),
+            {
+                'CPUAffinity': '8-15,24-31',
+                'NUMAPolicy': 'preferred',
+                'NUMAMask': '1'})
+        # Nothing is pinned when the node is unknown.
+        self.assertEqual(
+            daemon_tuning.service_settings(config, lambda: None, self.sysfs),
+            {})
+
+    def test_invalid(self):
+        for config in (
+                {'daemon-cpu-affinity': 'all'},
+                {'daemon-numa-policy': 'spread'},
+                {'daemon-nice': 20},
+                {'daemon-io-scheduling-priority': 'high'},
+                {'daemon-memory-max': '8 GB'}):
+            with self.assertRaises(daemon_tuning.TuningError):
+                daemon_tuning.parse_options(config)
+
+
+if __name__ == '__main__':
+    unittest.main()
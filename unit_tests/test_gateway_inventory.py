@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+import copy
+import unittest
+import sys
+
+sys.path.append('lib')  # noqa
+sys.path.append('src')  # noqa
+
+from mock import MagicMock
+
+import gateway_inventory
+
+IQN = 'iqn.2003-01.com.ubuntu.iscsi-gw:iscsi-igw'
+INITIATOR = 'iqn.1993-08.org.debian:01:aaa2299be916'
+
+CONFIG = {
+    'epoch': 5,
+    'disks': {'iscsi/disk1': {}, 'iscsi/disk2': {}},
+    'targets': {
+        IQN: {
+            'portals': {'ceph-iscsi-0.example': {}},
+            'disks': {'iscsi/disk1': {'lun_id': 0}},
+            'clients': {
+                INITIATOR: {
+                    'auth': {
+                        'username': 'myusername',
+                        'password': 'mypassword'},
+                    'luns': {'iscsi/disk1': {'lun_id': 0}}}}}}}
+
+
+class TestGatewayInventory(unittest.TestCase):
+
+    def setUp(self):
+        self.fetch = MagicMock(return_value=copy.deepcopy(CONFIG))
+        self.inventory = gateway_inventory.GatewayInventory(self.fetch)
+
+    def test_lookups(self):
+        self.assertTrue(self.inventory.has_target(IQN))
+        self.assertFalse(self.inventory.has_target('iqn.other'))
+        self.assertTrue(
+            self.inventory.has_portal(IQN, 'ceph-iscsi-0.example'))
+        self.assertFalse(
+            self.inventory.has_portal(IQN, 'ceph-iscsi-1.example'))
+        self.assertTrue(self.inventory.has_disk('iscsi/disk2'))
+        self.assertTrue(self.inventory.has_target_lun(IQN, 'iscsi/disk1'))
+        self.assertFalse(self.inventory.has_target_lun(IQN, 'iscsi/disk2'))
+        self.assertTrue(self.inventory.has_client(IQN, INITIATOR))
+        self.assertTrue(self.inventory.has_client_auth(
+            IQN, INITIATOR, 'myusername', 'mypassword'))
+        self.assertFalse(self.inventory.has_client_auth(
+            IQN, INITIATOR, 'myusername', 'newpassword'))
+        self.assertFalse(self.inventory.has_client_auth(
+            IQN, INITIATOR, 'myusername', 'mypassword',
+            'mutualuser', 'mutualpassword'))
+        self.assertTrue(
+            self.inventory.has_client_lun(IQN, INITIATOR, 'iscsi/disk1'))
+        self.assertEqual(
+            self.inventory.client_disks(IQN, INITIATOR),
+            ['iscsi/disk1'])
+        self.assertEqual(
+            self.inventory.disk_clients('iscsi/disk1'),
+            [(IQN, INITIATOR)])
+        self.fetch.assert_called_once_with()
+
+    def test_record(self):
+        self.inventory.load()
+        self.inventory.add_target_lun(IQN, 'iscsi/disk2')
+        self.inventory.add_client_lun(IQN, INITIATOR, 'iscsi/disk2')
+        self.assertTrue(self.inventory.has_target_lun(IQN, 'iscsi/disk2'))
+        self.assertEqual(
+            self.inventory.client_disks(IQN, INITIATOR),
+            ['iscsi/disk1', 'iscsi/disk2'])
+
+    def test_record_before_load(self):
+        self.inventory.add_target('iqn.other')
+        self.fetch.assert_not_called()
+        self.assertFalse(self.inventory.has_target('iqn.other'))
+
+    def test_refresh(self):
+        self.inventory.load()
+        self.inventory.add_disk('iscsi/disk3')
+        # Changed elsewhere with the same epoch, eg after a restore.
+        config = copy.deepcopy(CONFIG)
+        config['disks']['iscsi/disk4'] = {}
+        self.fetch.return_value = config
+        self.inventory.refresh()
+        self.assertEqual(self.fetch.call_count, 2)
+        self.assertTrue(self.inventory.has_disk('iscsi/disk4'))
+        self.assertFalse(self.inventory.has_disk('iscsi/disk3'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+
+import base64
+import http.server
+import json
+import socket
+import threading
+import unittest
+import sys
+import urllib.parse
+
+sys.path.append('lib')  # noqa
+sys.path.append('src')  # noqa
+
+import gwcli_client
+
+
+class StubAPIHandler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def _reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _handle(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        form = urllib.parse.parse_qs(self.rfile.read(length).decode())
+        self.server.requests.append({
+            'method': self.command,
+            'path': self.path,
+            'auth': self.headers.get('Authorization'),
+            'form': {k: v[0] for k, v in form.items()}})
+        status, body = self.server.responses.get(
+            (self.command, self.path),
+            (200, {'message': 'ok'}))
+        self._reply(status, body)
+        if self.server.drop_connections:
+            # Close without announcing it, like an idle timeout would.
+            self.close_connection = True
+
+    do_GET = _handle
+    do_PUT = _handle
+    do_DELETE = _handle
+
+
+class StubAPIServer(http.server.ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), StubAPIHandler)
+        self.connections = 0
+        self.requests = []
+        self.responses = {}
+        self.drop_connections = False
+
+
+class TestGatewayClient(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubAPIServer()
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.client = gwcli_client.GatewayClient(
+            host='127.0.0.1',
+            port=self.server.server_address[1],
+            user='admin',
+            password='s3cr3t')
+        self.addCleanup(self.client.close)
+
+    def test_requests_reuse_connection(self):
+        iqn = 'iqn.mock.iscsi-gw:iscsi-igw'
+        self.client.create_target(iqn)
+        self.client.add_gateway_to_target(
+            iqn,
+            '10.0.0.10',
+            'ceph-iscsi-0.example')
+        self.client.create_pool('iscsi-pool', 'disk1', '5G')
+        self.client.add_client_to_target(iqn, 'client-initiator')
+        self.client.add_client_auth(
+            iqn,
+            'client-initiator',
+            'myusername',
+            'mypassword')
+        self.client.add_disk_to_client(
+            iqn,
+            'client-initiator',
+            'iscsi-pool',
+            'disk1')
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(
+            [(r['method'], r['path']) for r in self.server.requests],
+            [
+                ('PUT', '/api/target/iqn.mock.iscsi-gw:iscsi-igw'),
+                ('PUT', '/api/gateway/iqn.mock.iscsi-gw:iscsi-igw/'
+                        'ceph-iscsi-0.example'),
+                ('PUT', '/api/disk/iscsi-pool/disk1'),
+                ('PUT', '/api/client/iqn.mock.iscsi-gw:iscsi-igw/'
+                        'client-initiator'),
+                ('PUT', '/api/clientauth/iqn.mock.iscsi-gw:iscsi-igw/'
+                        'client-initiator'),
+                ('PUT', '/api/targetlun/iqn.mock.iscsi-gw:iscsi-igw'),
+                ('PUT', '/api/clientlun/iqn.mock.iscsi-gw:iscsi-igw/'
+                        'client-initiator')])
+        self.assertEqual(
+            self.server.requests[1]['form'],
+            {'ip_address': '10.0.0.10'})
+        self.assertEqual(
+            self.server.requests[2]['form'],
+            {'mode': 'create', 'size': '5G', 'create_image': 'true'})
+        self.assertEqual(
+            self.server.requests[6]['form'],
+            {'disk': 'iscsi-pool/disk1'})
+        expected_auth = 'Basic {}'.format(
+            base64.b64encode(b'admin:s3cr3t').decode())
+        for request in self.server.requests:
+            self.assertEqual(request['auth'], expected_auth)
+
+    def test_controls(self):
+        self.client.create_pool(
+            'iscsi-pool',
+            'disk1',
+            '5G',
+            {'max_data_area_mb': 64})
+        self.client.reconfigure_disk(
+            'iscsi-pool',
+            'disk1',
+            {'hw_max_sectors': 2048})
+        self.client.reconfigure_target('iqn.one', {'cmdsn_depth': 512})
+        self.assertEqual(
+            [(r['path'], r['form']) for r in self.server.requests],
+            [
+                ('/api/disk/iscsi-pool/disk1', {
+                    'mode': 'create',
+                    'size': '5G',
+                    'create_image': 'true',
+                    'controls': '{"max_data_area_mb": 64}'}),
+                ('/api/disk/iscsi-pool/disk1', {
+                    'mode': 'reconfigure',
+                    'controls': '{"hw_max_sectors": 2048}'}),
+                ('/api/target/iqn.one', {
+                    'mode': 'reconfigure',
+                    'controls': '{"cmdsn_depth": 512}'})])
+
+    def test_add_gateway_portals(self):
+        self.client.add_gateway_to_target(
+            'iqn.mock.iscsi-gw:iscsi-igw',
+            ['10.0.1.10', '10.0.2.10'],
+            'ceph-iscsi-0.example')
+        self.assertEqual(
+            self.server.requests[0]['form'],
+            {'ip_address': '10.0.1.10,10.0.2.10'})
+
+    def test_register_disk(self):
+        self.client.register_disk('iscsi-pool', 'vdi1')
+        self.assertEqual(
+            [(r['path'], r['form']) for r in self.server.requests],
+            [('/api/disk/iscsi-pool/vdi1', {
+                'mode': 'create',
+                'create_image': 'false'})])
+
+    def test_resize_disk(self):
+        self.client.resize_disk('iscsi-pool', 'disk1', '20G')
+        self.assertEqual(
+            self.server.requests[-1]['form'],
+            {'mode': 'resize', 'size': '20G'})
+
+    def test_size_bytes(self):
+        self.assertEqual(gwcli_client.size_bytes('20G'), 20 * 2 ** 30)
+        self.assertEqual(gwcli_client.size_bytes('512m'), 512 * 2 ** 20)
+        self.assertEqual(gwcli_client.size_bytes('1TB'), 2 ** 40)
+        self.assertEqual(gwcli_client.size_bytes(4096), 4096)
+        with self.assertRaises(ValueError):
+            gwcli_client.size_bytes('lots')
+
+    def test_timer(self):
+        samples = []
+        self.client.timer = lambda name, seconds: samples.append(
+            (name, seconds))
+        self.client.create_target('iqn.one')
+        self.client.get_config(decrypt_passwords=True)
+        self.assertEqual(
+            [name for name, _ in samples],
+            ['PUT /api/target', 'GET /api/config'])
+        self.assertTrue(all(seconds >= 0 for _, seconds in samples))
+
+    def test_get_config(self):
+        self.server.responses[('GET', '/api/config')] = (
+            200,
+            {'epoch': 3, 'targets': {}, 'disks': {}})
+        self.assertEqual(
+            self.client.get_config(),
+            {'epoch': 3, 'targets': {}, 'disks': {}})
+
+    def test_inventory_skips_existing(self):
+        client = gwcli_client.GatewayClient(
+            host='127.0.0.1',
+            port=self.server.server_address[1],
+            user='admin',
+            password='s3cr3t',
+            use_inventory=True)
+        self.addCleanup(client.close)
+        self.server.responses[
+            ('GET', '/api/config?decrypt_passwords=true')] = (
+                200,
+                {
+                    'epoch': 1,
+                    'disks': {'iscsi-pool/disk1': {}},
+                    'targets': {'iqn.one': {}}})
+        client.create_target('iqn.one')
+        client.create_pool('iscsi-pool', 'disk1', '5G')
+        client.create_target('iqn.two')
+        client.create_target('iqn.two')
+        self.assertEqual(
+            [(r['method'], r['path']) for r in self.server.requests],
+            [
+                ('GET', '/api/config?decrypt_passwords=true'),
+                ('PUT', '/api/target/iqn.two')])
+
+    def test_error(self):
+        self.server.responses[('PUT', '/api/target/iqn.bad')] = (
+            400,
+            {'message': 'Invalid IQN'})
+        with self.assertRaises(gwcli_client.GatewayClientError) as ctxt:
+            self.client.create_target('iqn.bad')
+        self.assertEqual(ctxt.exception.status, 400)
+        self.assertEqual(ctxt.exception.message, 'Invalid IQN')
+        # The connection survives an error response.
+        self.client.create_target('iqn.good')
+        self.assertEqual(self.server.connections, 1)
+
+    def test_connection_refused(self):
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+        client = gwcli_client.GatewayClient(host='127.0.0.1', port=port)
+        with self.assertRaises(gwcli_client.GatewayClientError) as ctxt:
+            client.create_target('iqn.one')
+        self.assertIsNone(ctxt.exception.status)
+        self.assertIsInstance(ctxt.exception.__cause__, OSError)
+
+    def test_reconnect_after_server_close(self):
+        self.server.drop_connections = True
+        self.client.create_target('iqn.one')
+        self.client.create_target('iqn.two')
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(self.server.connections, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+import json
+import unittest
+import sys
+
+sys.path.append('lib')  # noqa
+sys.path.append('src')  # noqa
+
+import hook_timings
+
+
+class State():
+
+    def set_default(self, **kwargs):
+        for key, value in kwargs.items():
+            if not hasattr(self, key):
+                setattr(self, key, value)
+
+
+class Charm():
+
+    def __init__(self):
+        self.timings = hook_timings.Timings(State())
+
+    @hook_timings.timed
+    def on_install(self, event):
+        return event
+
+
+class TestHookTimings(unittest.TestCase):
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(hook_timings.percentile(values, 50), 50)
+        self.assertEqual(hook_timings.percentile(values, 99), 99)
+        self.assertEqual(hook_timings.percentile([3], 90), 3)
+
+    def test_report(self):
+        timings = hook_timings.Timings(State())
+        for seconds in (0.4, 0.1, 0.3, 0.2):
+            timings.record('handler:render_config', seconds)
+        timings.record('api:PUT /api/disk', 1.5)
+        self.assertEqual(
+            timings.report(),
+            {
+                'api:PUT /api/disk': {
+                    'count': 1, 'p50': 1.5, 'p90': 1.5, 'p99': 1.5,
+                    'max': 1.5},
+                'handler:render_config': {
+                    'count': 4, 'p50': 0.2, 'p90': 0.4, 'p99': 0.4,
+                    'max': 0.4}})
+        self.assertEqual(list(timings.report('api:')), ['api:PUT /api/disk'])
+
+    def test_flush_ring_buffer(self):
+        state = State()
+        timings = hook_timings.Timings(state, maxlen=3)
+        for i in range(5):
+            timings.record('op{}'.format(i), i)
+        self.assertEqual(state.hook_timings, '[]')
+        timings.flush()
+        self.assertEqual(
+            [name for name, _, _ in json.loads(state.hook_timings)],
+            ['op2', 'op3', 'op4'])
+        # Samples survive into the next hook.
+        timings = hook_timings.Timings(state, maxlen=3)
+        timings.record('op5', 5)
+        self.assertEqual(
+            [name for name, _, _ in timings.samples],
+            ['op2', 'op3', 'op4', 'op5'])
+
+    def test_timed(self):
+        charm = Charm()
+        self.assertEqual(charm.on_install.__name__, 'on_install')
+        self.assertEqual(charm.on_install('event'), 'event')
+        self.assertEqual(list(charm.timings.report()), ['handler:on_install'])
+
+    def test_timer_records_failures(self):
+        timings = hook_timings.Timings(State())
+        with self.assertRaises(ValueError):
+            with timings.timer('step:install_pkgs'):
+                raise ValueError()
+        self.assertEqual(timings.report()['step:install_pkgs']['count'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import json
 import unittest
 import sys
 
@@ -80,6 +81,143 @@ class TestCephISCSIGatewayPeers(unittest.TestCase):
         our_app = self.harness.charm.app
         self.assertEqual(rel_data[our_app]['admin_password'], 's3cr3t')
 
+    @mock.patch.object(CephISCSIGatewayPeers, 'cluster_bind_address',
+                       new_callable=PropertyMock)
+    @mock.patch('socket.getfqdn')
+    def test_rolling_restart(self, _getfqdn, _cluster_bind_address):
+        _getfqdn.return_value = 'ceph-iscsi-0.example'
+        _cluster_bind_address.return_value = '192.0.2.1'
+
+        class TestReceiver(framework.Object):
+
+            def __init__(self, parent, key):
+                super().__init__(parent, key)
+                self.observed_events = []
+
+            def on_restart_granted(self, event):
+                self.observed_events.append(event)
+
+        self.harness.set_leader()
+        self.harness.begin()
+        self.peers = CephISCSIGatewayPeers(self.harness.charm, 'cluster')
+        receiver = TestReceiver(self.harness.framework, 'receiver')
+        self.harness.framework.observe(self.peers.on.restart_granted,
+                                       receiver.on_restart_granted)
+        relation_id = self.harness.add_relation('cluster', 'ceph-iscsi')
+        self.harness.add_relation_unit(
+            relation_id,
+            'ceph-iscsi/1')
+        self.harness.update_relation_data(
+            relation_id,
+            'ceph-iscsi/1',
+            {'restart_request': '1.000000'})
+        rel_data = self.harness.charm.model.get_relation('cluster').data
+        our_app = self.harness.charm.app
+        self.assertEqual(
+            json.loads(rel_data[our_app]['restart_token']),
+            {'unit': 'ceph-iscsi/1', 'nonce': '1.000000'})
+
+        # The peer holds the token so our request has to wait.
+        self.peers.request_restart()
+        self.assertEqual(len(receiver.observed_events), 0)
+        self.assertFalse(self.peers.holds_restart_token)
+
+        self.harness.update_relation_data(
+            relation_id,
+            'ceph-iscsi/1',
+            {'restart_released': '1.000000'})
+        self.assertEqual(len(receiver.observed_events), 1)
+        self.assertTrue(self.peers.holds_restart_token)
+        self.assertEqual(
+            json.loads(rel_data[our_app]['restart_token'])['unit'],
+            'ceph-iscsi/0')
+
+        self.peers.release_restart()
+        self.assertFalse(self.peers.holds_restart_token)
+        self.assertEqual(len(receiver.observed_events), 1)
+
+    @mock.patch.object(CephISCSIGatewayPeers, 'cluster_bind_address',
+                       new_callable=PropertyMock)
+    @mock.patch('socket.getfqdn')
+    def test_cached_until_changed(self, _getfqdn, _cluster_bind_address):
+        _getfqdn.return_value = 'ceph-iscsi-0.example'
+        _cluster_bind_address.return_value = '192.0.2.1'
+        self.harness.set_leader()
+        self.harness.begin()
+        self.peers = CephISCSIGatewayPeers(self.harness.charm, 'cluster')
+        relation_id = self.harness.add_relation('cluster', 'ceph-iscsi')
+        self.harness.add_relation_unit(
+            relation_id,
+            'ceph-iscsi/1')
+        self.harness.update_relation_data(
+            relation_id,
+            'ceph-iscsi/1',
+            {'ingress-address': '192.0.2.2'})
+        _getfqdn.reset_mock()
+        self.assertEqual(list(self.peers.ready_peer_details), ['ceph-iscsi/0'])
+        self.peers.ready_peer_details['ceph-iscsi/0']['ip'] = '192.0.2.9'
+        self.assertEqual(
+            self.peers.ready_peer_details['ceph-iscsi/0']['ip'],
+            '192.0.2.1')
+        self.assertEqual(self.peers.fqdn, 'ceph-iscsi-0.example')
+        # Already worked out while handling relation-changed.
+        _getfqdn.assert_not_called()
+
+        # Relation events and our own writes are seen straight away.
+        self.harness.update_relation_data(
+            relation_id,
+            'ceph-iscsi/1',
+            {
+                'gateway_ready': 'True',
+                'gateway_fqdn': 'ceph-iscsi-1.example'})
+        self.assertEqual(
+            sorted(self.peers.ready_peer_details),
+            ['ceph-iscsi/0', 'ceph-iscsi/1'])
+        self.assertEqual(self.peers.allowed_ips, [])
+        self.peers.set_allowed_ips(['192.0.2.10'])
+        self.assertEqual(self.peers.allowed_ips, ['192.0.2.10'])
+
+    def test_collapse_networks(self):
+        networks = interface_ceph_iscsi_peer.collapse_networks([
+            '10.0.0.1', '10.0.0.0', '10.0.1.0/24', '10.0.0.2/31',
+            '2001:db8::1', '10.0.0.4/30', '10.0.1.7', '10.0.0.1'])
+        # Addresses are never merged, neither with each other nor into
+        # networks.
+        self.assertEqual(
+            interface_ceph_iscsi_peer.format_networks(networks),
+            ['10.0.0.0', '10.0.0.1', '10.0.0.2/31', '10.0.0.4/30',
+             '10.0.1.0/24', '10.0.1.7', '2001:db8::1'])
+        with self.assertRaises(ValueError):
+            interface_ceph_iscsi_peer.collapse_networks(['10.0.0.300'])
+
+    def test_exclude_networks(self):
+        networks = interface_ceph_iscsi_peer.exclude_networks(
+            ['10.0.0.0/30', '10.0.1.0/24', '10.0.2.1'],
+            ['10.0.0.1', '10.0.1.0/24', '10.0.2.0/24'])
+        self.assertEqual(
+            interface_ceph_iscsi_peer.format_networks(networks),
+            ['10.0.0.0', '10.0.0.2/31'])
+
+    def test_set_allowed_ips(self):
+        self.harness.set_leader()
+        self.harness.begin()
+        self.peers = CephISCSIGatewayPeers(self.harness.charm, 'cluster')
+        self.harness.add_relation('cluster', 'ceph-iscsi')
+        self.peers.set_allowed_ips(['10.0.0.1', '10.0.0.0', '10.0.1.0/24'])
+        self.assertEqual(
+            self.peers.allowed_ips,
+            ['10.0.0.0', '10.0.0.1', '10.0.1.0/24'])
+        digest = self.peers.allowed_ips_digest
+        self.peers.set_allowed_ips(['10.0.1.0/25'])
+        self.assertEqual(self.peers.allowed_ips_digest, digest)
+        self.peers.set_allowed_ips([], remove=['10.0.1.128/25'])
+        self.assertEqual(
+            self.peers.allowed_ips,
+            ['10.0.0.0', '10.0.0.1', '10.0.1.0/25'])
+        self.assertNotEqual(self.peers.allowed_ips_digest, digest)
+        self.peers.set_allowed_ips(['10.0.2.2'], append=False)
+        self.assertEqual(self.peers.allowed_ips, ['10.0.2.2'])
+
     @mock.patch('socket.getfqdn')
     def test_announce_ready(self, _getfqdn):
         our_fqdn = 'ceph-iscsi-0.example'
@@ -94,6 +232,39 @@ class TestCephISCSIGatewayPeers(unittest.TestCase):
         self.assertEqual(rel_data[our_unit]['gateway_fqdn'], our_fqdn)
         self.assertEqual(rel_data[our_unit]['gateway_ready'], 'True')
 
+    @mock.patch.object(CephISCSIGatewayPeers, 'cluster_bind_address',
+                       new_callable=PropertyMock)
+    @mock.patch('socket.getfqdn')
+    def test_portals(self, _getfqdn, _cluster_bind_address):
+        _getfqdn.return_value = 'ceph-iscsi-0.example'
+        _cluster_bind_address.return_value = '192.0.2.1'
+        self.harness.begin()
+        self.peers = CephISCSIGatewayPeers(self.harness.charm, 'cluster')
+        relation_id = self.harness.add_relation('cluster', 'ceph-iscsi')
+        self.harness.add_relation_unit(relation_id, 'ceph-iscsi/1')
+        self.harness.update_relation_data(
+            relation_id,
+            'ceph-iscsi/1',
+            {
+                'ingress-address': '192.0.2.2',
+                'gateway_ready': 'True',
+                'gateway_fqdn': 'ceph-iscsi-1.example',
+                'gateway_portals': '["198.51.100.2", "203.0.113.2"]'})
+        self.assertEqual(
+            self.peers.ready_peer_details['ceph-iscsi/0']['portals'],
+            ['192.0.2.1'])
+        self.peers.announce_ready(['198.51.100.1', '203.0.113.1'])
+        details = self.peers.ready_peer_details
+        self.assertEqual(
+            details['ceph-iscsi/0']['portals'],
+            ['198.51.100.1', '203.0.113.1'])
+        self.assertEqual(
+            details['ceph-iscsi/1'],
+            {
+                'fqdn': 'ceph-iscsi-1.example',
+                'ip': '192.0.2.2',
+                'portals': ['198.51.100.2', '203.0.113.2']})
+
     @mock.patch.object(CephISCSIGatewayPeers, 'cluster_bind_address',
                        new_callable=PropertyMock)
     @mock.patch('socket.getfqdn')
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+import glob
+import http.client
+import http.server
+import os
+import tempfile
+import threading
+import unittest
+import sys
+
+sys.path.append('lib')  # noqa
+sys.path.append('src')  # noqa
+
+from mock import patch
+
+import lio_exporter
+
+IQN = 'iqn.2003-01.com.ubuntu.iscsi-gw:iscsi-igw'
+
+
+def write(path, value):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write('{}\n'.format(value))
+
+
+class TestLioExporter(unittest.TestCase):
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.core = os.path.join(tmpdir.name, 'core')
+        self.iscsi = os.path.join(tmpdir.name, 'iscsi')
+        backstore = os.path.join(self.core, 'user_0', 'iscsi.disk_1')
+        write(
+            os.path.join(backstore, 'attrib', 'dev_config'),
+            'rbd/iscsi/disk_1;osd_op_timeout=30')
+        write(os.path.join(backstore, 'attrib', 'hw_queue_depth'), 128)
+        write(os.path.join(backstore, 'attrib', 'dev_size'), 1073741824)
+        stats = os.path.join(backstore, 'statistics', 'scsi_lu')
+        write(os.path.join(stats, 'num_cmds'), 1000)
+        write(os.path.join(stats, 'read_mbytes'), 2)
+        write(os.path.join(stats, 'write_mbytes'), 3)
+        write(
+            os.path.join(
+                self.iscsi,
+                IQN,
+                'fabric_statistics',
+                'iscsi_instance',
+                'sessions'),
+            2)
+
+    def test_collect(self):
+        metrics = lio_exporter.collect(
+            self.core,
+            self.iscsi,
+            gateway='gw0').splitlines()
+        labels = '{gateway="gw0",disk="iscsi/disk_1"}'
+        self.assertIn(
+            'ceph_iscsi_lun_commands_total{} 1000'.format(labels),
+            metrics)
+        self.assertIn(
+            'ceph_iscsi_lun_read_bytes_total{} 2097152'.format(labels),
+            metrics)
+        self.assertIn(
+            'ceph_iscsi_lun_write_bytes_total{} 3145728'.format(labels),
+            metrics)
+        self.assertIn(
+            'ceph_iscsi_lun_hw_queue_depth{} 128'.format(labels),
+            metrics)
+        self.assertIn(
+            'ceph_iscsi_lun_size_bytes{} 1073741824'.format(labels),
+            metrics)
+        self.assertIn(
+            'ceph_iscsi_target_sessions{{gateway="gw0",target="{}"}} 2'.format(
+                IQN),
+            metrics)
+        self.assertIn('ceph_iscsi_gateway_sessions{gateway="gw0"} 2', metrics)
+        self.assertIn(
+            '# TYPE ceph_iscsi_lun_commands_total counter',
+            metrics)
+
+    def test_collect_single_pass(self):
+        with patch.object(
+                lio_exporter.lio_stats.glob,
+                'glob',
+                wraps=glob.glob) as _glob:
+            lio_exporter.collect(self.core, self.iscsi, gateway='gw0')
+        self.assertEqual(
+            [c[0][0] for c in _glob.call_args_list],
+            [
+                os.path.join(self.core, 'user_*', '*'),
+                os.path.join(self.iscsi, 'iqn.*')])
+
+    def test_collect_empty(self):
+        metrics = lio_exporter.collect(
+            os.path.join(self.core, 'missing'),
+            os.path.join(self.iscsi, 'missing'),
+            gateway='gw0')
+        self.assertIn('ceph_iscsi_gateway_sessions{gateway="gw0"} 0', metrics)
+
+    def test_parse_counters(self):
+        metrics = lio_exporter.collect(self.core, self.iscsi, gateway='gw0')
+        metrics += (
+            'ceph_iscsi_lun_commands_total'
+            '{gateway="gw0",disk="iscsi/\\"odd\\""} 5\n')
+        self.assertEqual(
+            lio_exporter.parse_counters(metrics),
+            {'iscsi/disk_1': {'cmds': 1000, 'read_mb': 2, 'write_mb': 3}})
+
+    def test_parse_sizes(self):
+        metrics = lio_exporter.collect(self.core, self.iscsi, gateway='gw0')
+        self.assertEqual(
+            lio_exporter.parse_sizes(metrics),
+            {'iscsi/disk_1': 1073741824})
+
+    def test_handler(self):
+
+        class Handler(lio_exporter.MetricsHandler):
+            core_root = self.core
+            iscsi_root = self.iscsi
+
+        server = http.server.HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        conn = http.client.HTTPConnection('127.0.0.1', server.server_port)
+        self.addCleanup(conn.close)
+        conn.request('GET', '/metrics')
+        response = conn.getresponse()
+        self.assertEqual(response.status, 200)
+        self.assertIn(b'ceph_iscsi_lun_commands_total', response.read())
+        conn.request('GET', '/')
+        response = conn.getresponse()
+        response.read()
+        self.assertEqual(response.status, 404)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+import unittest
+import sys
+
+sys.path.append('lib')  # noqa
+sys.path.append('src')  # noqa
+
+import lio_stats
+
+
+class TestLioStats(unittest.TestCase):
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.root = tmpdir.name
+
+    def add_backstore(self, name, dev_config, cmds, read_mb, write_mb):
+        backstore = os.path.join(self.root, 'user_1', name)
+        os.makedirs(os.path.join(backstore, 'attrib'))
+        stats = os.path.join(backstore, 'statistics', 'scsi_lu')
+        os.makedirs(stats)
+        if dev_config is not None:
+            with open(os.path.join(backstore, 'attrib', 'dev_config'),
+                      'w') as f:
+                f.write(dev_config + '\n')
+        for stat, value in (('num_cmds', cmds),
+                            ('read_mbytes', read_mb),
+                            ('write_mbytes', write_mb)):
+            with open(os.path.join(stats, stat), 'w') as f:
+                f.write('{}\n'.format(value))
+
+    def test_read_counters(self):
+        self.add_backstore(
+            'iscsi.disk_1',
+            'rbd/iscsi/disk_1;osd_op_timeout=30',
+            100,
+            10,
+            20)
+        self.add_backstore('rbd.disk.2', None, 5, 0, 1)
+        os.makedirs(os.path.join(self.root, 'user_1', 'hba_info'))
+        self.assertEqual(
+            lio_stats.read_counters(self.root),
+            {
+                'iscsi/disk_1': {'cmds': 100, 'read_mb': 10, 'write_mb': 20},
+                'rbd/disk.2': {'cmds': 5, 'read_mb': 0, 'write_mb': 1}})
+
+    def test_read_counters_queue_depth(self):
+        self.add_backstore('iscsi.disk_1', None, 1, 2, 3)
+        with open(os.path.join(self.root, 'user_1', 'iscsi.disk_1',
+                               'attrib', 'hw_queue_depth'), 'w') as f:
+            f.write('128\n')
+        self.assertEqual(
+            lio_stats.read_counters(self.root, queue_depth=True),
+            {'iscsi/disk_1': {
+                'cmds': 1,
+                'read_mb': 2,
+                'write_mb': 3,
+                'queue_depth': 128}})
+
+    def test_read_counters_size(self):
+        self.add_backstore('iscsi.disk_1', None, 1, 2, 3)
+        self.add_backstore('iscsi.disk_2', None, 1, 2, 3)
+        with open(os.path.join(self.root, 'user_1', 'iscsi.disk_1',
+                               'attrib', 'dev_size'), 'w') as f:
+            f.write('1073741824\n')
+        self.assertEqual(
+            lio_stats.read_counters(self.root, size=True),
+            {
+                'iscsi/disk_1': {
+                    'cmds': 1,
+                    'read_mb': 2,
+                    'write_mb': 3,
+                    'size': 1073741824},
+                'iscsi/disk_2': {'cmds': 1, 'read_mb': 2, 'write_mb': 3}})
+
+    def test_read_sessions(self):
+        for iqn, sessions in (('iqn.2003-01.com.ubuntu:one', 2),
+                              ('iqn.2003-01.com.ubuntu:two', 0)):
+            stats = os.path.join(
+                self.root, iqn, 'fabric_statistics', 'iscsi_instance')
+            os.makedirs(stats)
+            with open(os.path.join(stats, 'sessions'), 'w') as f:
+                f.write('{}\n'.format(sessions))
+        os.makedirs(os.path.join(self.root, 'discovery_auth'))
+        self.assertEqual(
+            lio_stats.read_sessions(self.root),
+            {
+                'iqn.2003-01.com.ubuntu:one': 2,
+                'iqn.2003-01.com.ubuntu:two': 0})
+
+    def test_read_counters_missing(self):
+        self.assertEqual(
+            lio_stats.read_counters(os.path.join(self.root, 'missing')),
+            {})
+
+    def test_rates(self):
+        old = {
+            'iscsi/disk_1': {'cmds': 100, 'read_mb': 10, 'write_mb': 20},
+            'iscsi/disk_2': {'cmds': 500, 'read_mb': 0, 'write_mb': 0}}
+        new = {
+            'iscsi/disk_1': {'cmds': 1100, 'read_mb': 60, 'write_mb': 70},
+            'iscsi/disk_2': {'cmds': 10, 'read_mb': 0, 'write_mb': 0},
+            'iscsi/disk_3': {'cmds': 10, 'read_mb': 0, 'write_mb': 0}}
+        self.assertEqual(
+            lio_stats.rates(old, new, 100),
+            {'iscsi/disk_1': {'iops': 10.0, 'mbps': 1.0}})
+        self.assertEqual(lio_stats.rates(old, new, 0), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+import unittest
+import sys
+
+sys.path.append('lib')  # noqa
+sys.path.append('src')  # noqa
+
+import lun_placement
+
+GW0 = 'ceph-iscsi-0.example'
+GW1 = 'ceph-iscsi-1.example'
+GW2 = 'ceph-iscsi-2.example'
+
+
+class TestLunPlacement(unittest.TestCase):
+
+    def test_eligible_owners(self):
+        config = {
+            'targets': {
+                'iqn.one': {
+                    'portals': {GW0: {}, GW1: {}, GW2: {}},
+                    'disks': {'iscsi/disk1': {}, 'iscsi/disk2': {}}},
+                'iqn.two': {
+                    'portals': {GW1: {}, GW2: {}},
+                    'disks': {'iscsi/disk2': {}}}}}
+        self.assertEqual(
+            lun_placement.eligible_owners(config, [GW0, GW1]),
+            {'iscsi/disk1': {GW0, GW1}, 'iscsi/disk2': {GW1}})
+
+    def test_current_owners(self):
+        config = {
+            'disks': {
+                'iscsi/disk1': {'owner': GW0},
+                'iscsi/disk2': {'owner': ''},
+                'iscsi/disk3': {}}}
+        self.assertEqual(
+            lun_placement.current_owners(config),
+            {'iscsi/disk1': GW0})
+
+    def test_rebalance_hot_disks(self):
+        eligible = {
+            'iscsi/hot1': {GW0, GW1},
+            'iscsi/hot2': {GW0, GW1},
+            'iscsi/warm': {GW0, GW1},
+            'iscsi/idle': {GW0, GW1}}
+        current = {
+            'iscsi/hot1': GW0,
+            'iscsi/hot2': GW0,
+            'iscsi/warm': GW1,
+            'iscsi/idle': GW1}
+        weights = {'iscsi/hot1': 900, 'iscsi/hot2': 800, 'iscsi/warm': 300}
+        placement = lun_placement.rebalance(eligible, current, weights)
+        self.assertEqual(
+            lun_placement.moves(current, placement),
+            {'iscsi/hot2': (GW0, GW1)})
+        self.assertEqual(
+            lun_placement.loads(placement, weights, [GW0, GW1]),
+            {GW0: 900.0, GW1: 1100.0})
+
+    def test_rebalance_swap(self):
+        eligible = {
+            'iscsi/a': {GW0, GW1},
+            'iscsi/b': {GW0, GW1},
+            'iscsi/c': {GW0, GW1},
+            'iscsi/d': {GW0, GW1}}
+        current = {
+            'iscsi/a': GW0,
+            'iscsi/b': GW0,
+            'iscsi/c': GW1,
+            'iscsi/d': GW1}
+        weights = {'iscsi/a': 7, 'iscsi/b': 5, 'iscsi/c': 6, 'iscsi/d': 4}
+        placement = lun_placement.rebalance(eligible, current, weights)
+        # No single move lowers the peak of 12, swapping a and c does.
+        self.assertEqual(
+            lun_placement.moves(current, placement),
+            {'iscsi/a': (GW0, GW1), 'iscsi/c': (GW1, GW0)})
+        self.assertEqual(
+            lun_placement.loads(placement, weights, [GW0, GW1]),
+            {GW0: 11.0, GW1: 11.0})
+
+    def test_rebalance_balanced(self):
+        eligible = {'iscsi/a': {GW0, GW1}, 'iscsi/b': {GW0, GW1}}
+        current = {'iscsi/a': GW0, 'iscsi/b': GW1}
+        self.assertEqual(
+            lun_placement.rebalance(
+                eligible,
+                current,
+                {'iscsi/a': 5, 'iscsi/b': 4}),
+            current)
+        # Idle disks never move.
+        self.assertEqual(
+            lun_placement.rebalance(
+                eligible,
+                {'iscsi/a': GW0, 'iscsi/b': GW0},
+                {}),
+            {'iscsi/a': GW0, 'iscsi/b': GW0})
+
+    def test_rebalance_orphans(self):
+        eligible = {'iscsi/a': {GW1}, 'iscsi/b': {GW0, GW1}}
+        placement = lun_placement.rebalance(
+            eligible,
+            {'iscsi/a': GW2, 'iscsi/b': GW2},
+            {'iscsi/a': 3, 'iscsi/b': 2})
+        self.assertEqual(placement, {'iscsi/a': GW1, 'iscsi/b': GW0})
+        self.assertEqual(lun_placement.rebalance({}, {}, {}), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,507 @@
+#!/usr/bin/env python3
+
+import json
+import time
+import unittest
+import sys
+
+sys.path.append('lib')  # noqa
+sys.path.append('src')  # noqa
+
+from mock import MagicMock
+
+import provisioning
+from provisioning import Operation
+
+IQN = 'iqn.2003-01.com.ubuntu.iscsi-gw:iscsi-igw'
+INITIATOR = 'iqn.1993-08.org.debian:01:aaa2299be916'
+
+MANIFEST = '''
+disks:
+  - pool: iscsi
+    image: disk1
+    size: 5G
+  - pool: iscsi
+    image: disk2
+    size: 10G
+targets:
+  - iqn: {iqn}
+    hosts:
+      - initiator: {initiator}
+        username: myusername
+        password: mypassword
+        disks: [iscsi/disk1, iscsi/disk2]
+'''.format(iqn=IQN, initiator=INITIATOR)
+
+GATEWAYS = {
+    'ceph-iscsi/0': {
+        'fqdn': 'ceph-iscsi-0.example',
+        'ip': '10.0.0.10',
+        'portals': ['10.0.1.10', '10.0.2.10']},
+    'ceph-iscsi/1': {'fqdn': 'ceph-iscsi-1.example', 'ip': '10.0.0.2'}}
+
+
+class TestProvisioning(unittest.TestCase):
+
+    def test_load_manifest_json(self):
+        manifest = provisioning.load_manifest(
+            '{"targets": [{"iqn": "iqn.test", "gateways": ["ceph-iscsi/0"]}]}')
+        self.assertEqual(
+            manifest,
+            {
+                'disks': [],
+                'targets': [{
+                    'iqn': 'iqn.test',
+                    'gateways': ['ceph-iscsi/0'],
+                    'disks': [],
+                    'hosts': [],
+                    'controls': {}}]})
+
+    def test_load_manifest_invalid(self):
+        with self.assertRaises(provisioning.ManifestError):
+            provisioning.load_manifest('[1, 2]')
+        with self.assertRaises(provisioning.ManifestError):
+            provisioning.load_manifest('targets: [{hosts: []}]')
+        with self.assertRaises(provisioning.ManifestError):
+            provisioning.load_manifest('disks: [{pool: iscsi}]')
+        with self.assertRaises(provisioning.ManifestError):
+            provisioning.load_manifest(
+                'disks: [{pool: iscsi, image: a, controls: {bogus: 1}}]')
+
+    def test_load_manifest_duplicates(self):
+        manifest = provisioning.load_manifest('''
+targets:
+  - iqn: iqn.test
+    gateways: [ceph-iscsi/0, ceph-iscsi/0]
+    disks: [iscsi/disk1, iscsi/disk1]
+    hosts:
+      - initiator: iqn.host
+        disks: [iscsi/disk1, iscsi/disk2, iscsi/disk1]
+''')
+        target = manifest['targets'][0]
+        self.assertEqual(target['gateways'], ['ceph-iscsi/0'])
+        self.assertEqual(target['disks'], ['iscsi/disk1'])
+        self.assertEqual(
+            target['hosts'][0]['disks'],
+            ['iscsi/disk1', 'iscsi/disk2'])
+        for text in (
+                'disks: [{pool: p, image: d1}, {pool: p, image: d1}]',
+                'targets: [{iqn: iqn.test}, {iqn: iqn.test}]',
+                'targets: [{iqn: iqn.test, hosts: '
+                '[{initiator: iqn.host}, {initiator: iqn.host}]}]'):
+            with self.assertRaises(provisioning.ManifestError):
+                provisioning.load_manifest(text)
+
+    def test_plan_duplicate_gateway(self):
+        manifest = provisioning.load_manifest('''
+targets:
+  - iqn: iqn.test
+    gateways: [ceph-iscsi/0, ceph-iscsi-0.example]
+''')
+        ops = provisioning.plan(manifest, {}, GATEWAYS)
+        self.assertEqual(
+            [(op.kind, op.obj) for op in ops],
+            [
+                ('create_target', 'iqn.test'),
+                ('add_gateway_to_target', 'iqn.test/ceph-iscsi-0.example')])
+
+    def test_plan_empty_config(self):
+        ops = provisioning.plan(
+            provisioning.load_manifest(MANIFEST),
+            {},
+            GATEWAYS)
+        self.assertEqual(ops, [
+            Operation(
+                'create_pool', 'iscsi/disk1', ('iscsi', 'disk1', '5G')),
+            Operation(
+                'create_pool', 'iscsi/disk2', ('iscsi', 'disk2', '10G')),
+            Operation('create_target', IQN, (IQN,)),
+            Operation(
+                'add_gateway_to_target',
+                IQN + '/ceph-iscsi-0.example',
+                (IQN, ['10.0.1.10', '10.0.2.10'], 'ceph-iscsi-0.example')),
+            Operation(
+                'add_gateway_to_target',
+                IQN + '/ceph-iscsi-1.example',
+                (IQN, ['10.0.0.2'], 'ceph-iscsi-1.example')),
+            Operation(
+                'add_disk_to_target',
+                IQN + '/iscsi/disk1',
+                (IQN, 'iscsi', 'disk1')),
+            Operation(
+                'add_disk_to_target',
+                IQN + '/iscsi/disk2',
+                (IQN, 'iscsi', 'disk2')),
+            Operation(
+                'add_client_to_target',
+                IQN + '/' + INITIATOR,
+                (IQN, INITIATOR)),
+            Operation(
+                'add_client_auth',
+                IQN + '/' + INITIATOR,
+                (IQN, INITIATOR, 'myusername', 'mypassword', '', '')),
+            Operation(
+                'add_client_lun',
+                IQN + '/' + INITIATOR + '/iscsi/disk1',
+                (IQN, INITIATOR, 'iscsi', 'disk1')),
+            Operation(
+                'add_client_lun',
+                IQN + '/' + INITIATOR + '/iscsi/disk2',
+                (IQN, INITIATOR, 'iscsi', 'disk2'))])
+
+    def test_plan_partial_config(self):
+        config = {
+            'disks': {'iscsi/disk1': {}},
+            'targets': {
+                IQN: {
+                    'portals': {
+                        'ceph-iscsi-0.example': {},
+                        'ceph-iscsi-1.example': {}},
+                    'disks': {'iscsi/disk1': {'lun_id': 0}},
+                    'clients': {
+                        INITIATOR: {
+                            'auth': {
+                                'username': 'myusername',
+                                'password': 'mypassword'},
+                            'luns': {'iscsi/disk1': {'lun_id': 0}}}}}}}
+        ops = provisioning.plan(
+            provisioning.load_manifest(MANIFEST),
+            config,
+            GATEWAYS)
+        self.assertEqual(ops, [
+            Operation(
+                'create_pool', 'iscsi/disk2', ('iscsi', 'disk2', '10G')),
+            Operation(
+                'add_disk_to_target',
+                IQN + '/iscsi/disk2',
+                (IQN, 'iscsi', 'disk2')),
+            Operation(
+                'add_client_lun',
+                IQN + '/' + INITIATOR + '/iscsi/disk2',
+                (IQN, INITIATOR, 'iscsi', 'disk2'))])
+
+    def test_plan_controls(self):
+        manifest = provisioning.load_manifest('''
+disks:
+  - {pool: iscsi, image: disk1, controls: {max_data_area_mb: 64}}
+  - {pool: iscsi, image: disk2, size: 1G, controls: {qfull_timeout: 10}}
+  - {pool: iscsi, image: disk3, controls: {hw_max_sectors: 2048}}
+targets:
+  - iqn: iqn.one
+    controls: {cmdsn_depth: 512}
+    disks: [iscsi/disk1]
+  - iqn: iqn.two
+    controls: {cmdsn_depth: 256}
+''')
+        config = {
+            'disks': {
+                'iscsi/disk1': {'controls': {'max_data_area_mb': 8}},
+                'iscsi/disk3': {'controls': {'hw_max_sectors': '2048'}}},
+            'targets': {
+                'iqn.two': {
+                    'controls': {'cmdsn_depth': 256},
+                    'portals': {
+                        'ceph-iscsi-0.example': {},
+                        'ceph-iscsi-1.example': {}}}}}
+        ops = provisioning.plan(manifest, config, GATEWAYS)
+        self.assertEqual(ops[:4], [
+            Operation(
+                'reconfigure_disk',
+                'iscsi/disk1',
+                ('iscsi', 'disk1', {'max_data_area_mb': 64})),
+            Operation(
+                'create_pool',
+                'iscsi/disk2',
+                ('iscsi', 'disk2', '1G', {'qfull_timeout': 10})),
+            Operation('create_target', 'iqn.one', ('iqn.one',)),
+            Operation(
+                'reconfigure_target',
+                'iqn.one',
+                ('iqn.one', {'cmdsn_depth': 512}))])
+        self.assertEqual(len(ops), 7)
+        deps = {op.name: op.deps for op in ops}
+        self.assertEqual(
+            deps['add_gateway_to_target:iqn.one/ceph-iscsi-0.example'],
+            ['create_target:iqn.one', 'reconfigure_target:iqn.one'])
+        self.assertEqual(
+            deps['add_disk_to_target:iqn.one/iscsi/disk1'],
+            [
+                'create_target:iqn.one',
+                'reconfigure_target:iqn.one',
+                'add_gateway_to_target:iqn.one/ceph-iscsi-0.example',
+                'add_gateway_to_target:iqn.one/ceph-iscsi-1.example',
+                'reconfigure_disk:iscsi/disk1'])
+
+    def test_plan_clone(self):
+        manifest = provisioning.load_manifest('''
+disks:
+  - {pool: iscsi, image: vdi1, source: iscsi/golden@base, flatten: true}
+  - {pool: iscsi, image: vdi2, source: iscsi/golden@base, size: 40G,
+     controls: {qfull_timeout: 10}}
+  - {pool: iscsi, image: vdi3, source: iscsi/golden@base}
+targets:
+  - iqn: iqn.one
+    disks: [iscsi/vdi1]
+''')
+        config = {'disks': {'iscsi/vdi3': {}}}
+        ops = provisioning.plan(manifest, config, GATEWAYS)
+        self.assertEqual(ops[:5], [
+            Operation(
+                'clone_image',
+                'iscsi/vdi1',
+                ('iscsi/golden@base', 'iscsi', 'vdi1', None)),
+            Operation('register_disk', 'iscsi/vdi1', ('iscsi', 'vdi1', None)),
+            Operation('flatten_image', 'iscsi/vdi1', ('iscsi', 'vdi1')),
+            Operation(
+                'clone_image',
+                'iscsi/vdi2',
+                ('iscsi/golden@base', 'iscsi', 'vdi2', '40G')),
+            Operation(
+                'register_disk',
+                'iscsi/vdi2',
+                ('iscsi', 'vdi2', {'qfull_timeout': 10}))])
+        deps = {op.name: op.deps for op in ops}
+        self.assertEqual(
+            deps['register_disk:iscsi/vdi1'],
+            ['clone_image:iscsi/vdi1'])
+        self.assertIn(
+            'register_disk:iscsi/vdi1',
+            deps['add_disk_to_target:iqn.one/iscsi/vdi1'])
+        with self.assertRaises(provisioning.ManifestError):
+            provisioning.load_manifest(
+                'disks: [{pool: iscsi, image: a, source: iscsi/golden}]')
+
+    def test_export_config(self):
+        config = {
+            'epoch': 7,
+            'disks': {
+                'iscsi/disk1': {
+                    'controls': {'qfull_timeout': 10, 'owner_only': 1}},
+                'iscsi/disk2': {}},
+            'targets': {
+                IQN: {
+                    'controls': {'cmdsn_depth': 512},
+                    'portals': {
+                        'ceph-iscsi-1.example': {},
+                        'old-gateway.example': {}},
+                    'disks': {
+                        'iscsi/disk2': {'lun_id': 0},
+                        'iscsi/disk1': {'lun_id': 1}},
+                    'clients': {
+                        INITIATOR: {
+                            'auth': {
+                                'username': 'myusername',
+                                'password': 'mypassword',
+                                'mutual_username': 'mytarget',
+                                'mutual_password': 'mytargetpassword'},
+                            'luns': {
+                                'iscsi/disk2': {'lun_id': 0},
+                                'iscsi/disk1': {'lun_id': 1}}},
+                        'iqn.encrypted': {
+                            'auth': {
+                                'username': 'u',
+                                'password': 'secret',
+                                'password_encryption_enabled': True},
+                            'luns': {}}}}}}
+        export = provisioning.export_config(config)
+        self.assertEqual(export['version'], provisioning.EXPORT_VERSION)
+        self.assertEqual(export['disks'][0], {
+            'pool': 'iscsi',
+            'image': 'disk1',
+            'create_image': False,
+            'controls': {'qfull_timeout': 10}})
+        target = export['targets'][0]
+        self.assertEqual(target['disks'], ['iscsi/disk2', 'iscsi/disk1'])
+        self.assertEqual(target['controls'], {'cmdsn_depth': 512})
+        self.assertEqual(target['hosts'][0], {
+            'initiator': INITIATOR,
+            'disks': ['iscsi/disk2', 'iscsi/disk1'],
+            'username': 'myusername',
+            'password': 'mypassword',
+            'mutual_username': 'mytarget',
+            'mutual_password': 'mytargetpassword'})
+        # The gateway config is read with its passwords decrypted.
+        self.assertEqual(target['hosts'][1], {
+            'initiator': 'iqn.encrypted',
+            'disks': [],
+            'username': 'u',
+            'password': 'secret'})
+        manifest = provisioning.load_export(json.dumps(export), GATEWAYS)
+        self.assertEqual(
+            manifest['targets'][0]['gateways'],
+            ['ceph-iscsi-1.example'])
+        ops = provisioning.plan(manifest, {}, GATEWAYS)
+        self.assertEqual(ops[:2], [
+            Operation(
+                'register_disk',
+                'iscsi/disk1',
+                ('iscsi', 'disk1', {'qfull_timeout': 10})),
+            Operation(
+                'register_disk',
+                'iscsi/disk2',
+                ('iscsi', 'disk2', None))])
+        # Disks are mapped in LUN id order, whichever registers first.
+        client = MagicMock()
+        client.register_disk.side_effect = (
+            lambda pool, image, controls: time.sleep(
+                0.1 if image == 'disk2' else 0))
+        provisioning.apply(ops, client, workers=4)
+        self.assertEqual(
+            [c[0][2] for c in client.add_disk_to_target.call_args_list],
+            ['disk2', 'disk1'])
+        client.add_client_auth.assert_any_call(
+            IQN, INITIATOR, 'myusername', 'mypassword', 'mytarget',
+            'mytargetpassword')
+        # Restoring onto a configured gateway changes nothing.
+        self.assertEqual(provisioning.plan(manifest, config, GATEWAYS), [])
+        # QoS limits are read from the images and set again on import.
+        export = provisioning.export_config(
+            config,
+            {'iscsi/disk1': {'iops_limit': 500, 'bps_burst': 2048},
+             'iscsi/disk2': {}})
+        self.assertEqual(
+            export['disks'][0]['qos'],
+            {'iops_limit': 500, 'bps_burst': 2048})
+        self.assertNotIn('qos', export['disks'][1])
+        manifest = provisioning.load_export(json.dumps(export), GATEWAYS)
+        self.assertEqual(provisioning.plan(manifest, config, GATEWAYS), [
+            Operation(
+                'set_image_qos',
+                'iscsi/disk1',
+                ('iscsi', 'disk1', {'iops_limit': 500, 'bps_burst': 2048}))])
+        with self.assertRaises(provisioning.ManifestError):
+            provisioning.load_export('{"version": 99}', GATEWAYS)
+
+    def test_unexported_settings(self):
+        self.assertEqual(provisioning.unexported_settings({}), [])
+        config = {
+            'discovery_auth': {'username': 'discovery', 'password': 'p'},
+            'targets': {
+                IQN: {
+                    'auth': {'username': 'target', 'password': 'p'},
+                    'acl_enabled': False,
+                    'groups': {'cluster': {}}},
+                'iqn.other': {
+                    'auth': {'username': '', 'password': ''},
+                    'acl_enabled': True,
+                    'groups': {}}}}
+        self.assertEqual(provisioning.unexported_settings(config), [
+            "discovery CHAP credentials",
+            "{} target CHAP credentials".format(IQN),
+            "{} ACLs disabled".format(IQN),
+            "{} host group cluster".format(IQN)])
+
+    def test_plan_qos(self):
+        manifest = provisioning.load_manifest(
+            'disks: [{pool: iscsi, image: disk1, size: 5G, '
+            'qos: {iops_limit: 500}}]\n'
+            'targets: [{iqn: iqn.one, disks: [iscsi/disk1]}]')
+        ops = provisioning.plan(manifest, {}, GATEWAYS)
+        self.assertEqual(ops[1], Operation(
+            'set_image_qos',
+            'iscsi/disk1',
+            ('iscsi', 'disk1', {'iops_limit': 500})))
+        self.assertEqual(ops[1].deps, ['create_pool:iscsi/disk1'])
+        deps = {op.name: op.deps for op in ops}
+        self.assertIn(
+            'set_image_qos:iscsi/disk1',
+            deps['add_disk_to_target:iqn.one/iscsi/disk1'])
+        with self.assertRaises(provisioning.ManifestError):
+            provisioning.load_manifest(
+                'disks: [{pool: iscsi, image: a, qos: {iops: 5}}]')
+
+    def test_plan_data_pool(self):
+        manifest = provisioning.load_manifest(
+            'disks: [{pool: iscsi, image: disk1, size: 2T, '
+            'data_pool: iscsi-ec}]')
+        ops = provisioning.plan(manifest, {}, GATEWAYS)
+        self.assertEqual(ops, [
+            Operation(
+                'create_image',
+                'iscsi/disk1',
+                ('iscsi', 'disk1', '2T', 'iscsi-ec')),
+            Operation(
+                'register_disk',
+                'iscsi/disk1',
+                ('iscsi', 'disk1', None))])
+        self.assertEqual(ops[1].deps, ['create_image:iscsi/disk1'])
+
+    def test_plan_unknown_gateway(self):
+        manifest = provisioning.load_manifest(
+            'targets: [{iqn: iqn.test, gateways: [ceph-iscsi/5]}]')
+        with self.assertRaises(provisioning.ManifestError):
+            provisioning.plan(manifest, {}, GATEWAYS)
+
+    def test_plan_unknown_disk(self):
+        manifest = provisioning.load_manifest(
+            'targets: [{iqn: iqn.test, disks: [iscsi/missing]}]')
+        with self.assertRaises(provisioning.ManifestError):
+            provisioning.plan(manifest, {}, GATEWAYS)
+
+    def test_plan_dependencies(self):
+        ops = provisioning.plan(
+            provisioning.load_manifest(MANIFEST),
+            {},
+            GATEWAYS)
+        deps = {op.name: op.deps for op in ops}
+        self.assertEqual(deps['create_pool:iscsi/disk1'], [])
+        self.assertEqual(
+            deps['add_gateway_to_target:{}/ceph-iscsi-0.example'.format(IQN)],
+            ['create_target:{}'.format(IQN)])
+        self.assertEqual(
+            deps['add_client_lun:{}/{}/iscsi/disk2'.format(IQN, INITIATOR)],
+            [
+                'create_target:{}'.format(IQN),
+                'add_gateway_to_target:{}/ceph-iscsi-0.example'.format(IQN),
+                'add_gateway_to_target:{}/ceph-iscsi-1.example'.format(IQN),
+                'add_client_to_target:{}/{}'.format(IQN, INITIATOR),
+                'add_disk_to_target:{}/iscsi/disk2'.format(IQN)])
+        self.assertEqual(
+            deps['add_disk_to_target:{}/iscsi/disk2'.format(IQN)][-2:],
+            [
+                'create_pool:iscsi/disk2',
+                'add_disk_to_target:{}/iscsi/disk1'.format(IQN)])
+        self.assertEqual(ops[0].locks, ('disk:iscsi/disk1',))
+        self.assertEqual(ops[2].locks, ('target:{}'.format(IQN),))
+
+    def test_apply(self):
+        client = MagicMock()
+        client.create_target.side_effect = Exception('boom')
+        ops = [
+            Operation('create_pool', 'iscsi/disk1', ('iscsi', 'disk1', '5G')),
+            Operation('create_target', IQN, (IQN,)),
+            Operation(
+                'add_client_to_target',
+                IQN,
+                (IQN, INITIATOR),
+                deps=['create_target:{}'.format(IQN)])]
+        results = provisioning.apply(ops, client, workers=2)
+        client.create_pool.assert_called_once_with('iscsi', 'disk1', '5G')
+        client.add_client_to_target.assert_not_called()
+        self.assertEqual(
+            [r['status'] for r in results],
+            ['done', 'failed', 'skipped'])
+        self.assertEqual(results[1]['error'], 'boom')
+
+    def test_apply_rbd(self):
+        client = MagicMock()
+        rbd = MagicMock()
+        ops = [
+            Operation(
+                'clone_image',
+                'iscsi/vdi1',
+                ('iscsi/golden@base', 'iscsi', 'vdi1', None)),
+            Operation(
+                'register_disk',
+                'iscsi/vdi1',
+                ('iscsi', 'vdi1', None),
+                deps=['clone_image:iscsi/vdi1'])]
+        provisioning.apply(ops, client, rbd=rbd)
+        rbd.clone_image.assert_called_once_with(
+            'iscsi/golden@base', 'iscsi', 'vdi1', None)
+        client.register_disk.assert_called_once_with('iscsi', 'vdi1', None)
+        client.clone_image.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+
+import json
+import subprocess
+import unittest
+import sys
+
+sys.path.append('lib')  # noqa
+sys.path.append('src')  # noqa
+
+from mock import call, patch, MagicMock
+
+import rbd_client
+
+RBD = ['rbd', '--id', 'ceph-iscsi', '--conf', '/etc/ceph/iscsi/ceph.conf']
+
+
+class TestRBDClient(unittest.TestCase):
+
+    def setUp(self):
+        patcher = patch.object(rbd_client, 'subprocess')
+        self.subprocess = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.subprocess.PIPE = subprocess.PIPE
+        self.subprocess.DEVNULL = subprocess.DEVNULL
+        self.subprocess.CalledProcessError = subprocess.CalledProcessError
+        self.client = rbd_client.RBDClient()
+
+    def test_split_snapshot(self):
+        self.assertEqual(
+            rbd_client.split_snapshot('iscsi/golden@base'),
+            ('iscsi', 'golden', 'base'))
+        for spec in ('iscsi/golden', 'golden@base', 'a/b/c@d'):
+            with self.assertRaises(ValueError):
+                rbd_client.split_snapshot(spec)
+
+    def test_image_size(self):
+        self.subprocess.run.return_value.stdout = json.dumps({
+            'name': 'disk1',
+            'size': 21474836480,
+            'objects': 5120}).encode()
+        self.assertEqual(
+            self.client.image_size('iscsi', 'disk1'),
+            21474836480)
+        self.assertEqual(
+            self.subprocess.run.call_args[0][0],
+            RBD + ['info', '--format', 'json', 'iscsi/disk1'])
+
+    def test_image_size_error(self):
+        self.subprocess.run.side_effect = subprocess.CalledProcessError(
+            2, 'rbd', stderr=b'rbd: error opening image disk1\n')
+        with self.assertRaises(rbd_client.RBDError) as cm:
+            self.client.image_size('iscsi', 'disk1')
+        self.assertEqual(
+            str(cm.exception),
+            'rbd info failed: rbd: error opening image disk1')
+
+    def test_create_image(self):
+        self.subprocess.run.side_effect = [
+            subprocess.CalledProcessError(2, 'rbd', stderr=b'not found'),
+            MagicMock()]
+        self.client.create_image('iscsi', 'disk1', '2T', 'iscsi-ec')
+        self.assertEqual(
+            self.subprocess.run.call_args[0][0],
+            RBD + [
+                'create', '--size', '2T', '--data-pool', 'iscsi-ec',
+                'iscsi/disk1'])
+
+    def test_create_image_exists(self):
+        self.client.create_image('iscsi', 'disk1', '2T', 'iscsi-ec')
+        self.subprocess.run.assert_called_once()
+
+    def test_clone_image(self):
+        self.subprocess.run.side_effect = [
+            subprocess.CalledProcessError(2, 'rbd', stderr=b'not found'),
+            MagicMock(),
+            MagicMock()]
+        self.client.clone_image('iscsi/golden@base', 'iscsi', 'vdi1', '40G')
+        self.assertEqual(
+            [c[0][0] for c in self.subprocess.run.call_args_list],
+            [
+                RBD + ['info', 'iscsi/vdi1'],
+                RBD + ['clone', 'iscsi/golden@base', 'iscsi/vdi1'],
+                RBD + [
+                    'resize', '--no-progress', '--size', '40G',
+                    'iscsi/vdi1']])
+
+    def test_clone_image_exists(self):
+        info = MagicMock()
+        info.stdout = json.dumps({
+            'name': 'vdi1',
+            'parent': {
+                'pool': 'iscsi',
+                'pool_namespace': '',
+                'image': 'golden',
+                'snapshot': 'base'}}).encode()
+        self.subprocess.run.return_value = info
+        self.client.clone_image('iscsi/golden@base', 'iscsi', 'vdi1')
+        self.assertEqual(
+            [c[0][0] for c in self.subprocess.run.call_args_list],
+            [
+                RBD + ['info', 'iscsi/vdi1'],
+                RBD + ['info', '--format', 'json', 'iscsi/vdi1']])
+
+    def test_clone_image_exists_other_parent(self):
+        info = MagicMock()
+        info.stdout = json.dumps({
+            'name': 'vdi1',
+            'parent': {
+                'pool': 'iscsi',
+                'pool_namespace': '',
+                'image': 'golden',
+                'snapshot': 'old'}}).encode()
+        self.subprocess.run.return_value = info
+        with self.assertRaises(rbd_client.RBDError) as cm:
+            self.client.clone_image('iscsi/golden@base', 'iscsi', 'vdi1')
+        self.assertEqual(
+            str(cm.exception),
+            'iscsi/vdi1 already exists and is not a clone of '
+            'iscsi/golden@base, its parent is iscsi/golden@old')
+        # Nor is an image that is no clone at all reused.
+        info.stdout = json.dumps({'name': 'vdi1'}).encode()
+        with self.assertRaisesRegex(rbd_client.RBDError, 'not a clone'):
+            self.client.clone_image('iscsi/golden@base', 'iscsi', 'vdi1')
+        self.assertNotIn(
+            'clone',
+            [c[0][0][5] for c in self.subprocess.run.call_args_list])
+
+    def test_clone_image_error(self):
+        self.subprocess.run.side_effect = [
+            subprocess.CalledProcessError(2, 'rbd', stderr=b'not found'),
+            subprocess.CalledProcessError(
+                2, 'rbd', stderr=b'parent snapshot must be protected\n')]
+        with self.assertRaisesRegex(rbd_client.RBDError, 'protected'):
+            self.client.clone_image('iscsi/golden@base', 'iscsi', 'vdi1')
+
+    def test_parse_qos(self):
+        self.assertEqual(
+            rbd_client.parse_qos({'iops_limit': '500', 'bps_limit': '100M'}),
+            {'iops_limit': 500, 'bps_limit': 100 * 2 ** 20})
+        for qos in ({'iops': 5}, {'iops_limit': 'lots'}, {'bps_limit': -1}):
+            with self.assertRaises(ValueError):
+                rbd_client.parse_qos(qos)
+
+    def test_image_qos(self):
+        self.client.set_image_qos(
+            'iscsi',
+            'disk1',
+            {'iops_limit': 500, 'bps_limit': 1048576})
+        self.assertEqual(
+            [c[0][0] for c in self.subprocess.run.call_args_list],
+            [
+                RBD + [
+                    'config', 'image', 'set', 'iscsi/disk1',
+                    'rbd_qos_bps_limit', '1048576'],
+                RBD + [
+                    'config', 'image', 'set', 'iscsi/disk1',
+                    'rbd_qos_iops_limit', '500']])
+        self.subprocess.run.return_value.stdout = json.dumps([
+            {'name': 'rbd_qos_iops_limit', 'value': '500', 'source': 'image'},
+            {'name': 'rbd_qos_bps_limit', 'value': '0', 'source': 'config'},
+            {'name': 'rbd_qos_schedule_tick_min', 'value': '50',
+             'source': 'config'},
+            {'name': 'rbd_cache', 'value': 'true', 'source': 'config'},
+        ]).encode()
+        self.assertEqual(
+            self.client.get_image_qos('iscsi', 'disk1'),
+            {'iops_limit': 500})
+        self.subprocess.run.return_value.stdout = json.dumps([
+            {'name': 'rbd_qos_iops_limit', 'value': '500', 'source': 'pool'},
+            {'name': 'rbd_qos_bps_burst', 'value': '2048', 'source': 'image'},
+        ]).encode()
+        self.assertEqual(
+            self.client.get_image_qos('iscsi', 'disk1'),
+            {'iops_limit': 500, 'bps_burst': 2048})
+        self.assertEqual(
+            self.client.get_image_qos('iscsi', 'disk1', image_only=True),
+            {'bps_burst': 2048})
+
+    def test_flatten_image(self):
+        self.client.flatten_image('iscsi', 'vdi1')
+        self.assertEqual(
+            self.subprocess.Popen.call_args,
+            call(
+                RBD + ['flatten', '--no-progress', 'iscsi/vdi1'],
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                start_new_session=True))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+import threading
+import time
+import unittest
+import sys
+
+sys.path.append('lib')  # noqa
+sys.path.append('src')  # noqa
+
+import task_graph
+
+
+class TestTaskGraph(unittest.TestCase):
+
+    def setUp(self):
+        self.lock = threading.Lock()
+        self.running = 0
+        self.max_running = 0
+        self.order = []
+
+    def work(self, name, duration=0.05):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+            self.order.append(name)
+        time.sleep(duration)
+        with self.lock:
+            self.running -= 1
+        return name
+
+    def test_run_parallel(self):
+        graph = task_graph.TaskGraph()
+        for i in range(6):
+            graph.add('t{}'.format(i), self.work, ('t{}'.format(i),))
+        results = graph.run(workers=3)
+        self.assertEqual(self.max_running, 3)
+        self.assertEqual(
+            [r['result'] for r in results.values()],
+            ['t0', 't1', 't2', 't3', 't4', 't5'])
+        self.assertTrue(
+            all(r['status'] == task_graph.DONE for r in results.values()))
+
+    def test_run_no_workers(self):
+        graph = task_graph.TaskGraph()
+        for i in range(3):
+            graph.add('t{}'.format(i), self.work, ('t{}'.format(i),))
+        for workers in (0, -2):
+            results = graph.run(workers=workers)
+            self.assertEqual(
+                [r['status'] for r in results.values()],
+                [task_graph.DONE] * 3)
+        self.assertEqual(self.max_running, 1)
+
+    def test_dependencies(self):
+        graph = task_graph.TaskGraph()
+        graph.add('a', self.work, ('a',))
+        graph.add('b', self.work, ('b', 0.01))
+        graph.add('c', self.work, ('c',), deps=['a', 'b'])
+        graph.run(workers=4)
+        self.assertEqual(self.order[-1], 'c')
+
+    def test_locks(self):
+        graph = task_graph.TaskGraph()
+        graph.add('a', self.work, ('a',), locks=['target'])
+        graph.add('b', self.work, ('b',), locks=['target'])
+        graph.add('c', self.work, ('c',), locks=['disk'])
+        graph.run(workers=4)
+        self.assertEqual(self.max_running, 2)
+        self.assertEqual(self.order.index('a') < self.order.index('b'), True)
+
+    def test_failure_skips_dependents(self):
+        def fail():
+            raise Exception('boom')
+
+        graph = task_graph.TaskGraph()
+        graph.add('a', fail)
+        graph.add('b', self.work, ('b',), deps=['a'])
+        graph.add('c', self.work, ('c',), deps=['b'])
+        graph.add('d', self.work, ('d',))
+        results = graph.run(workers=2)
+        self.assertEqual(results['a']['status'], task_graph.FAILED)
+        self.assertEqual(results['a']['error'], 'boom')
+        self.assertEqual(results['b']['status'], task_graph.SKIPPED)
+        self.assertEqual(results['c']['status'], task_graph.SKIPPED)
+        self.assertEqual(results['d']['status'], task_graph.DONE)
+        self.assertEqual(self.order, ['d'])
+
+    def test_unknown_dependency(self):
+        graph = task_graph.TaskGraph()
+        with self.assertRaises(ValueError):
+            graph.add('a', self.work, deps=['b'])
+
+
+if __name__ == '__main__':
+    unittest.main()